@@ -22,6 +22,7 @@ setup(
         'netCDF4',
         'pandas',
         'RAPIDpy',
+        'scipy',
         'tethys_dataset_services',
         'xarray',
     ],
@@ -10,20 +10,11 @@
 import datetime
 from glob import glob
 import json
-from multiprocessing import Pool as mp_Pool
+from multiprocessing import cpu_count, Pool as mp_Pool
 import os
 from shutil import rmtree
-import tarfile
 from traceback import print_exc
 
-try:
-    from condorpy import Job as CJob
-    from condorpy import Templates as tmplt
-
-    CONDOR_ENABLED = True
-except ImportError:
-    CONDOR_ENABLED = False
-    pass
 try:
     from spt_dataset_manager.dataset_manager import (ECMWFRAPIDDatasetManager,
                                                      RAPIDInputDatasetManager)
@@ -43,9 +34,12 @@ except ImportError:
     pass
 
 from .process_lock import update_lock_info_file
-from .imports.ftp_ecmwf_download import get_ftp_forecast_list, download_and_extract_ftp
+from .imports.CreateInflowFileFromECMWFRunoff import CreateInflowFileFromECMWFRunoff
+from .imports.ftp_ecmwf_download import get_ftp_download_paths, get_ftp_forecast_list, ForecastPrefetcher
 from .imports.generate_warning_points import generate_ecmwf_warning_points
 from .imports.helper_functions import (CaptureStdOutToLog,
+                                       case_insensitive_file_search,
+                                       clean_job_directories,
                                        clean_logs,
                                        find_current_rapid_output,
                                        get_valid_watershed_list,
@@ -53,8 +47,37 @@ from .imports.helper_functions import (CaptureStdOutToLog,
                                        get_datetime_from_forecast_folder,
                                        get_date_timestep_from_forecast_folder,
                                        get_ensemble_number_from_forecast,
-                                       get_watershed_subbasin_from_folder, )
-from .imports.ecmwf_rapid_multiprocess_worker import run_ecmwf_rapid_multiprocess_worker
+                                       get_staging_directory,
+                                       get_total_memory_mb,
+                                       get_watershed_subbasin_from_folder,
+                                       is_memory_file_system, )
+from .imports.ecmwf_forecast_metadata import build_forecast_metadata_index
+from .imports.ecmwf_rapid_multiprocess_worker import (get_job_staging_mb,
+                                                      run_ecmwf_rapid_multiprocess_worker,
+                                                      set_watershed_state_cache_mb)
+from .imports.rapid_qout_merge import is_valid_qout_file, QOUT_TIME_LENGTH
+from .imports.job_executors import (CONDOR_ENABLED,
+                                    get_job_executor,
+                                    get_job_executor_processes,
+                                    JOB_EXECUTOR_MODES)
+from .imports.job_scheduler import (estimate_job_cost,
+                                    estimate_job_memory_mb,
+                                    estimate_regional_inflow_memory_mb,
+                                    format_cycle_eta,
+                                    get_weight_table_extent,
+                                    JobCostModel,
+                                    order_longest_job_first,
+                                    predict_cycle_eta)
+from .imports.job_stats import read_job_stats, write_job_stats_summary
+from .imports.task_graph import TaskGraph
+from .imports.upload_queue import upload_single_forecast, UploadQueue
+from .imports.worker_pool import AffinityWorkerPool
+from .imports.watershed_input_manifest import (build_watershed_input_manifest,
+                                              get_watershed_river_count,
+                                              write_watershed_input_manifest)
+from .imports.ecmwf_regional_inflow import (get_regional_inflow_batches,
+                                            get_regional_inflow_directory,
+                                            run_regional_inflow_worker)
 from .imports.streamflow_assimilation import (compute_initial_rapid_flows,
                                               compute_seasonal_initial_rapid_flows_multicore_worker,
                                               update_inital_flows_usgs, )
@@ -63,42 +86,37 @@ from .imports.streamflow_assimilation import (compute_initial_rapid_flows,
 # ----------------------------------------------------------------------------------------
 # HELPER FUNCTIONS
 # ----------------------------------------------------------------------------------------
-def upload_single_forecast(job_info, data_manager):
+def compile_ecmwf_weight_tables(watershed_input_directory, write_cache=True):
     """
-    Uploads a single forecast file to CKAN
+    Compiles the ECMWF weight tables of the watershed once so that
+    the ensemble jobs do not parse the weight table csv files.
+    With write_cache=False, the compiled weight tables are read
+    but not written (e.g. for a dry run).
+
+    Returns the runoff bounding box size and number of runoff cells
+    of the weight table of each resolution (True for high resolution)
     """
-    print("Uploading {0} {1} {2} {3}".format(job_info['watershed'],
-                                             job_info['subbasin'],
-                                             job_info['forecast_date_timestep'],
-                                             job_info['ensemble_number']))
-
-    # Upload to CKAN
-    data_manager.initialize_run_ecmwf(job_info['watershed'], job_info['subbasin'], job_info['forecast_date_timestep'])
-    data_manager.update_resource_ensemble_number(job_info['ensemble_number'])
-    # upload file
-    try:
-        # tar.gz file
-        output_tar_file = os.path.join(job_info['master_watershed_outflow_directory'],
-                                       "%s.tar.gz" % data_manager.resource_name)
-        if not os.path.exists(output_tar_file):
-            with tarfile.open(output_tar_file, "w:gz") as tar:
-                tar.add(job_info['outflow_file_name'], arcname=os.path.basename(job_info['outflow_file_name']))
-        return_data = data_manager.upload_resource(output_tar_file)
-        if not return_data['success']:
-            print(return_data)
-            print("Attempting to upload again")
-            return_data = data_manager.upload_resource(output_tar_file)
-            if not return_data['success']:
-                print(return_data)
+    weight_table_extents = {}
+    inflow_tool = CreateInflowFileFromECMWFRunoff()
+    for high_res in (True, False):
+        grid_name = inflow_tool.getGridName(None, high_res=high_res)
+        try:
+            weight_table_file = case_insensitive_file_search(watershed_input_directory,
+                                                             r'weight_{0}\.csv'.format(grid_name))
+        except IndexError:
+            continue
+        try:
+            if write_cache:
+                weight_table = inflow_tool.readWeightTable(weight_table_file)
             else:
-                print("Upload success")
-        else:
-            print("Upload success")
-    except Exception as ex:
-        print(ex)
-        pass
-    # remove tar.gz file
-    os.remove(output_tar_file)
+                weight_table = inflow_tool.loadWeightTableCache(weight_table_file)
+                if weight_table is None:
+                    weight_table = inflow_tool.compileWeightTable(weight_table_file)
+            weight_table_extents[high_res] = get_weight_table_extent(weight_table)
+        except Exception as ex:
+            print("WARNING: Unable to compile {0}: {1}".format(weight_table_file, ex))
+            pass
+    return weight_table_extents
 
 
 # ----------------------------------------------------------------------------------------
@@ -122,6 +140,11 @@ def run_ecmwf_forecast_process(rapid_executable_location,  # path to RAPID execu
                                ftp_passwd="",  # ECMWF ftp password
                                ftp_directory="",  # ECMWF ftp directory
                                delete_past_ecmwf_forecasts=True,  # Deletes all past forecasts before next run
+                               prefetch_forecasts=1,  # number of forecasts downloaded while a forecast is computed
+                               prefetch_min_free_mb=1024,  # free space to keep in the forecast directory when prefetching
+                               num_uploaders=2,  # number of forecasts uploaded to CKAN at the same time
+                               upload_wait_minutes=60,  # wait for the pending uploads before the output is deleted (delete_output_when_done)
+                               memory_budget_mb=None,  # memory of the jobs running at the same time and the watershed state of the workers, 80% of the memory by default (multiprocess mode)
                                upload_output_to_ckan=False,  # upload data to CKAN and remove local copy
                                delete_output_when_done=False,  # delete all output data from this code
                                initialize_flows=False,  # use forecast to initialize next run
@@ -133,8 +156,19 @@ def run_ecmwf_forecast_process(rapid_executable_location,  # path to RAPID execu
                                geoserver_url="",  # url to API endpoint ending in geoserver/rest
                                geoserver_username="",  # username for geoserver
                                geoserver_password="",  # password for geoserver
-                               mp_mode='htcondor',  # valid options are htcondor and multiprocess,
-                               mp_execute_directory="",  # required if using multiprocess mode
+                               mp_mode='htcondor',  # valid options are htcondor, multiprocess, futures, serial and local_condor
+                               mp_execute_directory="",  # required if using multiprocess, futures or serial mode
+                               regional_inflow=True,  # extract inflow for all watersheds from one read of each forecast (multiprocess mode)
+                               inflow_memory_limit_mb=None,  # memory limit of the inflow of each job (multiprocess mode)
+                               inflow_precision="float64",  # float32 computes the inflow without masked arrays in the precision of the inflow file (multiprocess mode)
+                               inflow_format="NETCDF3_CLASSIC",  # NETCDF3_CLASSIC, NETCDF3_64BIT_OFFSET, NETCDF4 or auto to benchmark (multiprocess mode)
+                               staging_directories=(),  # directories for job files if there is space, e.g. local scratch or /dev/shm, which uses memory (multiprocess mode)
+                               watershed_state_cache_mb=512,  # memory of the watershed inputs kept by each worker between jobs (multiprocess mode)
+                               job_retries=1,  # times a failed job is run again from its last completed stage (multiprocess mode)
+                               job_retry_delay_seconds=30,  # wait before running a failed job again (multiprocess mode)
+                               skip_completed_jobs=True,  # skip jobs with a valid Qout file from a previous run of the forecast
+                               cycle_walltime_hours=None,  # warn if the jobs of a forecast cycle are predicted to take longer (multiprocess mode)
+                               dry_run=False,  # print the plan of the tasks of each forecast cycle without running them
                               ):
     """
     This it the main ECMWF RAPID forecast process
@@ -149,6 +183,9 @@ def run_ecmwf_forecast_process(rapid_executable_location,  # path to RAPID execu
 
     with CaptureStdOutToLog(log_file_path):
 
+        if mp_mode not in JOB_EXECUTOR_MODES:
+            raise Exception("ERROR: Invalid mp_mode. Valid types are {0} ...".format(", ".join(JOB_EXECUTOR_MODES)))
+
         if not CONDOR_ENABLED and mp_mode == 'htcondor':
             raise ImportError("condorpy is not installed. Please install condorpy to use the 'htcondor' option.")
 
@@ -156,11 +193,34 @@ def run_ecmwf_forecast_process(rapid_executable_location,  # path to RAPID execu
             raise ImportError("AutoRoute is not enabled. Please install tethys_dataset_services"
                               " and AutoRoutePy to use the AutoRoute option.")
 
-        if mp_mode == "multiprocess":
+        # options of the inflow of each job run on this machine
+        inflow_options = {}
+        # the jobs of these modes run in the execute directory of this machine
+        if mp_mode in ("multiprocess", "futures", "serial"):
             if not mp_execute_directory or not os.path.exists(mp_execute_directory):
-                raise Exception("If mode is multiprocess, mp_execute_directory is required ...")
-
-        if sync_rapid_input_with_ckan and app_instance_id and data_store_url and data_store_api_key:
+                raise Exception("If mode is {0}, mp_execute_directory is required ...".format(mp_mode))
+
+            inflow_options['memory_limit_mb'] = inflow_memory_limit_mb
+            inflow_options['inflow_precision'] = inflow_precision
+            if inflow_format == "auto" and dry_run:
+                print("INFO: The inflow format is picked by a benchmark when the forecasts run ...")
+            elif inflow_format == "auto":
+                # pick the fastest inflow format on the file system the jobs write to,
+                # the benchmark inflow file is about 5 MB
+                benchmark_directory = get_staging_directory(mp_execute_directory, "inflow_format_benchmark",
+                                                            5, staging_directories)
+                try:
+                    inflow_format, format_seconds = \
+                        CreateInflowFileFromECMWFRunoff().benchmarkInflowFormats(benchmark_directory)
+                finally:
+                    rmtree(benchmark_directory, ignore_errors=True)
+                for benchmark_format, seconds in sorted(format_seconds.items()):
+                    print("INFO: Inflow format {0}: {1:.3f} seconds".format(benchmark_format, seconds))
+                print("INFO: Using the {0} inflow format ...".format(inflow_format))
+            inflow_options['inflow_format'] = inflow_format
+
+        if sync_rapid_input_with_ckan and app_instance_id and data_store_url and data_store_api_key \
+                and not dry_run:
             # sync with data store
             ri_manager = RAPIDInputDatasetManager(data_store_url,
                                                   data_store_api_key,
@@ -169,7 +229,8 @@ def run_ecmwf_forecast_process(rapid_executable_location,  # path to RAPID execu
             ri_manager.sync_dataset(os.path.join(rapid_io_files_location, 'input'))
 
         # clean up old log files
-        clean_logs(subprocess_log_directory, main_log_directory, log_file_path=log_file_path)
+        if not dry_run:
+            clean_logs(subprocess_log_directory, main_log_directory, log_file_path=log_file_path)
 
         data_manager = None
         if upload_output_to_ckan and data_store_url and data_store_api_key:
@@ -228,12 +289,60 @@ def run_ecmwf_forecast_process(rapid_executable_location,  # path to RAPID execu
             return
 
         # GENERATE NEW LOCK INFO FILE
-        update_lock_info_file(LOCK_INFO_FILE, True, last_forecast_date.strftime('%Y%m%d%H'))
+        # a dry run only reads the forecasts and inputs, so it does not lock them
+        if not dry_run:
+            update_lock_info_file(LOCK_INFO_FILE, True, last_forecast_date.strftime('%Y%m%d%H'))
+
+        # the files of the jobs staged on a RAM disk are part of their memory
+        staging_in_memory = any(is_memory_file_system(staging_directory)
+                                for staging_directory in staging_directories)
+        # one pool of workers for the whole run (multiprocess mode)
+        # jobs of a watershed go to the workers that already loaded its inputs
+        worker_pool = None
+        if mp_mode == "multiprocess" and not dry_run:
+            # jobs are started while their estimated memory is within the budget
+            if memory_budget_mb is None:
+                total_memory_mb = get_total_memory_mb()
+                if total_memory_mb is not None:
+                    memory_budget_mb = 0.8 * total_memory_mb
+            num_pool_processes = cpu_count()
+            if memory_budget_mb is not None:
+                # the watershed state each worker of the pool keeps between
+                # jobs is not part of the memory of the jobs
+                state_cache_mb = num_pool_processes * watershed_state_cache_mb
+                if state_cache_mb > 0.5 * memory_budget_mb:
+                    print("WARNING: The watershed state of {0} workers ({1:.0f} MB) takes more than half "
+                          "of the memory budget ({2:.0f} MB). Lower watershed_state_cache_mb "
+                          "or raise memory_budget_mb ...".format(num_pool_processes, state_cache_mb,
+                                                                 memory_budget_mb))
+                if state_cache_mb >= memory_budget_mb:
+                    print("WARNING: No memory budget is left for the jobs. "
+                          "Using half of the memory budget for the jobs ...")
+                    memory_budget_mb *= 0.5
+                else:
+                    memory_budget_mb -= state_cache_mb
+                print("INFO: Memory budget of the jobs: {0:.0f} MB ...".format(memory_budget_mb))
+            worker_pool = AffinityWorkerPool(processes=num_pool_processes,
+                                             initializer=set_watershed_state_cache_mb,
+                                             initargs=(watershed_state_cache_mb,),
+                                             memory_budget_mb=memory_budget_mb)
+        # runs the watershed jobs of each forecast cycle
+        job_executor = None
+        if not dry_run:
+            job_executor = get_job_executor(mp_mode, worker_pool, scratch_directory=mp_execute_directory or None)
+        # number of jobs run at the same time to predict the runtime of the jobs
+        num_job_processes = get_job_executor_processes(mp_mode) if job_executor is None \
+            else job_executor.processes
+
+        # runtime of the jobs predicted from the measured runtime of past jobs
+        job_cost_model = JobCostModel(os.path.join(subprocess_log_directory, "job_cost_history.json"))
 
         # Try/Except added for lock file
+        forecast_prefetcher = None
+        upload_queue = None
         try:
             # ADD SEASONAL INITIALIZATION WHERE APPLICABLE
-            if initialize_flows:
+            if initialize_flows and not dry_run:
                 initial_forecast_date_timestep = get_date_timestep_from_forecast_folder(ecmwf_folders[0])
                 seasonal_init_job_list = []
                 for rapid_input_directory in rapid_input_directories:
@@ -273,14 +382,39 @@ def run_ecmwf_forecast_process(rapid_executable_location,  # path to RAPID execu
             # ----------------------------------------------------------------------
             # BEGIN ECMWF-RAPID FORECAST LOOP
             # ----------------------------------------------------------------------
+            # threads are started after the seasonal initialization pool
+            if download_ecmwf and not dry_run:
+                # download the next forecasts while a forecast is computed
+                forecast_prefetcher = ForecastPrefetcher(ecmwf_forecast_location, ecmwf_folders,
+                                                         ftp_host, ftp_login,
+                                                         ftp_passwd, ftp_directory,
+                                                         look_ahead=prefetch_forecasts,
+                                                         min_free_mb=prefetch_min_free_mb,
+                                                         remove_past_downloads=delete_past_ecmwf_forecasts)
+            if data_manager and not dry_run:
+                # forecasts are uploaded in the background, pending uploads are kept for the next run
+                upload_queue = UploadQueue(os.path.join(subprocess_log_directory, "upload_queue.json"),
+                                           upload_single_forecast,
+                                           lambda: ECMWFRAPIDDatasetManager(data_store_url,
+                                                                            data_store_api_key,
+                                                                            data_store_owner_org),
+                                           num_uploaders=num_uploaders)
+
+            # the upload tasks are also planned by a dry run, which has no upload queue
+            def put_upload(job_info):
+                """
+                Adds the output of the job to the uploads
+                """
+                upload_queue.put(job_info)
+
             master_job_info_list = []
-            for ecmwf_folder in ecmwf_folders:
-                if download_ecmwf:
+            for ecmwf_folder_index, ecmwf_folder in enumerate(ecmwf_folders):
+                if download_ecmwf and dry_run:
+                    # the forecast is planned from the download directory without downloading it
+                    ecmwf_folder = get_ftp_download_paths(ecmwf_forecast_location, ecmwf_folder)[1]
+                elif download_ecmwf:
                     # download forecast
-                    ecmwf_folder = download_and_extract_ftp(ecmwf_forecast_location, ecmwf_folder,
-                                                            ftp_host, ftp_login,
-                                                            ftp_passwd, ftp_directory,
-                                                            delete_past_ecmwf_forecasts)
+                    ecmwf_folder = forecast_prefetcher.get(ecmwf_folder_index)
 
                 # get list of forecast files
                 ecmwf_forecasts = glob(os.path.join(ecmwf_folder, '*.runoff.%s*nc' % region))
@@ -290,137 +424,47 @@ def run_ecmwf_forecast_process(rapid_executable_location,  # path to RAPID execu
                     ecmwf_forecasts = glob(os.path.join(ecmwf_folder, 'full_*.runoff.netcdf')) + \
                                       glob(os.path.join(ecmwf_folder, '*.52.205.*.runoff.netcdf'))
 
-                if not ecmwf_forecasts:
-                    print("ERROR: Forecasts not found in folder. Exiting ...")
-                    update_lock_info_file(LOCK_INFO_FILE, False, last_forecast_date.strftime('%Y%m%d%H'))
-                    return
-
-                # make the largest files first
-                ecmwf_forecasts.sort(key=os.path.getsize, reverse=True)
+                forecast_metadata = {}
+                if not ecmwf_forecasts and download_ecmwf and dry_run:
+                    # the jobs of a forecast not downloaded are planned for its
+                    # ensembles, the high resolution ensemble 52 first
+                    print("INFO: {0} is not downloaded. Planning the jobs of its 52 ensembles ..."
+                          .format(os.path.basename(ecmwf_folder)))
+                    ecmwf_forecasts = [os.path.join(ecmwf_folder, "{0}.runoff.nc".format(ensemble_number))
+                                       for ensemble_number in range(52, 0, -1)]
+                else:
+                    if not ecmwf_forecasts:
+                        print("ERROR: Forecasts not found in folder. Exiting ...")
+                        if not dry_run:
+                            update_lock_info_file(LOCK_INFO_FILE, False, last_forecast_date.strftime('%Y%m%d%H'))
+                        return
+
+                    # read the metadata of each forecast once for all of the jobs
+                    forecast_metadata = build_forecast_metadata_index(ecmwf_folder, ecmwf_forecasts,
+                                                                      write_index=not dry_run)
+
+                    # make the largest files first
+                    ecmwf_forecasts.sort(key=os.path.getsize, reverse=True)
 
                 forecast_date_timestep = get_date_timestep_from_forecast_folder(ecmwf_folder)
                 print("Running ECMWF Forecast: {0}".format(forecast_date_timestep))
 
-                # submit jobs to downsize ecmwf files to watershed
-                rapid_watershed_jobs = {}
-                for rapid_input_directory in rapid_input_directories:
-                    # keep list of jobs
-                    rapid_watershed_jobs[rapid_input_directory] = {
-                        'jobs': [],
-                        'jobs_info': []
-                    }
-                    print("Running forecasts for: {0} {1}".format(rapid_input_directory,
-                                                                  os.path.basename(ecmwf_folder)))
-
-                    watershed, subbasin = get_watershed_subbasin_from_folder(rapid_input_directory)
-                    master_watershed_input_directory = os.path.join(rapid_io_files_location, "input",
-                                                                    rapid_input_directory)
-                    master_watershed_outflow_directory = os.path.join(rapid_io_files_location, 'output',
-                                                                      rapid_input_directory, forecast_date_timestep)
-                    try:
-                        os.makedirs(master_watershed_outflow_directory)
-                    except OSError:
-                        pass
-
-                    # initialize HTCondor/multiprocess Logging Directory
-                    subprocess_forecast_log_dir = os.path.join(subprocess_log_directory, forecast_date_timestep)
-                    try:
-                        os.makedirs(subprocess_forecast_log_dir)
-                    except OSError:
-                        pass
-
-                    # add USGS gage data to initialization file
-                    if initialize_flows:
-                        # update intial flows with usgs data
-                        update_inital_flows_usgs(master_watershed_input_directory,
-                                                 forecast_date_timestep)
-
-                    # create jobs for HTCondor/multiprocess
-                    for watershed_job_index, forecast in enumerate(ecmwf_forecasts):
-                        ensemble_number = get_ensemble_number_from_forecast(forecast)
-
-                        # get basin names
-                        outflow_file_name = 'Qout_%s_%s_%s.nc' % (watershed.lower(), subbasin.lower(), ensemble_number)
-                        node_rapid_outflow_file = outflow_file_name
-                        master_rapid_outflow_file = os.path.join(master_watershed_outflow_directory, outflow_file_name)
-
-                        job_name = 'job_%s_%s_%s_%s' % (forecast_date_timestep, watershed, subbasin, ensemble_number)
-
-                        rapid_watershed_jobs[rapid_input_directory]['jobs_info'].append({'watershed': watershed,
-                                                                                         'subbasin': subbasin,
-                                                                                         'outflow_file_name': master_rapid_outflow_file,
-                                                                                         'forecast_date_timestep': forecast_date_timestep,
-                                                                                         'ensemble_number': ensemble_number,
-                                                                                         'master_watershed_outflow_directory': master_watershed_outflow_directory,
-                                                                                         })
-                        if mp_mode == "htcondor":
-                            # create job to downscale forecasts for watershed
-                            job = CJob(job_name, tmplt.vanilla_transfer_files)
-                            job.set('executable', os.path.join(LOCAL_SCRIPTS_DIRECTORY, 'htcondor_ecmwf_rapid.py'))
-                            job.set('transfer_input_files', "%s, %s, %s" % (
-                            forecast, master_watershed_input_directory, LOCAL_SCRIPTS_DIRECTORY))
-                            job.set('initialdir', subprocess_forecast_log_dir)
-                            job.set('arguments', '%s %s %s %s %s %s' % (
-                            forecast, forecast_date_timestep, watershed.lower(), subbasin.lower(),
-                            rapid_executable_location, initialize_flows))
-                            job.set('transfer_output_remaps',
-                                    "\"%s = %s\"" % (node_rapid_outflow_file, master_rapid_outflow_file))
-                            job.submit()
-                            rapid_watershed_jobs[rapid_input_directory]['jobs'].append(job)
-                        elif mp_mode == "multiprocess":
-                            rapid_watershed_jobs[rapid_input_directory]['jobs'].append((forecast,
-                                                                                        forecast_date_timestep,
-                                                                                        watershed.lower(),
-                                                                                        subbasin.lower(),
-                                                                                        rapid_executable_location,
-                                                                                        initialize_flows,
-                                                                                        job_name,
-                                                                                        master_rapid_outflow_file,
-                                                                                        master_watershed_input_directory,
-                                                                                        mp_execute_directory,
-                                                                                        subprocess_forecast_log_dir,
-                                                                                        watershed_job_index))
-                            # COMMENTED CODE FOR DEBUGGING SERIALLY
-                            ##                    run_ecmwf_rapid_multiprocess_worker((forecast,
-                            ##                                                         forecast_date_timestep,
-                            ##                                                         watershed.lower(),
-                            ##                                                         subbasin.lower(),
-                            ##                                                         rapid_executable_location,
-                            ##                                                         initialize_flows,
-                            ##                                                         job_name,
-                            ##                                                         master_rapid_outflow_file,
-                            ##                                                         master_watershed_input_directory,
-                            ##                                                         mp_execute_directory,
-                            ##                                                         subprocess_forecast_log_dir,
-                            ##                                                         watershed_job_index))
-                        else:
-                            raise Exception("ERROR: Invalid mp_mode. Valid types are htcondor and multiprocess ...")
-
-                for rapid_input_directory, watershed_job_info in rapid_watershed_jobs.items():
-                    # add sub job list to master job list
-                    master_job_info_list = master_job_info_list + watershed_job_info['jobs_info']
-                    if mp_mode == "htcondor":
-                        # wait for jobs to finish then upload files
-                        for job_index, job in enumerate(watershed_job_info['jobs']):
-                            job.wait()
-                            # upload file when done
-                            if data_manager:
-                                upload_single_forecast(watershed_job_info['jobs_info'][job_index], data_manager)
-
-                    elif mp_mode == "multiprocess":
-                        pool_main = mp_Pool()
-                        multiprocess_worker_list = pool_main.imap_unordered(run_ecmwf_rapid_multiprocess_worker,
-                                                                            watershed_job_info['jobs'],
-                                                                            chunksize=1)
-                        if data_manager:
-                            for multi_job_index in multiprocess_worker_list:
-                                # upload file when done
-                                upload_single_forecast(watershed_job_info['jobs_info'][multi_job_index], data_manager)
-
-                        # just in case ...
-                        pool_main.close()
-                        pool_main.join()
-
+                # the job directories of a previous run that stopped are removed,
+                # except for the jobs of this forecast, which continue from them
+                if mp_mode in ("multiprocess", "futures", "serial") and not dry_run:
+                    clean_job_directories([mp_execute_directory] + list(staging_directories),
+                                          forecast_date_timestep)
+
+                # inflow for all watersheds prepared before the watershed jobs
+                regional_inflow_directory = ""
+                if regional_inflow and mp_mode == "multiprocess":
+                    regional_inflow_directory = os.path.join(mp_execute_directory,
+                                                             "inflow_{0}".format(forecast_date_timestep))
+
+                def finish_watershed(rapid_input_directory):
+                    """
+                    Runs the steps of the watershed after all of its jobs are done
+                    """
                     # when all jobs in watershed are done, generate warning points
                     if create_warning_points:
                         watershed, subbasin = get_watershed_subbasin_from_folder(rapid_input_directory)
@@ -450,10 +494,8 @@ def run_ecmwf_forecast_process(rapid_executable_location,  # path to RAPID execu
                             print("No ERA Interim directory found for {0}. "
                                   "Skipping warning point generation...".format(rapid_input_directory))
 
-                # initialize flows for next run
-                if initialize_flows:
-                    # create new init flow files/generate warning point files
-                    for rapid_input_directory in rapid_input_directories:
+                    # initialize flows for next run
+                    if initialize_flows:
                         input_directory = os.path.join(rapid_io_files_location,
                                                        'input',
                                                        rapid_input_directory)
@@ -462,30 +504,340 @@ def run_ecmwf_forecast_process(rapid_executable_location,  # path to RAPID execu
                                                           rapid_input_directory,
                                                           forecast_date_timestep)
                         if os.path.exists(forecast_directory):
-                            # loop through all the rapid_namelist files in directory
                             watershed, subbasin = get_watershed_subbasin_from_folder(rapid_input_directory)
-                            if initialize_flows:
-                                print("Initializing flows for {0}-{1} from {2}".format(watershed, subbasin,
-                                                                                       forecast_date_timestep))
-                                basin_files = find_current_rapid_output(forecast_directory, watershed, subbasin)
-                                try:
-                                    compute_initial_rapid_flows(basin_files, input_directory, forecast_date_timestep)
-                                except Exception as ex:
-                                    print(ex)
-                                    pass
+                            print("Initializing flows for {0}-{1} from {2}".format(watershed, subbasin,
+                                                                                   forecast_date_timestep))
+                            basin_files = find_current_rapid_output(forecast_directory, watershed, subbasin)
+                            try:
+                                compute_initial_rapid_flows(basin_files, input_directory, forecast_date_timestep)
+                            except Exception as ex:
+                                print(ex)
+                                pass
+
+                # initialize the job logging directory
+                subprocess_forecast_log_dir = os.path.join(subprocess_log_directory, forecast_date_timestep)
+                if not dry_run:
+                    try:
+                        os.makedirs(subprocess_forecast_log_dir)
+                    except OSError:
+                        pass
+
+                # tasks of the forecast cycle, each runs when its inputs are ready
+                cycle_graph = TaskGraph(os.path.join(subprocess_forecast_log_dir, "task_memo.json"))
+                # tasks each job of the watershed runs after
+                watershed_depends = {}
+
+                # submit jobs to downsize ecmwf files to watershed
+                rapid_watershed_jobs = {}
+                watershed_input_manifests = {}
+                # runoff extents of the weight tables of each watershed
+                watershed_weight_table_extents = {}
+                # forecasts with a job to run in at least one watershed
+                pending_forecasts = set()
+                # jobs of all of the watersheds in the forecast cycle
+                cycle_jobs = []
+                # watershed, forecast resolution and cost of each job to learn the runtime
+                cycle_job_costs = {}
+                for rapid_input_directory in rapid_input_directories:
+                    # keep list of jobs
+                    rapid_watershed_jobs[rapid_input_directory] = {
+                        'jobs_info': [],
+                        'completed_jobs_info': [],
+                    }
+                    print("Running forecasts for: {0} {1}".format(rapid_input_directory,
+                                                                  os.path.basename(ecmwf_folder)))
+
+                    watershed, subbasin = get_watershed_subbasin_from_folder(rapid_input_directory)
+                    master_watershed_input_directory = os.path.join(rapid_io_files_location, "input",
+                                                                    rapid_input_directory)
+                    master_watershed_outflow_directory = os.path.join(rapid_io_files_location, 'output',
+                                                                      rapid_input_directory, forecast_date_timestep)
+                    if not dry_run:
+                        try:
+                            os.makedirs(master_watershed_outflow_directory)
+                        except OSError:
+                            pass
+
+                    # add USGS gage data to initialization file
+                    watershed_depends[rapid_input_directory] = []
+                    if initialize_flows:
+                        # update intial flows with usgs data
+                        watershed_depends[rapid_input_directory].append(
+                            cycle_graph.addTask("usgs/{0}".format(rapid_input_directory),
+                                                update_inital_flows_usgs,
+                                                (master_watershed_input_directory, forecast_date_timestep)))
+
+                    # compile weight tables once for all of the ensemble jobs
+                    weight_table_extents = compile_ecmwf_weight_tables(master_watershed_input_directory,
+                                                                       write_cache=not dry_run)
+                    watershed_weight_table_extents[rapid_input_directory] = weight_table_extents
+
+                    # find the watershed input files once for all of the jobs
+                    watershed_input_manifests[rapid_input_directory] = \
+                        build_watershed_input_manifest(master_watershed_input_directory)
+                    input_manifest_file = os.path.join(subprocess_forecast_log_dir,
+                                                       "{0}_input_manifest.json".format(rapid_input_directory))
+                    if not dry_run and job_executor.transfers_files:
+                        write_watershed_input_manifest(watershed_input_manifests[rapid_input_directory],
+                                                       input_manifest_file)
+
+                    # number of rivers in the Qout files to estimate the cost of the jobs
+                    # and to check for jobs completed before
+                    num_watershed_rivers = get_watershed_river_count(master_watershed_input_directory,
+                                                                     watershed_input_manifests[rapid_input_directory])
+                    num_watershed_reaches = get_watershed_river_count(master_watershed_input_directory,
+                                                                      watershed_input_manifests[rapid_input_directory],
+                                                                      'rapid_connect')
+                    watershed_key = "{0}-{1}".format(watershed, subbasin).lower()
+
+                    # create the jobs of the watershed
+                    for forecast in ecmwf_forecasts:
+                        ensemble_number = get_ensemble_number_from_forecast(forecast)
+
+                        # get basin names
+                        outflow_file_name = 'Qout_%s_%s_%s.nc' % (watershed.lower(), subbasin.lower(), ensemble_number)
+                        node_rapid_outflow_file = outflow_file_name
+                        master_rapid_outflow_file = os.path.join(master_watershed_outflow_directory, outflow_file_name)
+
+                        job_name = 'job_%s_%s_%s_%s' % (forecast_date_timestep, watershed, subbasin, ensemble_number)
+
+                        job_info = {'watershed': watershed,
+                                    'subbasin': subbasin,
+                                    'outflow_file_name': master_rapid_outflow_file,
+                                    'forecast_date_timestep': forecast_date_timestep,
+                                    'ensemble_number': ensemble_number,
+                                    'master_watershed_outflow_directory': master_watershed_outflow_directory,
+                                    }
+
+                        # skip the job if the forecast was rerun after it completed
+                        forecast_resolution = forecast_metadata.get(os.path.basename(forecast), {}).get('resolution')
+                        if skip_completed_jobs and num_watershed_rivers is not None \
+                                and forecast_resolution in QOUT_TIME_LENGTH \
+                                and is_valid_qout_file(master_rapid_outflow_file,
+                                                       QOUT_TIME_LENGTH[forecast_resolution],
+                                                       num_watershed_rivers):
+                            print("Skipping {0}. Valid output found from a previous run ...".format(job_name))
+                            rapid_watershed_jobs[rapid_input_directory]['completed_jobs_info'].append(job_info)
+                            continue
+
+                        pending_forecasts.add(forecast)
+                        cycle_job_costs[job_name] = (watershed_key, forecast_resolution,
+                                                     estimate_job_cost(num_watershed_reaches, forecast_resolution))
+                        rapid_watershed_jobs[rapid_input_directory]['jobs_info'].append(job_info)
+                        # the job index is the index of the job in the forecast cycle
+                        cycle_job_index = len(cycle_jobs)
+                        cycle_jobs.append({
+                            'job_name': job_name,
+                            'forecast': forecast,
+                            'rapid_input_directory': rapid_input_directory,
+                            'job_info': job_info,
+                            'watershed_key': watershed_key,
+                            # resource hints for the executor
+                            'affinity_key': rapid_input_directory,
+                            'predicted_seconds': job_cost_model.predictSeconds(watershed_key,
+                                                                               num_watershed_reaches,
+                                                                               forecast_resolution),
+                            'memory_mb': job_cost_model.predictMemoryMB(
+                                watershed_key, forecast_resolution,
+                                estimate_job_memory_mb(num_watershed_reaches, forecast_resolution,
+                                                       weight_table_extents.get(forecast_resolution not in
+                                                                                ('LowRes', 'LowResFull')),
+                                                       inflow_memory_limit_mb)) +
+                            (get_job_staging_mb(master_watershed_input_directory,
+                                                watershed_input_manifests[rapid_input_directory],
+                                                num_watershed_reaches)
+                             if staging_in_memory else 0),
+                            # job run by a worker on this machine
+                            'function': run_ecmwf_rapid_multiprocess_worker,
+                            'args': (forecast,
+                                     forecast_date_timestep,
+                                     watershed.lower(),
+                                     subbasin.lower(),
+                                     rapid_executable_location,
+                                     initialize_flows,
+                                     job_name,
+                                     master_rapid_outflow_file,
+                                     master_watershed_input_directory,
+                                     mp_execute_directory,
+                                     subprocess_forecast_log_dir,
+                                     cycle_job_index,
+                                     get_regional_inflow_directory(
+                                         regional_inflow_directory,
+                                         rapid_input_directory)
+                                     if regional_inflow_directory else "",
+                                     forecast_metadata,
+                                     inflow_options,
+                                     staging_directories,
+                                     watershed_input_manifests[rapid_input_directory],
+                                     job_retries,
+                                     job_retry_delay_seconds,
+                                     num_watershed_reaches),
+                            # job run on a node with its files transferred
+                            'htcondor': {
+                                'job_name': job_name,
+                                'executable': os.path.join(LOCAL_SCRIPTS_DIRECTORY, 'htcondor_ecmwf_rapid.py'),
+                                'arguments': [forecast, forecast_date_timestep, watershed.lower(),
+                                              subbasin.lower(), rapid_executable_location, initialize_flows,
+                                              os.path.basename(input_manifest_file)],
+                                'transfer_input_files': [forecast, master_watershed_input_directory,
+                                                         LOCAL_SCRIPTS_DIRECTORY, input_manifest_file],
+                                'transfer_output_remaps': {node_rapid_outflow_file: master_rapid_outflow_file},
+                                'initialdir': subprocess_forecast_log_dir,
+                            },
+                        })
+
+                if regional_inflow_directory and pending_forecasts:
+                    # read each forecast once and write the inflow of every watershed
+                    watershed_input_directories = dict((rapid_input_directory,
+                                                        os.path.join(rapid_io_files_location, "input",
+                                                                     rapid_input_directory))
+                                                       for rapid_input_directory in rapid_input_directories)
+                    # ensemble members with the same resolution are computed in batches
+                    regional_inflow_jobs = []
+                    for batch_index, forecast_batch in \
+                            enumerate(get_regional_inflow_batches([forecast for forecast in ecmwf_forecasts
+                                                                   if forecast in pending_forecasts],
+                                                                  forecast_metadata)):
+                        regional_inflow_jobs.append((forecast_batch,
+                                                     watershed_input_directories,
+                                                     regional_inflow_directory,
+                                                     os.path.join(subprocess_forecast_log_dir,
+                                                                  "inflow_{0}_{1}.log".format(
+                                                                      forecast_date_timestep,
+                                                                      batch_index)),
+                                                     forecast_metadata,
+                                                     inflow_options,
+                                                     watershed_input_manifests))
+
+                # the jobs of a forecast run after the inflow batch of the forecast,
+                # a job generates its inflow if the batch failed
+                forecast_inflow_tasks = {}
+                if regional_inflow_directory and pending_forecasts:
+                    for batch_index, regional_inflow_job in enumerate(regional_inflow_jobs):
+                        forecast_batch = regional_inflow_job[0]
+                        batch_resolution = forecast_metadata.get(os.path.basename(forecast_batch[0]),
+                                                                 {}).get('resolution')
+                        batch_high_res = batch_resolution not in ('LowRes', 'LowResFull')
+                        inflow_task = cycle_graph.addTask("inflow/{0}".format(batch_index),
+                                                          job={'function': run_regional_inflow_worker,
+                                                               'args': regional_inflow_job,
+                                                               'memory_mb': estimate_regional_inflow_memory_mb(
+                                                                   len(forecast_batch), batch_resolution,
+                                                                   [weight_table_extents[batch_high_res]
+                                                                    for weight_table_extents in
+                                                                    watershed_weight_table_extents.values()
+                                                                    if batch_high_res in weight_table_extents],
+                                                                   inflow_precision,
+                                                                   inflow_memory_limit_mb)})
+                        for forecast in regional_inflow_job[0]:
+                            forecast_inflow_tasks[forecast] = inflow_task
+
+                # one queue for the jobs of all of the watersheds, longest first,
+                # and each watershed is finished when its last job is done
+                rapid_watershed_tasks = dict((rapid_input_directory, [])
+                                             for rapid_input_directory in rapid_input_directories)
+                for cycle_job in cycle_jobs:
+                    rapid_task = cycle_graph.addTask("rapid/{0}".format(cycle_job['job_name']),
+                                                     job=cycle_job,
+                                                     depends=watershed_depends[cycle_job['rapid_input_directory']] +
+                                                     ([forecast_inflow_tasks[cycle_job['forecast']]]
+                                                      if cycle_job['forecast'] in forecast_inflow_tasks else []),
+                                                     priority=cycle_job['predicted_seconds'])
+                    rapid_watershed_tasks[cycle_job['rapid_input_directory']].append(rapid_task)
+                    if data_manager:
+                        # upload file when done
+                        cycle_graph.addTask("upload/{0}".format(cycle_job['job_name']), put_upload,
+                                            (cycle_job['job_info'],), depends=[rapid_task])
+
+                for rapid_input_directory in rapid_input_directories:
+                    watershed_job_info = rapid_watershed_jobs[rapid_input_directory]
+                    # upload the output of the jobs completed in a previous run
+                    if data_manager:
+                        for completed_job_info in watershed_job_info['completed_jobs_info']:
+                            cycle_graph.addTask("upload/{0}".format(os.path.basename(
+                                                    completed_job_info['outflow_file_name'])),
+                                                put_upload, (completed_job_info,))
+                    # the steps of the watershed are skipped if its outputs are the same
+                    # as when the steps were done before
+                    finish_output_files = []
+                    if create_warning_points and \
+                            os.path.exists(os.path.join(era_interim_data_location, rapid_input_directory)):
+                        finish_output_files += [os.path.join(rapid_io_files_location, 'output', rapid_input_directory,
+                                                             forecast_date_timestep,
+                                                             "return_{0}_points.geojson".format(return_period))
+                                                for return_period in (20, 10, 2)]
+                    if initialize_flows:
+                        finish_output_files.append(os.path.join(rapid_io_files_location, 'input', rapid_input_directory,
+                                                                "Qinit_{0}.csv".format(
+                                                                    get_datetime_from_date_timestep(
+                                                                        forecast_date_timestep).strftime("%Y%m%dt%H"))))
+                    cycle_graph.addTask("finish/{0}".format(rapid_input_directory), finish_watershed,
+                                        (rapid_input_directory,),
+                                        depends=watershed_depends[rapid_input_directory] +
+                                        rapid_watershed_tasks[rapid_input_directory],
+                                        input_files=[job_info['outflow_file_name'] for job_info in
+                                                     watershed_job_info['jobs_info'] +
+                                                     watershed_job_info['completed_jobs_info']],
+                                        output_files=finish_output_files,
+                                        memoize=True)
 
                 # run autoroute process if added
                 if autoroute_executable_location and autoroute_io_files_location:
                     # run autoroute on all of the watersheds
-                    run_autorapid_process(autoroute_executable_location,
-                                          autoroute_io_files_location,
-                                          rapid_io_files_location,
-                                          forecast_date_timestep,
-                                          subprocess_forecast_log_dir,
-                                          geoserver_url,
-                                          geoserver_username,
-                                          geoserver_password,
-                                          app_instance_id)
+                    cycle_graph.addTask("autoroute", run_autorapid_process,
+                                        (autoroute_executable_location,
+                                         autoroute_io_files_location,
+                                         rapid_io_files_location,
+                                         forecast_date_timestep,
+                                         subprocess_forecast_log_dir,
+                                         geoserver_url,
+                                         geoserver_username,
+                                         geoserver_password,
+                                         app_instance_id),
+                                        depends=[rapid_task for rapid_input_directory in rapid_input_directories
+                                                 for rapid_task in rapid_watershed_tasks[rapid_input_directory]])
+
+                if cycle_jobs and num_job_processes:
+                    cycle_eta = predict_cycle_eta([(cycle_job['watershed_key'], cycle_job['predicted_seconds'])
+                                                   for cycle_job in order_longest_job_first(
+                                                       cycle_jobs, lambda cycle_job: cycle_job['predicted_seconds'])],
+                                                  num_job_processes)
+                    print("INFO: Predicted runtime of the jobs for {0}:".format(forecast_date_timestep))
+                    print(format_cycle_eta(cycle_eta))
+                    if cycle_walltime_hours and cycle_eta['makespan_seconds'] > cycle_walltime_hours * 3600:
+                        print("WARNING: The jobs for {0} are predicted to take {1:.1f} hours, "
+                              "longer than the walltime of {2} hours ...".format(forecast_date_timestep,
+                                                                                cycle_eta['makespan_seconds'] / 3600.0,
+                                                                                cycle_walltime_hours))
+
+                if dry_run:
+                    print("INFO: Plan of the tasks for {0}:".format(forecast_date_timestep))
+                    print(cycle_graph.formatPlan())
+                    continue
+
+                for watershed_job_info in rapid_watershed_jobs.values():
+                    # add sub job list to master job list
+                    master_job_info_list = master_job_info_list + watershed_job_info['jobs_info'] + \
+                        watershed_job_info['completed_jobs_info']
+
+                # the steps on this machine run one at a time in the background
+                # while the jobs keep the workers busy
+                cycle_graph.run(job_executor, num_threads=1)
+
+                if regional_inflow_directory:
+                    rmtree(regional_inflow_directory, ignore_errors=True)
+
+                # time and resources of each stage of the jobs, slowest watershed first
+                job_stats_summary = write_job_stats_summary(subprocess_forecast_log_dir)
+                if job_stats_summary:
+                    print("INFO: Job stats for {0}:".format(forecast_date_timestep))
+                    print(job_stats_summary)
+
+                # learn the runtime of the jobs for the next forecast cycles
+                job_cost_model.learnForecastCycle(forecast_date_timestep,
+                                                  read_job_stats(subprocess_forecast_log_dir),
+                                                  cycle_job_costs)
+                job_cost_model.write()
 
                 last_forecast_date = get_datetime_from_date_timestep(forecast_date_timestep)
 
@@ -499,17 +851,39 @@ def run_ecmwf_forecast_process(rapid_executable_location,  # path to RAPID execu
             print_exc()
             print(ex)
             pass
+        finally:
+            if forecast_prefetcher is not None:
+                forecast_prefetcher.close()
+            # stop the jobs left by an error
+            if job_executor is not None:
+                job_executor.cancel()
+                job_executor.close()
+            if upload_queue is not None:
+                # the outputs are uploaded before they are deleted, the
+                # uploads not done are kept for the next run
+                upload_queue.close(wait=delete_output_when_done, timeout=upload_wait_minutes * 60)
+            if worker_pool is not None:
+                worker_pool.close()
 
         # Release & update lock info file with all completed forecasts
-        update_lock_info_file(LOCK_INFO_FILE, False, last_forecast_date.strftime('%Y%m%d%H'))
-
-        if delete_output_when_done:
-            # delete local datasets
+        if not dry_run:
+            update_lock_info_file(LOCK_INFO_FILE, False, last_forecast_date.strftime('%Y%m%d%H'))
+
+        if delete_output_when_done and not dry_run:
+            # delete local datasets, except the outputs still to upload
+            upload_directories = set()
+            if upload_queue is not None:
+                upload_directories = set(job_info['master_watershed_outflow_directory']
+                                         for job_info in upload_queue.getUploadsNotDone())
             for job_info in master_job_info_list:
+                if job_info['master_watershed_outflow_directory'] in upload_directories:
+                    continue
                 try:
                     rmtree(job_info['master_watershed_outflow_directory'])
                 except OSError:
                     pass
+            for upload_directory in sorted(upload_directories):
+                print("WARNING: Keeping {0} for the uploads not done ...".format(upload_directory))
             # delete watershed folder if empty
             for item in os.listdir(os.path.join(rapid_io_files_location, 'output')):
                 try:
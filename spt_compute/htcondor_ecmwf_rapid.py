@@ -13,10 +13,15 @@ import sys
 
 from spt_compute.imports.ecmwf_rapid_multiprocess_worker \
      import ecmwf_rapid_multiprocess_worker
+from spt_compute.imports.helper_functions \
+     import get_ensemble_number_from_forecast
+from spt_compute.imports.job_stats import get_job_stats_file, JobStats
+from spt_compute.imports.watershed_input_manifest \
+     import read_watershed_input_manifest
     
 def htcondor_process_ECMWF_RAPID(ecmwf_forecast, forecast_date_timestep, 
                                  watershed, subbasin, rapid_executable_location, 
-                                 init_flow):
+                                 init_flow, input_manifest_file=""):
     """
     HTCondor process to prepare all ECMWF forecast input and run RAPID
     """
@@ -28,13 +33,29 @@ def htcondor_process_ECMWF_RAPID(ecmwf_forecast, forecast_date_timestep,
     #rename rapid input directory
     os.rename(old_rapid_input_directory, rapid_input_directory)
 
+    # the input files were found before the job was submitted
+    input_manifest = None
+    if input_manifest_file:
+        input_manifest = read_watershed_input_manifest(os.path.join(node_path,
+                                                                    input_manifest_file))
+
     forecast_basename = os.path.basename(ecmwf_forecast)
+    # stats in the job directory are transferred back beside the job log
+    ensemble_number = get_ensemble_number_from_forecast(forecast_basename)
+    job_name = 'job_%s_%s_%s_%s' % (forecast_date_timestep, watershed, subbasin, ensemble_number)
+    job_stats = JobStats(get_job_stats_file(node_path, job_name),
+                         job_name=job_name, watershed=watershed, subbasin=subbasin,
+                         forecast_date_timestep=forecast_date_timestep,
+                         ensemble_number=ensemble_number)
     ecmwf_rapid_multiprocess_worker(node_path, rapid_input_directory,
                                     forecast_basename, forecast_date_timestep, 
                                     watershed, subbasin, rapid_executable_location, 
-                                    init_flow)
+                                    init_flow, input_manifest=input_manifest,
+                                    validate_input_manifest=False,
+                                    job_stats=job_stats)
 
 
 if __name__ == "__main__":   
     htcondor_process_ECMWF_RAPID(sys.argv[1],sys.argv[2], sys.argv[3], 
-                                 sys.argv[4], sys.argv[5], sys.argv[6])
+                                 sys.argv[4], sys.argv[5], sys.argv[6],
+                                 sys.argv[7] if len(sys.argv) > 7 else "")
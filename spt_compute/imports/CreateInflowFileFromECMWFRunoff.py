@@ -16,19 +16,75 @@
                 of netcdf4 as the format of RAPID inflow file
               Version 1.2, 02/03/2015, bug fixing - calculate inflow assuming that
                 ECMWF runoff data is cumulative instead of incremental through time
+              Version 1.3, 10/17/2026, sparse matrix inflow computation with a
+                cached compiled weight table, forecast metadata index, row and
+                time block reads, float32 mode and inflow file format options
 -------------------------------------------------------------------------------'''
+import hashlib
 import netCDF4 as NET
 import numpy as NUM
+import os
+from scipy.sparse import csr_matrix
+import time
 import csv
 from io import open
 
+from .helper_functions import drop_file_cache, get_peak_memory_mb
+
+# subdirectory next to the weight tables with the compiled weight tables
+WEIGHT_TABLE_CACHE_DIRECTORY = "weight_table_cache"
+
 class CreateInflowFileFromECMWFRunoff(object):
-    def __init__(self):
+    def __init__(self, inflow_method="sparse", weight_table_cache=True,
+                 forecast_metadata=None, read_strategy="auto", read_fill_ratio=0.25,
+                 inflow_precision="float64", memory_limit_mb=None,
+                 inflow_format="NETCDF3_CLASSIC", inflow_complevel=0,
+                 weight_tables=None):
         """Define the tool (tool name is the name of the class)."""
         self.label = "Create Inflow File From ECMWF Runoff"
         self.description = ("Creates RAPID NetCDF input of water inflow " +
                        "based on ECMWF runoff results and previously created weight table.")
         self.canRunInBackground = False
+        # "sparse" computes every stream with one sparse matrix product,
+        # "loop" computes the streams one at a time
+        if inflow_method not in ("sparse", "loop"):
+            raise Exception("Invalid inflow method: {0}".format(inflow_method))
+        self.inflow_method = inflow_method
+        # store the compiled weight table next to the weight table csv
+        self.weight_table_cache = weight_table_cache
+        self.weight_table_cache_version = 1
+        # compiled weight tables in memory with their weight table key indexed
+        # by the weight table path, shared with the caller to keep them
+        # between runs of the tool
+        self.weight_tables = weight_tables if weight_tables is not None else {}
+        # metadata of the forecast files indexed by file name
+        self.forecast_metadata = dict(forecast_metadata or {})
+        # "bbox" reads the bounding box of the cells, "rows" reads the cells
+        # one latitude row at a time, and "auto" reads by rows when the cells
+        # fill less than read_fill_ratio of the bounding box
+        if read_strategy not in ("auto", "bbox", "rows"):
+            raise Exception("Invalid read strategy: {0}".format(read_strategy))
+        self.read_strategy = read_strategy
+        self.read_fill_ratio = read_fill_ratio
+        # "float32" reads the runoff without masked arrays, with the missing
+        # values as NaN, and computes the inflow in float32, the precision
+        # of the inflow file
+        if inflow_precision not in ("float64", "float32"):
+            raise Exception("Invalid inflow precision: {0}".format(inflow_precision))
+        self.inflow_precision = inflow_precision
+        # process the runoff in blocks of time steps when
+        # all of the time steps do not fit in the memory limit
+        self.memory_limit_mb = memory_limit_mb
+        # netcdf format of the inflow file, NETCDF4 files are chunked by
+        # time step and compressed if inflow_complevel is above 0
+        self.inflow_formats = ["NETCDF3_CLASSIC", "NETCDF3_64BIT_OFFSET", "NETCDF4"]
+        # the formats with a different layout on disk, NETCDF3_64BIT_OFFSET
+        # only differs from NETCDF3_CLASSIC in the offsets of the header
+        self.benchmark_formats = ["NETCDF3_CLASSIC", "NETCDF4"]
+        if inflow_format not in self.inflow_formats:
+            raise Exception("Invalid inflow format: {0}".format(inflow_format))
+        self.inflow_format = inflow_format
+        self.inflow_complevel = inflow_complevel
         self.header_wt = ['StreamID', 'area_sqm', 'lon_index', 'lat_index', 'npoints']
         self.dims_oi = [['lon', 'lat', 'time'], ['longitude', 'latitude', 'time']]
         self.vars_oi = [["lon", "lat", "time", "RO"], ['longitude', 'latitude', 'time', 'ro']]
@@ -51,18 +107,20 @@ class CreateInflowFileFromECMWFRunoff(object):
         vars_oi_index = None
 
         data_nc = NET.Dataset(in_nc)
-        
-        dims = list(data_nc.dimensions)
-        if dims not in self.dims_oi:
-            raise Exception(self.errorMessages[1])
-
-        vars = list(data_nc.variables)
-        if vars == self.vars_oi[0]:
-            vars_oi_index = 0
-        elif vars == self.vars_oi[1]:
-            vars_oi_index = 1
-        else:    
-            raise Exception(self.errorMessages[2])
+        try:
+            dims = list(data_nc.dimensions)
+            if dims not in self.dims_oi:
+                raise Exception(self.errorMessages[1])
+
+            vars = list(data_nc.variables)
+            if vars == self.vars_oi[0]:
+                vars_oi_index = 0
+            elif vars == self.vars_oi[1]:
+                vars_oi_index = 1
+            else:
+                raise Exception(self.errorMessages[2])
+        finally:
+            data_nc.close()
 
         return vars_oi_index
 
@@ -71,8 +129,12 @@ class CreateInflowFileFromECMWFRunoff(object):
         """Check if the data is Ensemble 1-51 (low resolution) or 52 (high resolution)"""
         data_nc = NET.Dataset(in_nc)
         time = data_nc.variables['time'][:]
-        diff = NUM.unique(NUM.diff(time))
         data_nc.close()
+        return self.timeIdentify(time)
+
+    def timeIdentify(self, time):
+        """Identify the resolution of the data from the time variable"""
+        diff = NUM.unique(NUM.diff(time))
         time_interval_highres = NUM.array([1.0,3.0,6.0],dtype=float)
         time_interval_lowres_full = NUM.array([3.0, 6.0],dtype=float)
         time_interval_lowres = NUM.array([6.0],dtype=float)
@@ -91,34 +153,163 @@ class CreateInflowFileFromECMWFRunoff(object):
             return 'ecmwf_t1279'
         return 'ecmwf_tco639'
 
+    def readForecastMetadata(self, in_nc):
+        """Validate and identify the forecast file with one open of the file"""
+        data_nc = NET.Dataset(in_nc)
+        try:
+            if list(data_nc.dimensions) not in self.dims_oi:
+                raise Exception(self.errorMessages[1])
+            vars = list(data_nc.variables)
+            if vars not in self.vars_oi:
+                raise Exception(self.errorMessages[2])
+            time = data_nc.variables['time'][:]
+        finally:
+            data_nc.close()
+
+        id_data = self.timeIdentify(time)
+        return {
+            'file_size': os.path.getsize(in_nc),
+            'vars_oi_index': self.vars_oi.index(vars),
+            'resolution': id_data,
+            'time_length': len(time),
+            'grid_name': self.getGridName(in_nc, high_res=(id_data == "HighRes")),
+        }
+
+    def getForecastMetadata(self, in_nc):
+        """Get the metadata of the forecast file
+
+        The metadata in the index is used if the file size matches,
+        otherwise the forecast file is read.
+        """
+        forecast_name = os.path.basename(in_nc)
+        forecast_metadata = self.forecast_metadata.get(forecast_name)
+        if forecast_metadata is None or \
+                forecast_metadata['file_size'] != os.path.getsize(in_nc):
+            forecast_metadata = self.readForecastMetadata(in_nc)
+            self.forecast_metadata[forecast_name] = forecast_metadata
+        return forecast_metadata
+
+
+    def getWeightTableCacheFile(self, in_weight_table):
+        """Return the path to the compiled weight table
+
+        The compiled weight tables are kept in a subdirectory so writing
+        them does not change the modification time of the watershed input
+        directory, which the input manifest and worker state are checked with.
+        """
+        weight_table_directory, weight_table_name = os.path.split(in_weight_table)
+        return os.path.join(weight_table_directory, WEIGHT_TABLE_CACHE_DIRECTORY,
+                            "{0}.npz".format(os.path.splitext(weight_table_name)[0]))
+
+    def getWeightTableKey(self, in_weight_table, file_hash=False):
+        """Get the values identifying the contents of the weight table"""
+        weight_table_key = {
+            'csv_path': os.path.abspath(in_weight_table),
+            'csv_size': os.path.getsize(in_weight_table),
+            'csv_mtime': os.path.getmtime(in_weight_table),
+        }
+        if file_hash:
+            sha1 = hashlib.sha1()
+            with open(in_weight_table, "rb") as csvfile:
+                for block in iter(lambda: csvfile.read(1024*1024), b""):
+                    sha1.update(block)
+            weight_table_key['csv_sha1'] = sha1.hexdigest()
+        return weight_table_key
+
+    def loadWeightTableCache(self, in_weight_table):
+        """Load the compiled weight table if it matches the weight table csv
+
+        The size and modification time are checked first. If the
+        modification time changed (e.g. the file was copied), the hash of
+        the csv is compared and the cache is updated with the new time so
+        the next jobs do not hash the csv again.
+        Returns None if the cache is missing or out of date.
+        """
+        cache_file = self.getWeightTableCacheFile(in_weight_table)
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with NUM.load(cache_file) as cache_npz:
+                cache_data = dict((key, cache_npz[key]) for key in cache_npz.files)
+        except Exception as ex:
+            print("WARNING: Unable to read {0}: {1}".format(cache_file, ex))
+            return None
 
-    def execute(self, in_nc, in_weight_table, out_nc, grid_name, in_time_interval="6hr"):
-        """The source code of the tool."""
-
-        # Validate the netcdf dataset
-        vars_oi_index = self.dataValidation(in_nc)
-        
-        #get conversion factor
-        conversion_factor = 1.0
-        if grid_name == 'ecmwf_t1279' or grid_name == 'ecmwf_tco639':
-            #new grids in mm instead of m
-            conversion_factor = 0.001
-
-        # identify if the input netcdf data is the High Resolution data with three different time intervals
-        id_data = self.dataIdentify(in_nc)
-        if id_data is None:
-            raise Exception(self.errorMessages[3])
-
-        ''' Read the netcdf dataset'''
-        data_in_nc = NET.Dataset(in_nc)
-        time = data_in_nc.variables['time'][:]
-
-        # Check the size of time variable in the netcdf data
-        if len(time) != self.length_time[id_data]:
-            raise Exception(self.errorMessages[3])
-
-
-        ''' Read the weight table '''
+        if int(cache_data.pop('cache_version')) != self.weight_table_cache_version:
+            return None
+        cache_key = dict((key, cache_data.pop(key).item())
+                         for key in ('csv_path', 'csv_size', 'csv_mtime', 'csv_sha1'))
+        weight_table_key = self.getWeightTableKey(in_weight_table)
+        if weight_table_key['csv_size'] != cache_key['csv_size']:
+            return None
+        if weight_table_key['csv_mtime'] != cache_key['csv_mtime']:
+            weight_table_key = self.getWeightTableKey(in_weight_table, file_hash=True)
+            if weight_table_key['csv_sha1'] != cache_key['csv_sha1']:
+                return None
+            self.writeWeightTableCache(in_weight_table, cache_data, weight_table_key)
+        return cache_data
+
+    def writeWeightTableCache(self, in_weight_table, weight_table, weight_table_key=None):
+        """Write the compiled weight table in the cache directory of the weight table csv"""
+        cache_file = self.getWeightTableCacheFile(in_weight_table)
+        try:
+            os.makedirs(os.path.dirname(cache_file))
+        except OSError:
+            pass
+        if weight_table_key is None:
+            weight_table_key = self.getWeightTableKey(in_weight_table, file_hash=True)
+        # write to a temporary file first so that jobs reading the
+        # cache at the same time never see a partial file
+        temp_cache_file = "{0}.{1}.tmp".format(cache_file, os.getpid())
+        try:
+            with open(temp_cache_file, "wb") as cache_fp:
+                NUM.savez(cache_fp,
+                          cache_version=self.weight_table_cache_version,
+                          **dict(weight_table, **weight_table_key))
+            os.rename(temp_cache_file, cache_file)
+        except (IOError, OSError) as ex:
+            print("WARNING: Unable to write {0}: {1}".format(cache_file, ex))
+            try:
+                os.remove(temp_cache_file)
+            except OSError:
+                pass
+        return cache_file
+
+    def readWeightTable(self, in_weight_table):
+        """Read the compiled weight table
+
+        Uses the cached binary weight table if it is up to date and
+        rebuilds it from the weight table csv otherwise.
+        """
+        weight_table_key = self.getWeightTableKey(in_weight_table)
+        if in_weight_table in self.weight_tables:
+            memory_key, weight_table = self.weight_tables[in_weight_table]
+            if memory_key == weight_table_key:
+                return weight_table
+
+        weight_table = None
+        if self.weight_table_cache:
+            weight_table = self.loadWeightTableCache(in_weight_table)
+            if weight_table is not None:
+                print("Reading the compiled weight table...")
+
+        if weight_table is None:
+            weight_table = self.compileWeightTable(in_weight_table)
+            if self.weight_table_cache:
+                self.writeWeightTableCache(in_weight_table, weight_table)
+        self.weight_tables[in_weight_table] = (weight_table_key, weight_table)
+        return weight_table
+
+    def compileWeightTable(self, in_weight_table):
+        """Read the weight table csv and compile it for the inflow computation
+
+        Returns a dictionary of arrays:
+            stream_id -- unique stream IDs in the order of the weight table
+            row_stream_index -- index of the stream for each row
+            row_cell_index -- index of the grid cell for each row
+            area_sqm -- area of each row
+            cell_lon_index, cell_lat_index -- grid indices of each unique cell
+        """
         print("Reading the weight table...")
         dict_list = {self.header_wt[0]:[], self.header_wt[1]:[], self.header_wt[2]:[],
                      self.header_wt[3]:[], self.header_wt[4]:[]}
@@ -140,153 +331,635 @@ class CreateInflowFileFromECMWFRunoff(object):
                        dict_list[self.header_wt[i]].append(row[i])
                     count += 1
 
-        '''Calculate water inflows'''
-        print("Calculating water inflows...")
+        stream_id_rows = dict_list[self.header_wt[0]]
+        npoints_rows = dict_list[self.header_wt[4]]
+        size_streamID = len(set(stream_id_rows))
 
-        # Obtain size information
+        # each stream has npoints consecutive rows in the weight table
+        stream_id = []
+        row_stream_index = []
+        pointer = 0
+        for s in range(0, size_streamID):
+            npoints = int(npoints_rows[pointer])
+            # Check if all npoints points correspond to the same streamID
+            if len(set(stream_id_rows[pointer : (pointer + npoints)])) != 1:
+                print("ROW INDEX {0}".format(pointer))
+                print("RIVID {0}".format(stream_id_rows[pointer]))
+                raise Exception(self.errorMessages[6])
+            stream_id.append(int(float(stream_id_rows[pointer])))
+            row_stream_index += [s] * npoints
+            pointer += npoints
+
+        lon_ind_all = NUM.array([int(i) for i in dict_list[self.header_wt[2]][:pointer]],
+                                dtype=NUM.int64)
+        lat_ind_all = NUM.array([int(j) for j in dict_list[self.header_wt[3]][:pointer]],
+                                dtype=NUM.int64)
+        area_sqm = NUM.array([float(k) for k in dict_list[self.header_wt[1]][:pointer]],
+                             dtype=NUM.float64)
+
+        # rows sharing a grid cell read the runoff from the cell only once
+        cell_key = lat_ind_all * (lon_ind_all.max() + 1) + lon_ind_all
+        unique_cell_key, cell_first_row, row_cell_index = \
+            NUM.unique(cell_key, return_index=True, return_inverse=True)
+
+        return {
+            'stream_id': NUM.array(stream_id, dtype=NUM.int64),
+            'row_stream_index': NUM.array(row_stream_index, dtype=NUM.int64),
+            'row_cell_index': row_cell_index.ravel().astype(NUM.int64),
+            'area_sqm': area_sqm,
+            'cell_lon_index': lon_ind_all[cell_first_row],
+            'cell_lat_index': lat_ind_all[cell_first_row],
+        }
+
+    def getTimeIndices(self, id_data, in_time_interval="6hr"):
+        """Get the time indices to difference the cumulative runoff with
+
+        Returns the end and start indices of each output time step
+        """
+        time_index = NUM.arange(self.length_time[id_data])
+
+        ''''IMPORTANT NOTE: runoff variable in ECMWF dataset is cumulative instead of incremental through time'''
+        # For data with Low Resolution, there's only one time interval 6 hrs
         if id_data == "LowRes":
-            size_time = self.length_time_opt["LowRes-6hr"]
+            end_index = [time_index[1:,]]
+            start_index = [time_index[:-1,]]
+
+        #For data with the full version of Low Resolution, from Hour 0 to 144 (the first 49 time points) are of 3 hr time interval,
+        # then from Hour 144 to 360 (36 time points) are of 6 hour time interval
         elif id_data == "LowResFull":
             if in_time_interval == "3hr_subset":
-                size_time = self.length_time_opt["LowResFull-3hr-Sub"]
+                #use only the 3hr time interval
+                end_index = [time_index[1:49,]]
+                start_index = [time_index[:48,]]
             elif in_time_interval == "6hr_subset":
-                size_time = self.length_time_opt["LowResFull-6hr-Sub"]
-            else:
-                size_time = self.length_time_opt["LowRes-6hr"]
-        else: #HighRes
+                #use only the 6hr time interval
+                end_index = [time_index[49:,]]
+                start_index = [time_index[48:-1,]]
+            else: #"LowRes-6hr"
+                #convert all to 6hr
+                # calculate time series of 6 hr data from 3 hr data
+                # then get the time series of 6 hr data
+                end_index = [time_index[2:49:2,], time_index[49:,]]
+                start_index = [time_index[:48:2,], time_index[48:-1,]]
+        #For data with High Resolution, from Hour 0 to 90 (the first 91 time points) are of 1 hr time interval,
+        # then from Hour 90 to 144 (18 time points) are of 3 hour time interval, and from Hour 144 to 240 (16 time points)
+        # are of 6 hour time interval
+        else:
             if in_time_interval == "1hr":
-                size_time = self.length_time_opt["HighRes-1hr"]
+                end_index = [time_index[1:91,]]
+                start_index = [time_index[:90,]]
             elif in_time_interval == "3hr":
-                size_time = self.length_time_opt["HighRes-3hr"]
+                # calculate time series of 3 hr data from 1 hr data
+                # then get the time series of 3 hr data
+                end_index = [time_index[3:91:3,], time_index[91:109,]]
+                start_index = [time_index[:88:3,], time_index[90:108,]]
             elif in_time_interval == "3hr_subset":
-                size_time = self.length_time_opt["HighRes-3hr-Sub"]
+                #use only the 3hr time interval
+                end_index = [time_index[91:109,]]
+                start_index = [time_index[90:108,]]
             elif in_time_interval == "6hr_subset":
-                size_time = self.length_time_opt["HighRes-6hr-Sub"]
-            else:
-                size_time = self.length_time_opt["HighRes-6hr"]
+                #use only the 6hr time interval
+                end_index = [time_index[109:,]]
+                start_index = [time_index[108:-1,]]
+            else: # in_time_interval == "6hr"
+                # calculate time series of 6 hr data from 1 hr data,
+                # then from 3 hr data, then get the time series of 6 hr data
+                end_index = [time_index[6:91:6,], time_index[92:109:2,], time_index[109:,]]
+                start_index = [time_index[:85:6,], time_index[90:107:2,], time_index[108:-1,]]
+
+        return NUM.concatenate(end_index), NUM.concatenate(start_index)
+
+    def computeInflowSparse(self, data_cells, weight_table, end_index, start_index):
+        """Compute the inflow of every stream with one sparse matrix product
+
+        data_cells is the cumulative runoff of each unique cell in the weight
+        table with shape (time, cell) or (ensemble, time, cell) to compute
+        several ensemble members at once.
+        """
+        #missing values do not contribute to the inflow, they are
+        #masked or NaN in float32
+        if self.inflow_precision == "float32":
+            data_mask = NUM.isnan(data_cells)
+        else:
+            data_mask = NUM.ma.getmaskarray(data_cells)
+            data_cells = NUM.ma.getdata(data_cells)
+
+        #remove noise from data
+        data_cells[data_cells<=0.00001] = 0
+        ro_cells = NUM.subtract(data_cells[..., end_index, :], data_cells[..., start_index, :])
+        if data_mask.any():
+            ro_cells[data_mask[..., end_index, :] | data_mask[..., start_index, :]] = 0
+        #remove negative values (the areas are never negative)
+        ro_cells[ro_cells<0] = 0
+
+        # sparse (cell x stream) area matrix, cells shared by rows of the
+        # same stream have their areas summed
+        area_sqm = weight_table['area_sqm']
+        if self.inflow_precision == "float32":
+            area_sqm = area_sqm.astype(NUM.float32)
+        area_matrix = csr_matrix((area_sqm,
+                                  (weight_table['row_cell_index'],
+                                   weight_table['row_stream_index'])),
+                                 shape=(data_cells.shape[-1],
+                                        weight_table['stream_id'].size))
+        # all ensemble members and time steps in one product
+        ro_rows = ro_cells.reshape(-1, ro_cells.shape[-1])
+        return NUM.asarray(area_matrix.T.dot(ro_rows.T).T)\
+            .reshape(ro_cells.shape[:-1] + (weight_table['stream_id'].size,))
+
+    def computeInflowLoop(self, data_cells, weight_table, end_index, start_index):
+        """Compute the inflow one stream at a time"""
+        # obtain a new subset of data with one column per row
+        data_subset_new = data_cells[:, weight_table['row_cell_index']]
+        size_streamID = weight_table['stream_id'].size
+        data_temp = NUM.empty(shape = [end_index.size, size_streamID],
+                              dtype=NUM.dtype(self.inflow_precision))
+
+        stream_row_start = NUM.searchsorted(weight_table['row_stream_index'],
+                                            NUM.arange(size_streamID + 1))
+        for s in range(0, size_streamID):
+            pointer = stream_row_start[s]
+            npoints = stream_row_start[s+1] - pointer
 
-        size_streamID = len(set(dict_list[self.header_wt[0]]))
+            area_sqm_npoints = weight_table['area_sqm'][pointer : (pointer + npoints)]
+            area_sqm_npoints = area_sqm_npoints.reshape(1, npoints)
+            data_goal = data_subset_new[:, pointer:(pointer + npoints)]
 
-        # Create output inflow netcdf data
-        # data_out_nc = NET.Dataset(out_nc, "w") # by default format = "NETCDF4"
-        data_out_nc = NET.Dataset(out_nc, "w", format = "NETCDF3_CLASSIC")
-        dim_Time = data_out_nc.createDimension('Time', size_time)
-        dim_RiverID = data_out_nc.createDimension('rivid', size_streamID)
-        var_m3_riv = data_out_nc.createVariable('m3_riv', 'f4', 
-                                                ('Time', 'rivid'),
-                                                fill_value=0)
-                                                
-        data_temp = NUM.empty(shape = [size_time, size_streamID])
+            #remove noise from data
+            data_goal[data_goal<=0.00001] = 0
 
-        lon_ind_all = [int(i) for i in dict_list[self.header_wt[2]]]
-        lat_ind_all = [int(j) for j in dict_list[self.header_wt[3]]]
+            ro_stream = NUM.subtract(data_goal[end_index], data_goal[start_index]) * area_sqm_npoints
 
+            #remove negative values
+            ro_stream[ro_stream<0] = 0
+            if self.inflow_precision == "float32":
+                #missing values are NaN in float32
+                ro_stream[NUM.isnan(ro_stream)] = 0
+            data_temp[:,s] = ro_stream.sum(axis = 1)
+
+        return data_temp
+
+    def computeInflow(self, data_cells, weight_table, end_index, start_index):
+        """Compute the inflow with the inflow method of the tool"""
+        if self.inflow_method == "loop" and data_cells.ndim == 3:
+            return NUM.array([self.computeInflowLoop(ensemble_data_cells, weight_table,
+                                                     end_index, start_index)
+                              for ensemble_data_cells in data_cells])
+        if self.inflow_method == "loop":
+            return self.computeInflowLoop(data_cells, weight_table,
+                                          end_index, start_index)
+        return self.computeInflowSparse(data_cells, weight_table,
+                                        end_index, start_index)
+
+    def readRunoff(self, in_nc, lat_ind_all, lon_ind_all, grid_name,
+                   time_slice=slice(None)):
+        """Read the runoff of the grid cells at the latitude/longitude indices
+
+        Returns the resolution of the data and the cumulative runoff
+        with shape (time, cell) for the time steps in time_slice
+        """
+        # Validate the netcdf dataset
+        forecast_metadata = self.getForecastMetadata(in_nc)
+        
+        #get conversion factor
+        conversion_factor = 1.0
+        if grid_name == 'ecmwf_t1279' or grid_name == 'ecmwf_tco639':
+            #new grids in mm instead of m
+            conversion_factor = 0.001
+
+        # identify if the input netcdf data is the High Resolution data with three different time intervals
+        id_data = forecast_metadata['resolution']
+        if id_data is None:
+            raise Exception(self.errorMessages[3])
+
+        # Check the size of time variable in the netcdf data
+        if forecast_metadata['time_length'] != self.length_time[id_data]:
+            raise Exception(self.errorMessages[3])
+
+        read_strategy, fill_ratio = self.getReadStrategy(lat_ind_all, lon_ind_all)
+
+        ''' Read the netcdf dataset'''
+        data_in_nc = NET.Dataset(in_nc)
+        runoff_var = data_in_nc.variables[self.vars_oi[forecast_metadata['vars_oi_index']][3]]
+        if self.inflow_precision == "float32":
+            runoff_var.set_auto_mask(False)
+        print("Reading runoff of {0} cells with {1} read ({2:.1%} of bounding box) ..."
+              .format(lat_ind_all.size, read_strategy, fill_ratio))
+        if read_strategy == "rows":
+            data_cells = self.readRunoffRows(runoff_var, lat_ind_all, lon_ind_all,
+                                             time_slice)
+        else:
+            data_cells = self.readRunoffBoundingBox(runoff_var, lat_ind_all, lon_ind_all,
+                                                    time_slice)
+
+        if self.inflow_precision == "float32":
+            # convert in place, the missing values are NaN
+            data_cells = NUM.asarray(data_cells, dtype=NUM.float32)
+            missing_cells = self.getMissingRunoff(runoff_var, data_cells)
+            data_cells *= NUM.float32(conversion_factor)
+            data_cells[missing_cells] = NUM.nan
+        else:
+            data_cells = data_cells*conversion_factor
+        data_in_nc.close()
+
+        peak_memory = get_peak_memory_mb()
+        if peak_memory is not None:
+            print("Peak memory after reading runoff: {0:.1f} MB".format(peak_memory))
+
+        # obtain a new subset of data with one column per cell
+        return id_data, data_cells
+
+    def getMissingRunoff(self, runoff_var, data_cells):
+        """Find the missing values in runoff read without auto masking"""
+        missing_cells = ~NUM.isfinite(data_cells)
+        missing_values = []
+        for missing_attr in ('_FillValue', 'missing_value'):
+            if missing_attr in runoff_var.ncattrs():
+                missing_values.extend(NUM.ravel(runoff_var.getncattr(missing_attr)))
+        if not missing_values:
+            missing_values.append(NET.default_fillvals[runoff_var.dtype.str[1:]])
+        # the missing values are scaled with the data
+        scale_factor = getattr(runoff_var, 'scale_factor', 1.0)
+        add_offset = getattr(runoff_var, 'add_offset', 0.0)
+        for missing_value in missing_values:
+            missing_cells |= data_cells == NUM.float32(missing_value*scale_factor + add_offset)
+        return missing_cells
+
+    def getReadStrategy(self, lat_ind_all, lon_ind_all):
+        """Choose how to read the cells from the fraction of the bounding box they fill
+
+        Returns the read strategy and the fill ratio
+        """
+        bbox_size = (lat_ind_all.max() - lat_ind_all.min() + 1) * \
+                    (lon_ind_all.max() - lon_ind_all.min() + 1)
+        fill_ratio = NUM.unique(lat_ind_all.astype(NUM.int64)*(lon_ind_all.max() + 1)
+                                + lon_ind_all).size / float(bbox_size)
+        read_strategy = self.read_strategy
+        if read_strategy == "auto":
+            read_strategy = "rows" if fill_ratio < self.read_fill_ratio else "bbox"
+        return read_strategy, fill_ratio
+
+    def readRunoffBoundingBox(self, runoff_var, lat_ind_all, lon_ind_all,
+                              time_slice=slice(None)):
+        """Read the bounding box of the cells and extract the cells"""
         # Obtain a subset of  runoff data based on the indices in the weight table
-        min_lon_ind_all = min(lon_ind_all)
-        max_lon_ind_all = max(lon_ind_all)
-        min_lat_ind_all = min(lat_ind_all)
-        max_lat_ind_all = max(lat_ind_all)
+        min_lon_ind_all = lon_ind_all.min()
+        max_lon_ind_all = lon_ind_all.max()
+        min_lat_ind_all = lat_ind_all.min()
+        max_lat_ind_all = lat_ind_all.max()
 
 
-        data_subset_all = data_in_nc.variables[self.vars_oi[vars_oi_index][3]][:, min_lat_ind_all:max_lat_ind_all+1, min_lon_ind_all:max_lon_ind_all+1]
+        data_subset_all = runoff_var[time_slice, min_lat_ind_all:max_lat_ind_all+1, min_lon_ind_all:max_lon_ind_all+1]
         len_time_subset_all = data_subset_all.shape[0]
         len_lat_subset_all = data_subset_all.shape[1]
         len_lon_subset_all = data_subset_all.shape[2]
         data_subset_all = data_subset_all.reshape(len_time_subset_all, (len_lat_subset_all * len_lon_subset_all))
 
-
         # compute new indices based on the data_subset_all
-        index_new = []
-        for r in range(0,count-1):
-            ind_lat_orig = lat_ind_all[r]
-            ind_lon_orig = lon_ind_all[r]
-            index_new.append((ind_lat_orig - min_lat_ind_all)*len_lon_subset_all + (ind_lon_orig - min_lon_ind_all))
-
-        # obtain a new subset of data
-        data_subset_new = data_subset_all[:,index_new]*conversion_factor
+        index_new = (lat_ind_all - min_lat_ind_all)*len_lon_subset_all + (lon_ind_all - min_lon_ind_all)
+        return data_subset_all[:,index_new]
+
+    def readRunoffRows(self, runoff_var, lat_ind_all, lon_ind_all,
+                       time_slice=slice(None)):
+        """Read the cells one latitude row at a time
+
+        Only the longitude range of the cells in each row is read
+        """
+        data_cells = None
+        for lat_ind in NUM.unique(lat_ind_all):
+            row_cells = NUM.where(lat_ind_all == lat_ind)[0]
+            row_lon_ind = lon_ind_all[row_cells]
+            min_lon_ind = row_lon_ind.min()
+            data_row = runoff_var[time_slice, lat_ind, min_lon_ind:row_lon_ind.max()+1]
+            if data_cells is None:
+                # the data type of scaled data differs from the variable
+                zeros = NUM.ma.zeros if NUM.ma.isMaskedArray(data_row) else NUM.zeros
+                data_cells = zeros((data_row.shape[0], lat_ind_all.size),
+                                   dtype=data_row.dtype)
+            data_cells[:, row_cells] = data_row[:, row_lon_ind - min_lon_ind]
+        return data_cells
+
+    def createInflowFile(self, out_nc, size_time, size_streamID):
+        """Create a RAPID inflow file to write the inflow to
+
+        The inflow is written to a temporary file so a partial
+        inflow file is never used. closeInflowFile moves it to out_nc.
+        """
+        temp_out_nc = "{0}.tmp".format(out_nc)
+        # data_out_nc = NET.Dataset(out_nc, "w") # by default format = "NETCDF4"
+        data_out_nc = NET.Dataset(temp_out_nc, "w", format = self.inflow_format)
+        dim_Time = data_out_nc.createDimension('Time', size_time)
+        dim_RiverID = data_out_nc.createDimension('rivid', size_streamID)
+        var_options = {}
+        if self.inflow_format == "NETCDF4":
+            # RAPID reads the inflow one time step at a time
+            var_options['chunksizes'] = (1, max(size_streamID, 1))
+            if self.inflow_complevel > 0:
+                var_options['zlib'] = True
+                var_options['complevel'] = self.inflow_complevel
+        var_m3_riv = data_out_nc.createVariable('m3_riv', 'f4', 
+                                                ('Time', 'rivid'),
+                                                fill_value=0,
+                                                **var_options)
+        return data_out_nc
 
-        # start compute inflow
-        pointer = 0
-        for s in range(0, size_streamID):
-            npoints = int(dict_list[self.header_wt[4]][pointer])
-            # Check if all npoints points correspond to the same streamID
-            if len(set(dict_list[self.header_wt[0]][pointer : (pointer + npoints)])) != 1:
-                print("ROW INDEX {0}".format(pointer))
-                print("RIVID {0}".format(dict_list[self.header_wt[0]][pointer]))
-                raise Exception(self.errorMessages[2])
+    def closeInflowFile(self, data_out_nc, out_nc):
+        """Close the RAPID inflow file and move it to out_nc"""
+        data_out_nc.close()
+        os.rename("{0}.tmp".format(out_nc), out_nc)
 
-            area_sqm_npoints = [float(k) for k in dict_list[self.header_wt[1]][pointer : (pointer + npoints)]]
-            area_sqm_npoints = NUM.array(area_sqm_npoints)
-            area_sqm_npoints = area_sqm_npoints.reshape(1, npoints)
-            data_goal = data_subset_new[:, pointer:(pointer + npoints)]
-            
-            
-            #remove noise from data
-            data_goal[data_goal<=0.00001] = 0
+    def writeInflowFile(self, out_nc, data_temp):
+        """Write the inflow to a RAPID inflow file"""
+        print("Writing inflow data...")
+        data_out_nc = self.createInflowFile(out_nc, data_temp.shape[0], data_temp.shape[1])
+        data_out_nc.variables['m3_riv'][:] = data_temp
+        self.closeInflowFile(data_out_nc, out_nc)
+
+    def benchmarkInflowFormats(self, benchmark_directory, size_time=125,
+                               size_streamID=10000, repeats=3):
+        """Time writing and reading an inflow file in each layout
+
+        The inflow file is written to disk and dropped from the page
+        cache before it is read one time step at a time like RAPID,
+        so the read is timed on the file system of benchmark_directory.
+        Returns the fastest format and the seconds of each format
+        """
+        inflow_data = NUM.random.RandomState(0).uniform(0, 100, size=(size_time, size_streamID))
+        benchmark_nc = os.path.join(benchmark_directory, "m3_riv_benchmark.nc")
+        format_seconds = {}
+        for inflow_format in self.benchmark_formats:
+            inflow_tool = CreateInflowFileFromECMWFRunoff(inflow_format=inflow_format,
+                                                          inflow_complevel=self.inflow_complevel)
+            for _ in range(repeats):
+                time_start = time.time()
+                data_out_nc = inflow_tool.createInflowFile(benchmark_nc, size_time, size_streamID)
+                data_out_nc.variables['m3_riv'][:] = inflow_data
+                inflow_tool.closeInflowFile(data_out_nc, benchmark_nc)
+                drop_file_cache(benchmark_nc)
+                data_in_nc = NET.Dataset(benchmark_nc)
+                for time_index in range(size_time):
+                    data_in_nc.variables['m3_riv'][time_index]
+                data_in_nc.close()
+                os.remove(benchmark_nc)
+                seconds = time.time() - time_start
+                format_seconds[inflow_format] = min(seconds, format_seconds.get(inflow_format, seconds))
+        return min(format_seconds, key=format_seconds.get), format_seconds
+
+    def getInflowFileNames(self, inflow_directory, id_data, ensemble_number):
+        """Get the time intervals and inflow files RAPID is run with for the data
+
+        High resolution data is run at 1hr, 3hr and 6hr, the full
+        low resolution data at 3hr and 6hr and the low resolution data at 6hr.
+        """
+        if id_data == "HighRes":
+            time_interval_list = ["1hr", "3hr_subset", "6hr_subset"]
+        elif id_data == "LowResFull":
+            time_interval_list = ["3hr_subset", "6hr_subset"]
+        else:
+            return ["6hr"], [os.path.join(inflow_directory,
+                                          'm3_riv_bas_%s.nc' % ensemble_number)]
 
-            ''''IMPORTANT NOTE: runoff variable in ECMWF dataset is cumulative instead of incremental through time'''
-            # For data with Low Resolution, there's only one time interval 6 hrs
-            if id_data == "LowRes":
-                #ro_stream = data_goal * area_sqm_npoints
-                ro_stream = NUM.subtract(data_goal[1:,],data_goal[:-1,]) * area_sqm_npoints
-
-            #For data with the full version of Low Resolution, from Hour 0 to 144 (the first 49 time points) are of 3 hr time interval,
-            # then from Hour 144 to 360 (36 time points) are of 6 hour time interval
-            elif id_data == "LowResFull":
-                if in_time_interval == "3hr_subset":
-                    #use only the 3hr time interval
-                    ro_stream = NUM.subtract(data_goal[1:49,], data_goal[:48,]) * area_sqm_npoints
-                elif in_time_interval == "6hr_subset":
-                    #use only the 6hr time interval
-                    ro_stream = NUM.subtract(data_goal[49:,], data_goal[48:-1,]) * area_sqm_npoints
-                else: #"LowRes-6hr"
-                    #convert all to 6hr
-                    # calculate time series of 6 hr data from 3 hr data
-                    ro_6hr_a = NUM.subtract(data_goal[2:49:2,], data_goal[:48:2,])
-                    # get the time series of 6 hr data
-                    ro_6hr_b = NUM.subtract(data_goal[49:,], data_goal[48:-1,])
-                    # concatenate all time series
-                    ro_stream = NUM.concatenate([ro_6hr_a, ro_6hr_b]) * area_sqm_npoints
-            #For data with High Resolution, from Hour 0 to 90 (the first 91 time points) are of 1 hr time interval,
-            # then from Hour 90 to 144 (18 time points) are of 3 hour time interval, and from Hour 144 to 240 (16 time points)
-            # are of 6 hour time interval
-            else:
-                if in_time_interval == "1hr":
-                    ro_stream = NUM.subtract(data_goal[1:91,],data_goal[:90,]) * area_sqm_npoints
-                elif in_time_interval == "3hr":
-                    # calculate time series of 3 hr data from 1 hr data
-                    ro_3hr_a = NUM.subtract(data_goal[3:91:3,],data_goal[:88:3,])
-                    # get the time series of 3 hr data
-                    ro_3hr_b = NUM.subtract(data_goal[91:109,], data_goal[90:108,])
-                    # concatenate all time series
-                    ro_stream = NUM.concatenate([ro_3hr_a, ro_3hr_b]) * area_sqm_npoints
-                elif in_time_interval == "3hr_subset":
-                    #use only the 3hr time interval
-                    ro_stream = NUM.subtract(data_goal[91:109,], data_goal[90:108,]) * area_sqm_npoints
-                elif in_time_interval == "6hr_subset":
-                    #use only the 6hr time interval
-                    ro_stream = NUM.subtract(data_goal[109:,], data_goal[108:-1,]) * area_sqm_npoints
-                else: # in_time_interval == "6hr"
-                    #arcpy.AddMessage("6hr")
-                    # calculate time series of 6 hr data from 1 hr data
-                    ro_6hr_a = NUM.subtract(data_goal[6:91:6,], data_goal[:85:6,])
-                    # calculate time series of 6 hr data from 3 hr data
-                    ro_6hr_b = NUM.subtract(data_goal[92:109:2,], data_goal[90:107:2,])
-                    # get the time series of 6 hr data
-                    ro_6hr_c = NUM.subtract(data_goal[109:,], data_goal[108:-1,])
-                    # concatenate all time series
-                    ro_stream = NUM.concatenate([ro_6hr_a, ro_6hr_b, ro_6hr_c]) * area_sqm_npoints
-                    
-            #remove negative values
-            ro_stream[ro_stream<0] = 0
-            data_temp[:,s] = ro_stream.sum(axis = 1)
+        return time_interval_list, \
+            [os.path.join(inflow_directory,
+                          'm3_riv_bas_%s_%s.nc' % (time_interval.split("_")[0], ensemble_number))
+             for time_interval in time_interval_list]
 
-            pointer += npoints
+    def executeMultipleIntervals(self, in_nc, in_weight_table, out_nc_list,
+                                 grid_name, in_time_interval_list):
+        """Create the inflow files for several time intervals
 
+        The runoff and the weight table are read once and
+        each inflow file is computed from the same data.
+        """
+        ''' Read the weight table '''
+        weight_table = self.readWeightTable(in_weight_table)
+
+        if self.memory_limit_mb is not None:
+            time_block_size = self.getTimeBlockSize(weight_table,
+                                                    len(in_time_interval_list))
+            if time_block_size < self.getForecastMetadata(in_nc)['time_length']:
+                return self.executeTimeBlocks([in_nc],
+                                              weight_table['cell_lat_index'],
+                                              weight_table['cell_lon_index'],
+                                              grid_name,
+                                              [(weight_table, None, [out_nc_list],
+                                                in_time_interval_list)],
+                                              time_block_size)
+
+        id_data, data_cells = self.readRunoff(in_nc,
+                                              weight_table['cell_lat_index'],
+                                              weight_table['cell_lon_index'],
+                                              grid_name)
+
+        for out_nc, in_time_interval in zip(out_nc_list, in_time_interval_list):
+            '''Calculate water inflows'''
+            print("Calculating water inflows for {0}...".format(in_time_interval))
+            end_index, start_index = self.getTimeIndices(id_data, in_time_interval)
+            data_temp = self.computeInflow(data_cells, weight_table,
+                                           end_index, start_index)
+
+            '''Write inflow data'''
+            self.writeInflowFile(out_nc, data_temp)
+
+    def getTimeStepBytes(self, lat_ind_all, lon_ind_all, num_values, num_members=1):
+        """Get the memory used for each time step of the runoff read at the
+        latitude/longitude indices for num_members ensemble members
+
+        num_values is the number of values computed from the runoff of each
+        member (e.g. the inflow of each stream and time interval)
+        """
+        size_bbox = (lat_ind_all.max() - lat_ind_all.min() + 1) * \
+                    (lon_ind_all.max() - lon_ind_all.min() + 1)
+        # read buffer of one member, runoff of the cells of each member
+        # with its mask, runoff difference and the values computed
+        return 4*size_bbox + num_members*((8 + 1 + 8)*lat_ind_all.size + 8*num_values)
+
+    def getTimeBlockSize(self, weight_table, num_time_intervals):
+        """Get the number of time steps that can be processed within the memory limit"""
+        time_step_bytes = self.getTimeStepBytes(weight_table['cell_lat_index'],
+                                                weight_table['cell_lon_index'],
+                                                weight_table['stream_id'].size*num_time_intervals)
+        return max(int(self.memory_limit_mb*1024*1024 // time_step_bytes), 1)
+
+    def executeTimeBlocks(self, in_nc_list, lat_ind_all, lon_ind_all, grid_name,
+                          watershed_inflow_list, time_block_size):
+        """Create the inflow files reading the runoff in blocks of time steps
+
+        The runoff of the ensemble members is read at the latitude/longitude
+        indices. Each item in watershed_inflow_list is a tuple of
+        (weight_table, cell_index, out_nc_lists, in_time_interval_list)
+        where cell_index selects the cells of the weight table from the
+        cells read (None for all of them) and out_nc_lists has a list of
+        inflow files for each member.
+
+        The cumulative runoff of the time steps before each block that
+        it is differenced with is carried over from the previous block.
+        The inflow of each block is written as it is computed.
+        """
+        id_data = self.getForecastMetadata(in_nc_list[0])['resolution']
+        if id_data is None:
+            raise Exception(self.errorMessages[3])
+        carry_size = 1
+        for watershed_inflow in watershed_inflow_list:
+            for in_time_interval in watershed_inflow[3]:
+                end_index, start_index = self.getTimeIndices(id_data, in_time_interval)
+                carry_size = max(carry_size, (end_index - start_index).max())
+        time_block_size = max(time_block_size - carry_size, 1)
+        print("Calculating water inflows in blocks of {0} time steps..."
+              .format(time_block_size))
+
+        # inflow files to close or remove and the time indices and
+        # inflow files of each member of each watershed and time interval
+        inflow_nc_list = []
+        inflow_outputs = []
+        try:
+            for weight_table, cell_index, out_nc_lists, in_time_interval_list in watershed_inflow_list:
+                for interval_index, in_time_interval in enumerate(in_time_interval_list):
+                    end_index, start_index = self.getTimeIndices(id_data, in_time_interval)
+                    member_inflow_nc_list = []
+                    for out_nc_list in out_nc_lists:
+                        inflow_nc = self.createInflowFile(out_nc_list[interval_index], end_index.size,
+                                                          weight_table['stream_id'].size)
+                        inflow_nc_list.append((out_nc_list[interval_index], inflow_nc))
+                        member_inflow_nc_list.append(inflow_nc)
+                    inflow_outputs.append((weight_table, cell_index, end_index, start_index,
+                                           member_inflow_nc_list))
+
+            data_carry = None
+            for block_start in range(0, self.length_time[id_data], time_block_size):
+                block_end = min(block_start + time_block_size, self.length_time[id_data])
+                data_cells = self.readRunoffEnsemble(in_nc_list, lat_ind_all, lon_ind_all,
+                                                     grid_name, slice(block_start, block_end))[1]
+                if data_carry is not None:
+                    if NUM.ma.isMaskedArray(data_carry) or NUM.ma.isMaskedArray(data_cells):
+                        data_cells = NUM.ma.concatenate((data_carry, data_cells), axis=1)
+                    else:
+                        data_cells = NUM.concatenate((data_carry, data_cells), axis=1)
+                # time index of the first time step in data_cells
+                data_start = block_end - data_cells.shape[1]
+
+                for weight_table, cell_index, end_index, start_index, member_inflow_nc_list in inflow_outputs:
+                    block_steps = NUM.where((end_index >= block_start) &
+                                            (end_index < block_end))[0]
+                    if block_steps.size:
+                        data_temp = self.computeInflow(data_cells if cell_index is None
+                                                       else data_cells[..., cell_index],
+                                                       weight_table,
+                                                       end_index[block_steps] - data_start,
+                                                       start_index[block_steps] - data_start)
+                        for ensemble_index, inflow_nc in enumerate(member_inflow_nc_list):
+                            inflow_nc.variables['m3_riv'][block_steps[0]:block_steps[-1]+1] = \
+                                data_temp[ensemble_index]
+                data_carry = data_cells[:, -carry_size:]
+        except Exception:
+            for out_nc, inflow_nc in inflow_nc_list:
+                inflow_nc.close()
+                os.remove("{0}.tmp".format(out_nc))
+            raise
 
-        '''Write inflow data'''
         print("Writing inflow data...")
-        var_m3_riv[:] = data_temp
-        # close the input and output netcdf datasets
-        data_in_nc.close()
-        data_out_nc.close()
+        for out_nc, inflow_nc in inflow_nc_list:
+            self.closeInflowFile(inflow_nc, out_nc)
+
+    def readRunoffEnsemble(self, in_nc_list, lat_ind_all, lon_ind_all, grid_name,
+                           time_slice=slice(None)):
+        """Read the runoff of the grid cells for several ensemble members
+
+        All members must have the same resolution. Returns the resolution
+        of the data and the cumulative runoff with shape (ensemble, time, cell)
+        for the time steps in time_slice
+        """
+        data_cells = None
+        for ensemble_index, in_nc in enumerate(in_nc_list):
+            member_id_data, member_data_cells = self.readRunoff(in_nc, lat_ind_all,
+                                                                lon_ind_all, grid_name,
+                                                                time_slice)
+            if data_cells is None:
+                id_data = member_id_data
+                data_cells = NUM.zeros((len(in_nc_list),) + member_data_cells.shape,
+                                       dtype=member_data_cells.dtype)
+            elif member_id_data != id_data:
+                raise Exception("Ensemble members have different resolutions: {0} {1}"
+                                .format(in_nc_list[0], in_nc))
+            if NUM.ma.isMaskedArray(member_data_cells):
+                # keep the missing values of the member
+                data_cells = NUM.ma.asarray(data_cells)
+            data_cells[ensemble_index] = member_data_cells
+        return id_data, data_cells
+
+    def executeMultipleEnsembles(self, in_nc_list, watershed_inflow_list, grid_name):
+        """Create the inflow files of several ensemble members and watersheds
+
+        The members must share the same resolution and grid. Each member
+        is read once for the union of the grid cells of all the watersheds
+        and the inflow of all members is computed with one gather and one
+        sparse matrix product. Each item in watershed_inflow_list is a
+        tuple of (in_weight_table, out_nc_lists, in_time_interval_list)
+        where out_nc_lists has a list of inflow files for each member.
+        With a memory limit, the members are read in blocks of time steps.
+        """
+        weight_table_list = [self.readWeightTable(watershed_inflow[0])
+                             for watershed_inflow in watershed_inflow_list]
+
+        # union of the grid cells of all the watersheds
+        max_lon_index = max(weight_table['cell_lon_index'].max()
+                            for weight_table in weight_table_list) + 1
+        cell_key_list = [weight_table['cell_lat_index'] * max_lon_index + weight_table['cell_lon_index']
+                         for weight_table in weight_table_list]
+        union_cell_key = NUM.unique(NUM.concatenate(cell_key_list))
+
+        if self.memory_limit_mb is not None:
+            # the cells of each watershed and its inflow of each time interval
+            time_step_bytes = self.getTimeStepBytes(union_cell_key // max_lon_index,
+                                                    union_cell_key % max_lon_index,
+                                                    sum(cell_key.size + weight_table['stream_id'].size *
+                                                        len(watershed_inflow[2])
+                                                        for weight_table, cell_key, watershed_inflow in
+                                                        zip(weight_table_list, cell_key_list,
+                                                            watershed_inflow_list)),
+                                                    len(in_nc_list))
+            time_block_size = max(int(self.memory_limit_mb*1024*1024 // time_step_bytes), 1)
+            if time_block_size < self.getForecastMetadata(in_nc_list[0])['time_length']:
+                return self.executeTimeBlocks(in_nc_list,
+                                              union_cell_key // max_lon_index,
+                                              union_cell_key % max_lon_index,
+                                              grid_name,
+                                              [(weight_table, NUM.searchsorted(union_cell_key, cell_key),
+                                                watershed_inflow[1], watershed_inflow[2])
+                                               for weight_table, cell_key, watershed_inflow in
+                                               zip(weight_table_list, cell_key_list, watershed_inflow_list)],
+                                              time_block_size)
+
+        id_data, union_data_cells = self.readRunoffEnsemble(in_nc_list,
+                                                            union_cell_key // max_lon_index,
+                                                            union_cell_key % max_lon_index,
+                                                            grid_name)
+
+        for weight_table, cell_key, watershed_inflow in \
+                zip(weight_table_list, cell_key_list, watershed_inflow_list):
+            data_cells = union_data_cells[..., NUM.searchsorted(union_cell_key, cell_key)]
+            for interval_index, in_time_interval in enumerate(watershed_inflow[2]):
+                print("Calculating water inflows for {0} {1}..."
+                      .format(watershed_inflow[0], in_time_interval))
+                end_index, start_index = self.getTimeIndices(id_data, in_time_interval)
+                data_temp = self.computeInflow(data_cells, weight_table,
+                                               end_index, start_index)
+                for ensemble_index, out_nc_list in enumerate(watershed_inflow[1]):
+                    self.writeInflowFile(out_nc_list[interval_index], data_temp[ensemble_index])
+
+    def executeMultipleWatersheds(self, in_nc, watershed_inflow_list, grid_name):
+        """Create the inflow files of several watersheds
+
+        The runoff is read once for the union of the grid cells of all
+        the watersheds. Each item in watershed_inflow_list is a tuple of
+        (in_weight_table, out_nc_list, in_time_interval_list).
+        """
+        self.executeMultipleEnsembles([in_nc],
+                                      [(watershed_inflow[0], [watershed_inflow[1]], watershed_inflow[2])
+                                       for watershed_inflow in watershed_inflow_list],
+                                      grid_name)
+
+    def execute(self, in_nc, in_weight_table, out_nc, grid_name, in_time_interval="6hr"):
+        """The source code of the tool."""
+        self.executeMultipleIntervals(in_nc, in_weight_table, [out_nc],
+                                      grid_name, [in_time_interval])
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+##
+##  ecmwf_forecast_metadata.py
+##  spt_compute
+##
+##  License: BSD 3-Clause
+
+import json
+import os
+
+#local imports
+from .CreateInflowFileFromECMWFRunoff import CreateInflowFileFromECMWFRunoff
+from .helper_functions import get_ensemble_number_from_forecast
+
+FORECAST_METADATA_INDEX_VERSION = 1
+
+#------------------------------------------------------------------------------
+#functions
+#------------------------------------------------------------------------------
+def get_forecast_metadata_index_file(ecmwf_folder):
+    """
+    Returns the path to the metadata index of the forecast folder
+    """
+    return os.path.join(ecmwf_folder, "forecast_metadata.json")
+
+
+def load_forecast_metadata_index(ecmwf_folder):
+    """
+    Loads the metadata index of the forecast folder.
+    Returns an empty index if it is missing or invalid.
+    """
+    index_file = get_forecast_metadata_index_file(ecmwf_folder)
+    try:
+        with open(index_file) as index_json:
+            forecast_index = json.load(index_json)
+    except (IOError, OSError, ValueError):
+        return {}
+    if forecast_index.get('version') != FORECAST_METADATA_INDEX_VERSION:
+        return {}
+    return forecast_index.get('forecasts', {})
+
+
+def build_forecast_metadata_index(ecmwf_folder, ecmwf_forecasts, write_index=True):
+    """
+    Returns the metadata of the forecasts indexed by forecast file name
+
+    The metadata of each forecast (ensemble number, resolution, time length,
+    variable names, grid name, and file size) is read once and stored
+    in an index in the forecast folder. Forecasts that are missing from
+    the index or changed since it was written are read again. With
+    write_index=False, the index is not updated (e.g. for a dry run).
+    """
+    forecast_index = load_forecast_metadata_index(ecmwf_folder)
+    RAPIDinflowECMWF_tool = CreateInflowFileFromECMWFRunoff()
+
+    forecast_metadata = {}
+    index_changed = False
+    for ecmwf_forecast in ecmwf_forecasts:
+        forecast_name = os.path.basename(ecmwf_forecast)
+        file_stat = os.stat(ecmwf_forecast)
+        metadata = forecast_index.get(forecast_name)
+        if metadata is None or metadata['file_size'] != file_stat.st_size \
+                or metadata['file_mtime'] != file_stat.st_mtime:
+            try:
+                metadata = RAPIDinflowECMWF_tool.readForecastMetadata(ecmwf_forecast)
+            except Exception as ex:
+                print("WARNING: Metadata not read for {0}: {1}".format(ecmwf_forecast, ex))
+                continue
+            metadata['file_mtime'] = file_stat.st_mtime
+            metadata['ensemble_number'] = get_ensemble_number_from_forecast(forecast_name)
+            index_changed = True
+        forecast_metadata[forecast_name] = metadata
+
+    if write_index and (index_changed or set(forecast_metadata) != set(forecast_index)):
+        index_file = get_forecast_metadata_index_file(ecmwf_folder)
+        temp_index_file = "{0}.tmp".format(index_file)
+        try:
+            with open(temp_index_file, 'w') as index_json:
+                json.dump({'version': FORECAST_METADATA_INDEX_VERSION,
+                           'forecasts': forecast_metadata},
+                          index_json, indent=2, sort_keys=True)
+            os.rename(temp_index_file, index_file)
+        except (IOError, OSError) as ex:
+            print("WARNING: Forecast metadata index not written: {0}".format(ex))
+
+    return forecast_metadata
@@ -7,34 +7,161 @@
 ##  Copyright © 2015-2017 Alan D Snow. All rights reserved.
 ##  License: BSD 3-Clause
 
+from collections import OrderedDict
 import datetime
+from multiprocessing import cpu_count
 import os
+import time
 from RAPIDpy import RAPID
-from RAPIDpy.postprocess import ConvertRAPIDOutputToCF
-from shutil import move, rmtree
+from shutil import rmtree
 import traceback
 
 #local imports
 from .CreateInflowFileFromECMWFRunoff import CreateInflowFileFromECMWFRunoff
-from .helper_functions import (case_insensitive_file_search,
-                               get_ensemble_number_from_forecast,
+from .helper_functions import (get_ensemble_number_from_forecast,
+                               get_staging_directory,
+                               publish_file,
                                CaptureStdOutToLog)
+from .job_checkpoint import JobCheckpoint
+from .job_stats import get_job_stats_file, JobStats
+from .rapid_qout_merge import merge_rapid_qout_to_cf
+from .watershed_input_manifest import (get_watershed_input_file,
+                                       get_watershed_input_manifest)
                               
+
+# state of the watersheds loaded by this process, least recently used first
+WATERSHED_STATE_CACHE = OrderedDict()
+WATERSHED_STATE_CACHE_MB = 512
+# RAPID parameters set by update_reach_number_data
+REACH_NUMBER_PARAMETERS = ('IS_riv_tot', 'IS_max_up', 'IS_riv_bas',
+                           'IS_for_tot', 'IS_for_use')
+
 #------------------------------------------------------------------------------
 #functions
 #------------------------------------------------------------------------------
+def set_watershed_state_cache_mb(cache_mb):
+    """
+    Sets the memory limit of the watershed state kept by this process
+    """
+    global WATERSHED_STATE_CACHE_MB
+    WATERSHED_STATE_CACHE_MB = cache_mb
+
+
+def get_watershed_state(rapid_input_directory, input_manifest):
+    """
+    Returns the state of the watershed kept in memory by this process:
+    the RAPID reach numbers and the compiled weight tables. The state
+    is loaded again when the watershed input directory changes.
+    """
+    state_key = (rapid_input_directory, input_manifest['directory_mtime'])
+    watershed_state = WATERSHED_STATE_CACHE.pop(rapid_input_directory, None)
+    if watershed_state is None or watershed_state['key'] != state_key:
+        watershed_state = {
+            'key': state_key,
+            'reach_number_data': None,
+            'weight_tables': {},
+            'qout_metadata': None,
+        }
+    WATERSHED_STATE_CACHE[rapid_input_directory] = watershed_state
+    return watershed_state
+
+
+def get_watershed_state_mb(watershed_state):
+    """
+    Gets the memory of the arrays in the watershed state in MB
+    """
+    state_bytes = sum(weight_table_array.nbytes
+                      for _, weight_table in watershed_state['weight_tables'].values()
+                      for weight_table_array in weight_table.values())
+    if watershed_state['qout_metadata'] is not None:
+        state_bytes += sum(metadata_array.nbytes
+                           for metadata_array in watershed_state['qout_metadata'].values()
+                           if hasattr(metadata_array, 'nbytes'))
+    return state_bytes / (1024.0 * 1024.0)
+
+
+def get_watershed_state_cache_mb():
+    """
+    Gets the memory of the watershed state kept by this process in MB
+    """
+    return sum(get_watershed_state_mb(watershed_state)
+               for watershed_state in WATERSHED_STATE_CACHE.values())
+
+
+def evict_watershed_state():
+    """
+    Removes the least recently used watershed state
+    until the state is within the memory limit
+    """
+    while len(WATERSHED_STATE_CACHE) > 1 and \
+            get_watershed_state_cache_mb() > WATERSHED_STATE_CACHE_MB:
+        WATERSHED_STATE_CACHE.popitem(last=False)
+
+
+def get_job_staging_mb(rapid_input_directory, input_manifest, num_rivers=None):
+    """
+    Estimates the space in MB of the intermediate files of a job from the
+    inflow, partial and merged Qout of each river for the 125 time steps
+    of the high resolution forecast. num_rivers is the number of rivers
+    in the rapid_connect file if it was counted before the job.
+    """
+    if num_rivers is None:
+        reach_number_data = get_watershed_state(rapid_input_directory,
+                                                input_manifest)['reach_number_data']
+        if reach_number_data is not None:
+            num_rivers = reach_number_data['IS_riv_tot']
+        else:
+            rapid_connect_file = get_watershed_input_file(rapid_input_directory,
+                                                          input_manifest, 'rapid_connect')
+            with open(rapid_connect_file) as rapid_connect:
+                num_rivers = sum(1 for _ in rapid_connect)
+    return 10 + 4 * 125 * 4 * num_rivers / (1024.0 * 1024.0)
+
+
 def ecmwf_rapid_multiprocess_worker(node_path, rapid_input_directory,
                                     ecmwf_forecast, forecast_date_timestep, 
                                     watershed, subbasin, rapid_executable_location, 
-                                    init_flow):
+                                    init_flow, inflow_directory="",
+                                    forecast_metadata=None, inflow_options=None,
+                                    input_manifest=None, validate_input_manifest=True,
+                                    job_stats=None, checkpoint=False, outflow_file=None):
     """
     Multiprocess worker function
+
+    If the inflow files were prepared in inflow_directory before the
+    job, they are used instead of extracting the inflow from the forecast.
+    forecast_metadata is the metadata index of the forecast folder used
+    to identify the forecast without opening it. inflow_options are the
+    options of CreateInflowFileFromECMWFRunoff (e.g. memory_limit_mb and
+    inflow_format). input_manifest has the input files of the watershed
+    found before the job so the input directory is not searched.
+    job_stats records the time and resources of each stage of the job.
+    With checkpoint=True, the completed stages are stored in the job
+    directory and the intermediate files are kept if the job fails, so
+    running the job again in the directory continues after the last
+    valid stage. With outflow_file, the merged Qout file is written to
+    outflow_file (e.g. in the output directory of the forecast) instead
+    of the job directory.
     """
     time_start_all = datetime.datetime.utcnow()
 
     os.chdir(node_path)
 
     ensemble_number = get_ensemble_number_from_forecast(ecmwf_forecast)
+    if job_stats is None:
+        job_stats = JobStats(watershed=watershed, subbasin=subbasin,
+                             forecast_date_timestep=forecast_date_timestep,
+                             ensemble_number=ensemble_number)
+
+    input_manifest = get_watershed_input_manifest(rapid_input_directory, input_manifest,
+                                                  validate=validate_input_manifest)
+    watershed_state = get_watershed_state(rapid_input_directory, input_manifest)
+
+    def input_file(file_role):
+        """
+        path to the watershed input file in the manifest
+        """
+        return get_watershed_input_file(rapid_input_directory, input_manifest, file_role)
 
     def remove_file(file_name):
         """
@@ -53,30 +180,23 @@ def ecmwf_rapid_multiprocess_worker(node_path, rapid_input_directory,
                   ensemble_number))
 
     #set up RAPID manager
-    rapid_connect_file=case_insensitive_file_search(rapid_input_directory,
-                                                    r'rapid_connect\.csv')
+    rapid_connect_file=input_file('rapid_connect')
 
     rapid_manager = RAPID(
         rapid_executable_location=rapid_executable_location,
         rapid_connect_file=rapid_connect_file,
-        riv_bas_id_file=case_insensitive_file_search(rapid_input_directory,
-                                                     r'riv_bas_id.*?\.csv'),
-        k_file=case_insensitive_file_search(rapid_input_directory,
-                                            r'k\.csv'),
-        x_file=case_insensitive_file_search(rapid_input_directory,
-                                            r'x\.csv'),
+        riv_bas_id_file=input_file('riv_bas_id'),
+        k_file=input_file('k'),
+        x_file=input_file('x'),
         ZS_dtM=3*60*60, #RAPID internal loop time interval
     )
 
     # check for forcing flows
     try:
         rapid_manager.update_parameters(
-            Qfor_file=case_insensitive_file_search(rapid_input_directory,
-                                                   r'qfor\.csv'),
-            for_tot_id_file=case_insensitive_file_search(rapid_input_directory,
-                                                         r'for_tot_id\.csv'),
-            for_use_id_file=case_insensitive_file_search(rapid_input_directory,
-                                                         r'for_use_id\.csv'),
+            Qfor_file=input_file('qfor'),
+            for_tot_id_file=input_file('for_tot_id'),
+            for_use_id_file=input_file('for_use_id'),
             ZS_dtF=3*60*60, # forcing time interval
             BS_opt_for=True
         )
@@ -85,7 +205,13 @@ def ecmwf_rapid_multiprocess_worker(node_path, rapid_input_directory,
         pass
 
 
-    rapid_manager.update_reach_number_data()
+    if watershed_state['reach_number_data'] is None:
+        rapid_manager.update_reach_number_data()
+        watershed_state['reach_number_data'] = \
+            dict((parameter, getattr(rapid_manager, parameter))
+                 for parameter in REACH_NUMBER_PARAMETERS)
+    else:
+        rapid_manager.update_parameters(**watershed_state['reach_number_data'])
 
     outflow_file_name = os.path.join(node_path,
                                      'Qout_%s_%s_%s.nc' % (watershed.lower(), 
@@ -106,21 +232,130 @@ def ecmwf_rapid_multiprocess_worker(node_path, rapid_input_directory,
 
             
     try:
-        comid_lat_lon_z_file = case_insensitive_file_search(rapid_input_directory,
-                                                            r'comid_lat_lon_z.*?\.csv')
+        comid_lat_lon_z_file = input_file('comid_lat_lon_z')
     except Exception:
         comid_lat_lon_z_file = ""
         print("WARNING: comid_lat_lon_z_file not found. Not adding lat/lon/z to output file ...")
 
-    RAPIDinflowECMWF_tool = CreateInflowFileFromECMWFRunoff()
-    forecast_resolution = RAPIDinflowECMWF_tool.dataIdentify(ecmwf_forecast)
+    RAPIDinflowECMWF_tool = CreateInflowFileFromECMWFRunoff(forecast_metadata=forecast_metadata,
+                                                            weight_tables=watershed_state['weight_tables'],
+                                                            **(inflow_options or {}))
+    forecast_resolution = RAPIDinflowECMWF_tool.getForecastMetadata(ecmwf_forecast)['resolution']
+
+    job_checkpoint = None
+    if checkpoint:
+        job_checkpoint = JobCheckpoint(node_path, {
+            'forecast': os.path.basename(ecmwf_forecast),
+            'forecast_date_timestep': forecast_date_timestep,
+            'qinit_file': qinit_file,
+            'rapid_input_directory': rapid_input_directory,
+        })
+
+    def run_stage(stage_name, stage_function, stage_files, removed_files=()):
+        """
+        Runs the stage unless it was completed in a previous run
+        of the job in the directory
+        """
+        if job_checkpoint is not None and job_checkpoint.isComplete(stage_name):
+            print("INFO: Using {0} from the previous run of the job ...".format(stage_name))
+            return
+        stage_function()
+        if job_checkpoint is not None:
+            job_checkpoint.complete(stage_name, stage_files, removed_files)
+
+    def run_rapid(stage_name):
+        """
+        Runs RAPID and records the stage
+        """
+        def rapid_stage():
+            with job_stats.stage(stage_name, output_files=[rapid_manager.Qout_file]):
+                rapid_manager.run()
+        run_stage(stage_name, rapid_stage, [rapid_manager.Qout_file])
+
+    def generate_qinit(stage_name, qinit_next_file):
+        """
+        Generates the Qinit file of the next RAPID run from the last RAPID output
+        """
+        run_stage(stage_name,
+                  lambda: rapid_manager.generate_qinit_from_past_qout(qinit_next_file),
+                  [qinit_next_file])
+
+    def merge_qout(rapid_output_file_list, time_step_list):
+        """
+        Merges the RAPID output into the CF compliant Qout file
+        """
+        merged_outflow_file = outflow_file or outflow_file_name
+
+        def merge_stage():
+            with job_stats.stage('qout_merge', output_files=[merged_outflow_file]):
+                watershed_state['qout_metadata'] = \
+                    merge_rapid_qout_to_cf(rapid_output_file_list,
+                                           start_datetime=datetime.datetime.strptime(forecast_date_timestep[:11], "%Y%m%d.%H"),
+                                           time_step_list=time_step_list,
+                                           qinit_file=qinit_file,
+                                           comid_lat_lon_z_file=comid_lat_lon_z_file,
+                                           rapid_connect_file=rapid_connect_file,
+                                           project_name="ECMWF-RAPID Predicted flows by US Army ERDC",
+                                           output_id_dim_name='rivid',
+                                           output_flow_var_name='Qout',
+                                           static_metadata=watershed_state['qout_metadata'],
+                                           output_file=merged_outflow_file)
+        run_stage('qout_merge', merge_stage, [merged_outflow_file],
+                  removed_files=[rapid_output_file for rapid_output_file in rapid_output_file_list
+                                 if rapid_output_file != merged_outflow_file])
+
+    def clean_up(*intermediate_files):
+        """
+        Removes the intermediate files of the job
+        """
+        for intermediate_file in intermediate_files:
+            remove_file(intermediate_file)
+        if job_checkpoint is not None:
+            job_checkpoint.complete('clean_up', [], removed_files=intermediate_files)
+
+    def prepare_inflow(weight_table_file, grid_name):
+        """
+        Returns the inflow files of the forecast and generates them
+        for all time intervals from one read of the forecast if they
+        were not prepared before the job
+        """
+        if job_checkpoint is not None and job_checkpoint.isComplete('inflow'):
+            print("INFO: Using inflow from the previous run of the job ...")
+            return job_checkpoint.getFiles('inflow')
+
+        time_interval_list, inflow_file_list = \
+            RAPIDinflowECMWF_tool.getInflowFileNames(node_path,
+                                                     forecast_resolution,
+                                                     ensemble_number)
+        if inflow_directory:
+            prepared_inflow_file_list = \
+                RAPIDinflowECMWF_tool.getInflowFileNames(inflow_directory,
+                                                         forecast_resolution,
+                                                         ensemble_number)[1]
+            if all(os.path.exists(prepared_inflow_file)
+                   for prepared_inflow_file in prepared_inflow_file_list):
+                print("INFO: Using inflow prepared in {0} ...".format(inflow_directory))
+                if job_checkpoint is not None:
+                    job_checkpoint.complete('inflow', prepared_inflow_file_list)
+                return prepared_inflow_file_list
+
+        print("INFO: Converting ECMWF inflow ...")
+        with job_stats.stage('inflow', output_files=inflow_file_list):
+            RAPIDinflowECMWF_tool.executeMultipleIntervals(ecmwf_forecast,
+                                                           weight_table_file,
+                                                           inflow_file_list,
+                                                           grid_name,
+                                                           time_interval_list)
+        if job_checkpoint is not None:
+            job_checkpoint.complete('inflow', inflow_file_list)
+        return inflow_file_list
+
     #determine weight table from resolution
     if forecast_resolution == "HighRes":
         #HIGH RES
         grid_name = RAPIDinflowECMWF_tool.getGridName(ecmwf_forecast, high_res=True)
         #generate inflows for each timestep
-        weight_table_file = case_insensitive_file_search(rapid_input_directory,
-                                                         r'weight_{0}\.csv'.format(grid_name))
+        weight_table_file = input_file('weight_{0}'.format(grid_name))
                                                          
         inflow_file_name_1hr = os.path.join(node_path, 'm3_riv_bas_1hr_%s.nc' % ensemble_number)
         inflow_file_name_3hr = os.path.join(node_path, 'm3_riv_bas_3hr_%s.nc' % ensemble_number)
@@ -130,12 +365,8 @@ def ecmwf_rapid_multiprocess_worker(node_path, rapid_input_directory,
         
         
         try:
-        
-            RAPIDinflowECMWF_tool.execute(ecmwf_forecast, 
-                                          weight_table_file, 
-                                          inflow_file_name_1hr,
-                                          grid_name,
-                                          "1hr")
+            inflow_file_name_1hr, inflow_file_name_3hr, inflow_file_name_6hr = \
+                prepare_inflow(weight_table_file, grid_name)
 
             #from Hour 0 to 90 (the first 91 time points) are of 1 hr time interval
             interval_1hr = 1*60*60 #1hr
@@ -149,17 +380,12 @@ def ecmwf_rapid_multiprocess_worker(node_path, rapid_input_directory,
                                             Qout_file=outflow_file_name,
                                             Qinit_file=qinit_file,
                                             BS_opt_Qinit=BS_opt_Qinit)
-            rapid_manager.run()
+            run_rapid('rapid_1hr')
     
             #generate Qinit from 1hr
-            rapid_manager.generate_qinit_from_past_qout(qinit_3hr_file)
+            generate_qinit('qinit_3hr', qinit_3hr_file)
 
             #then from Hour 90 to 144 (19 time points) are of 3 hour time interval
-            RAPIDinflowECMWF_tool.execute(ecmwf_forecast, 
-                                          weight_table_file, 
-                                          inflow_file_name_3hr,
-                                          grid_name,
-                                          "3hr_subset")
             interval_3hr = 3*60*60 #3hr
             duration_3hr = 54*60*60 #54hrs
             qout_3hr = os.path.join(node_path,'Qout_3hr.nc')
@@ -170,16 +396,11 @@ def ecmwf_rapid_multiprocess_worker(node_path, rapid_input_directory,
                                             ZS_dtF=interval_3hr,  # forcing time interval
                                             Vlat_file=inflow_file_name_3hr,
                                             Qout_file=qout_3hr)
-            rapid_manager.run()
+            run_rapid('rapid_3hr')
 
             #generate Qinit from 3hr
-            rapid_manager.generate_qinit_from_past_qout(qinit_6hr_file)
+            generate_qinit('qinit_6hr', qinit_6hr_file)
             #from Hour 144 to 240 (15 time points) are of 6 hour time interval
-            RAPIDinflowECMWF_tool.execute(ecmwf_forecast, 
-                                          weight_table_file, 
-                                          inflow_file_name_6hr,
-                                          grid_name,
-                                          "6hr_subset")
             interval_6hr = 6*60*60 #6hr
             duration_6hr = 96*60*60 #96hrs
             qout_6hr = os.path.join(node_path,'Qout_6hr.nc')
@@ -190,54 +411,34 @@ def ecmwf_rapid_multiprocess_worker(node_path, rapid_input_directory,
                                             ZS_dtF=interval_6hr,  # forcing time interval
                                             Vlat_file=inflow_file_name_6hr,
                                             Qout_file=qout_6hr)
-            rapid_manager.run()
+            run_rapid('rapid_6hr')
 
             #Merge all files together at the end
-            cv = ConvertRAPIDOutputToCF(rapid_output_file=[outflow_file_name, qout_3hr, qout_6hr], 
-                                        start_datetime=datetime.datetime.strptime(forecast_date_timestep[:11], "%Y%m%d.%H"), 
-                                        time_step=[interval_1hr, interval_3hr, interval_6hr], 
-                                        qinit_file=qinit_file, 
-                                        comid_lat_lon_z_file=comid_lat_lon_z_file,
-                                        rapid_connect_file=rapid_connect_file, 
-                                        project_name="ECMWF-RAPID Predicted flows by US Army ERDC", 
-                                        output_id_dim_name='rivid',
-                                        output_flow_var_name='Qout',
-                                        print_debug=False)
-            cv.convert()
+            merge_qout([outflow_file_name, qout_3hr, qout_6hr], [interval_1hr, interval_3hr, interval_6hr])
     
         except Exception:
-            remove_file(qinit_3hr_file)
-            remove_file(qinit_6hr_file)
-            remove_file(inflow_file_name_1hr)
-            remove_file(inflow_file_name_3hr)
-            remove_file(inflow_file_name_6hr)
+            if job_checkpoint is None:
+                clean_up(qinit_3hr_file, qinit_6hr_file, inflow_file_name_1hr,
+                         inflow_file_name_3hr, inflow_file_name_6hr)
             traceback.print_exc()
             raise
             
-        remove_file(qinit_3hr_file)
-        remove_file(qinit_6hr_file)
-        remove_file(inflow_file_name_1hr)
-        remove_file(inflow_file_name_3hr)
-        remove_file(inflow_file_name_6hr)
+        clean_up(qinit_3hr_file, qinit_6hr_file, inflow_file_name_1hr,
+                 inflow_file_name_3hr, inflow_file_name_6hr)
 
     elif forecast_resolution == "LowResFull":
         #LOW RES - 3hr and 6hr timesteps
         grid_name = RAPIDinflowECMWF_tool.getGridName(ecmwf_forecast, high_res=False)
         #generate inflows for each timestep
-        weight_table_file = case_insensitive_file_search(rapid_input_directory,
-                                                         r'weight_{0}\.csv'.format(grid_name))
+        weight_table_file = input_file('weight_{0}'.format(grid_name))
                                                          
         inflow_file_name_3hr = os.path.join(node_path, 'm3_riv_bas_3hr_%s.nc' % ensemble_number)
         inflow_file_name_6hr = os.path.join(node_path, 'm3_riv_bas_6hr_%s.nc' % ensemble_number)
         qinit_6hr_file = os.path.join(node_path, 'Qinit_6hr.csv')
         
         try:
-        
-            RAPIDinflowECMWF_tool.execute(ecmwf_forecast, 
-                                          weight_table_file, 
-                                          inflow_file_name_3hr,
-                                          grid_name,
-                                          "3hr_subset")
+            inflow_file_name_3hr, inflow_file_name_6hr = \
+                prepare_inflow(weight_table_file, grid_name)
 
             #from Hour 0 to 144 (the first 49 time points) are of 3 hr time interval
             interval_3hr = 3*60*60 #3hr
@@ -251,16 +452,11 @@ def ecmwf_rapid_multiprocess_worker(node_path, rapid_input_directory,
                                             Qout_file=outflow_file_name,
                                             Qinit_file=qinit_file,
                                             BS_opt_Qinit=BS_opt_Qinit)
-            rapid_manager.run()
+            run_rapid('rapid_3hr')
     
             #generate Qinit from 3hr
-            rapid_manager.generate_qinit_from_past_qout(qinit_6hr_file)
+            generate_qinit('qinit_6hr', qinit_6hr_file)
             #from Hour 144 to 360 (36 time points) are of 6 hour time interval
-            RAPIDinflowECMWF_tool.execute(ecmwf_forecast, 
-                                          weight_table_file, 
-                                          inflow_file_name_6hr,
-                                          grid_name,
-                                          "6hr_subset")
             interval_6hr = 6*60*60 #6hr
             duration_6hr = 216*60*60 #216hrs
             qout_6hr = os.path.join(node_path,'Qout_6hr.nc')
@@ -271,31 +467,18 @@ def ecmwf_rapid_multiprocess_worker(node_path, rapid_input_directory,
                                             ZS_dtF=interval_6hr,  # forcing time interval
                                             Vlat_file=inflow_file_name_6hr,
                                             Qout_file=qout_6hr)
-            rapid_manager.run()
+            run_rapid('rapid_6hr')
 
             #Merge all files together at the end
-            cv = ConvertRAPIDOutputToCF(rapid_output_file=[outflow_file_name, qout_6hr], 
-                                        start_datetime=datetime.datetime.strptime(forecast_date_timestep[:11], "%Y%m%d.%H"), 
-                                        time_step=[interval_3hr, interval_6hr], 
-                                        qinit_file=qinit_file, 
-                                        comid_lat_lon_z_file=comid_lat_lon_z_file,
-                                        rapid_connect_file=rapid_connect_file, 
-                                        project_name="ECMWF-RAPID Predicted flows by US Army ERDC", 
-                                        output_id_dim_name='rivid',
-                                        output_flow_var_name='Qout',
-                                        print_debug=False)
-            cv.convert()
+            merge_qout([outflow_file_name, qout_6hr], [interval_3hr, interval_6hr])
     
         except Exception:
-            remove_file(qinit_6hr_file)
-            remove_file(inflow_file_name_3hr)
-            remove_file(inflow_file_name_6hr)
+            if job_checkpoint is None:
+                clean_up(qinit_6hr_file, inflow_file_name_3hr, inflow_file_name_6hr)
             traceback.print_exc()
             raise
             
-        remove_file(qinit_6hr_file)
-        remove_file(inflow_file_name_3hr)
-        remove_file(inflow_file_name_6hr)
+        clean_up(qinit_6hr_file, inflow_file_name_3hr, inflow_file_name_6hr)
         
     elif forecast_resolution == "LowRes":
         #LOW RES - 6hr only
@@ -303,16 +486,10 @@ def ecmwf_rapid_multiprocess_worker(node_path, rapid_input_directory,
 
         grid_name = RAPIDinflowECMWF_tool.getGridName(ecmwf_forecast, high_res=False)
         #generate inflows for each timestep
-        weight_table_file = case_insensitive_file_search(rapid_input_directory,
-                                                         r'weight_{0}\.csv'.format(grid_name))
+        weight_table_file = input_file('weight_{0}'.format(grid_name))
 
         try:
-
-            print("INFO: Converting ECMWF inflow ...")
-            RAPIDinflowECMWF_tool.execute(ecmwf_forecast, 
-                                          weight_table_file, 
-                                          inflow_file_name,
-                                          grid_name)
+            inflow_file_name = prepare_inflow(weight_table_file, grid_name)[0]
     
             interval = 6*60*60 #6hr
             duration = 15*24*60*60 #15 days
@@ -324,22 +501,29 @@ def ecmwf_rapid_multiprocess_worker(node_path, rapid_input_directory,
                                             Qinit_file=qinit_file,
                                             BS_opt_Qinit=BS_opt_Qinit)
     
-            rapid_manager.run()
-            rapid_manager.make_output_CF_compliant(simulation_start_datetime=datetime.datetime.strptime(forecast_date_timestep[:11], "%Y%m%d.%H"),
-                                                   comid_lat_lon_z_file=comid_lat_lon_z_file,
-                                                   project_name="ECMWF-RAPID Predicted flows by US Army ERDC")
+            run_rapid('rapid_6hr')
+
+            def cf_conversion_stage():
+                with job_stats.stage('cf_conversion', output_files=[outflow_file_name]):
+                    rapid_manager.make_output_CF_compliant(simulation_start_datetime=datetime.datetime.strptime(forecast_date_timestep[:11], "%Y%m%d.%H"),
+                                                           comid_lat_lon_z_file=comid_lat_lon_z_file,
+                                                           project_name="ECMWF-RAPID Predicted flows by US Army ERDC")
+            run_stage('cf_conversion', cf_conversion_stage, [outflow_file_name])
 
         except Exception:
-            remove_file(inflow_file_name)
+            if job_checkpoint is None:
+                clean_up(inflow_file_name)
             traceback.print_exc()
             raise
             
         #clean up
-        remove_file(inflow_file_name)
+        clean_up(inflow_file_name)
 
     else:
         raise Exception("ERROR: invalid forecast resolution ...")
         
+    evict_watershed_state()
+
     time_stop_all = datetime.datetime.utcnow()
     print("INFO: Total time to compute: {0}".format(time_stop_all-time_start_all))
 
@@ -360,31 +544,62 @@ def run_ecmwf_rapid_multiprocess_worker(args):
     mp_execute_directory = args[9]
     subprocess_forecast_log_dir = args[10]
     watershed_job_index = args[11]
+    inflow_directory = args[12] if len(args) > 12 else ""
+    forecast_metadata = args[13] if len(args) > 13 else None
+    inflow_options = args[14] if len(args) > 14 else None
+    staging_directories = args[15] if len(args) > 15 else ()
+    input_manifest = get_watershed_input_manifest(rapid_input_directory,
+                                                  args[16] if len(args) > 16 else None)
+    job_retries = args[17] if len(args) > 17 else 0
+    job_retry_delay_seconds = args[18] if len(args) > 18 else 0
+    num_rivers = args[19] if len(args) > 19 else None
     
     
+    # the memory of the watershed state kept from the previous jobs
+    # is not part of the memory of the job
+    job_stats = JobStats(get_job_stats_file(subprocess_forecast_log_dir, job_name),
+                         job_name=job_name, watershed=watershed, subbasin=subbasin,
+                         forecast_date_timestep=forecast_date_timestep,
+                         ensemble_number=get_ensemble_number_from_forecast(ecmwf_forecast),
+                         state_cache_mb=get_watershed_state_cache_mb())
+
     with CaptureStdOutToLog(os.path.join(subprocess_forecast_log_dir, "{0}.log".format(job_name))):
-        #create folder to run job
-        execute_directory = os.path.join(mp_execute_directory, job_name)
-        try:
-            os.mkdir(execute_directory)
-        except OSError:
-            pass
+        #create folder to run job, on a RAM disk or local scratch if there is
+        #space for the files of a job on every cpu
+        execute_directory = get_staging_directory(mp_execute_directory, job_name,
+                                                  get_job_staging_mb(rapid_input_directory,
+                                                                     input_manifest,
+                                                                     num_rivers)*cpu_count(),
+                                                  staging_directories)
+        print("INFO: Running job in {0} ...".format(execute_directory))
         
-        try:
-            ecmwf_rapid_multiprocess_worker(execute_directory, rapid_input_directory,
-                                            ecmwf_forecast, forecast_date_timestep, 
-                                            watershed, subbasin, rapid_executable_location, 
-                                            initialize_flows)
-             
-            #move output file from compute node to master location
-            node_rapid_outflow_file = os.path.join(execute_directory, 
-                                                   os.path.basename(master_rapid_outflow_file))
-                                                   
-            move(node_rapid_outflow_file, master_rapid_outflow_file)
-            rmtree(execute_directory)
-        except Exception:
-            rmtree(execute_directory)
-            traceback.print_exc()
-            raise
+        # a failed job is run again from the last completed stage
+        for job_attempt in range(job_retries + 1):
+            try:
+                ecmwf_rapid_multiprocess_worker(execute_directory, rapid_input_directory,
+                                                ecmwf_forecast, forecast_date_timestep, 
+                                                watershed, subbasin, rapid_executable_location, 
+                                                initialize_flows, inflow_directory,
+                                                forecast_metadata, inflow_options,
+                                                input_manifest, job_stats=job_stats,
+                                                checkpoint=True, outflow_file=master_rapid_outflow_file)
+                 
+                #move output file from compute node to master location if
+                #it was not merged there
+                node_rapid_outflow_file = os.path.join(execute_directory, 
+                                                       os.path.basename(master_rapid_outflow_file))
+                if os.path.exists(node_rapid_outflow_file):
+                    with job_stats.stage('publish', output_files=[master_rapid_outflow_file]):
+                        publish_file(node_rapid_outflow_file, master_rapid_outflow_file)
+                rmtree(execute_directory)
+                break
+            except Exception:
+                traceback.print_exc()
+                if job_attempt >= job_retries:
+                    rmtree(execute_directory)
+                    raise
+                print("WARNING: Job failed. Retrying from the last completed stage in {0} seconds ({1}/{2}) ..."
+                      .format(job_retry_delay_seconds, job_attempt + 1, job_retries))
+                time.sleep(job_retry_delay_seconds)
     return watershed_job_index
     
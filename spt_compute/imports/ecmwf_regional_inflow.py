@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+##
+##  ecmwf_regional_inflow.py
+##  spt_compute
+##
+##  License: BSD 3-Clause
+
+import os
+import traceback
+
+#local imports
+from .CreateInflowFileFromECMWFRunoff import CreateInflowFileFromECMWFRunoff
+from .helper_functions import (get_ensemble_number_from_forecast,
+                               CaptureStdOutToLog)
+from .watershed_input_manifest import (get_watershed_input_file,
+                                       get_watershed_input_manifest)
+
+# ensemble members computed together, which bounds the memory of a batch
+REGIONAL_INFLOW_BATCH_SIZE = 13
+
+#------------------------------------------------------------------------------
+#functions
+#------------------------------------------------------------------------------
+def get_regional_inflow_directory(regional_inflow_directory, rapid_input_directory):
+    """
+    Returns the directory of the prepared inflow files of a watershed
+    """
+    return os.path.join(regional_inflow_directory, rapid_input_directory)
+
+
+def get_regional_inflow_batches(ecmwf_forecasts, forecast_metadata=None,
+                                batch_size=REGIONAL_INFLOW_BATCH_SIZE):
+    """
+    Splits the ECMWF forecasts into batches of ensemble members to compute
+    together. The members of a batch have the same resolution, so they
+    share the grid and the weight table, and there are at most batch_size
+    members in a batch.
+    """
+    forecast_metadata = forecast_metadata or {}
+    resolution_forecasts = {}
+    for ecmwf_forecast in ecmwf_forecasts:
+        forecast_resolution = forecast_metadata.get(os.path.basename(ecmwf_forecast), {}).get('resolution')
+        resolution_forecasts.setdefault(str(forecast_resolution), []).append(ecmwf_forecast)
+
+    forecast_batches = []
+    for forecast_resolution, resolution_batch in sorted(resolution_forecasts.items()):
+        resolution_batch.sort(key=get_ensemble_number_from_forecast)
+        for batch_start in range(0, len(resolution_batch), batch_size):
+            forecast_batches.append(resolution_batch[batch_start:batch_start + batch_size])
+    return forecast_batches
+
+
+def generate_regional_inflow(ecmwf_forecasts, watershed_input_directories,
+                             regional_inflow_directory, forecast_metadata=None,
+                             inflow_options=None, watershed_input_manifests=None):
+    """
+    Reads each ECMWF forecast once and writes the inflow files
+    of all the watersheds
+
+    ecmwf_forecasts is a list of forecasts. The forecasts with the
+    same resolution are computed together as one ensemble batch.
+    watershed_input_directories is a dictionary of the watershed
+    input folder name to the path of the watershed input directory.
+    forecast_metadata is the metadata index of the forecast folder and
+    inflow_options are the options of CreateInflowFileFromECMWFRunoff.
+    watershed_input_manifests has the input manifest of each watershed
+    input folder name.
+    """
+    if not isinstance(ecmwf_forecasts, (list, tuple)):
+        ecmwf_forecasts = [ecmwf_forecasts]
+
+    watershed_input_manifests = dict(watershed_input_manifests or {})
+    for rapid_input_directory, watershed_input_directory in watershed_input_directories.items():
+        watershed_input_manifests[rapid_input_directory] = \
+            get_watershed_input_manifest(watershed_input_directory,
+                                         watershed_input_manifests.get(rapid_input_directory))
+
+    RAPIDinflowECMWF_tool = CreateInflowFileFromECMWFRunoff(forecast_metadata=forecast_metadata,
+                                                            **(inflow_options or {}))
+    forecast_batches = {}
+    for ecmwf_forecast in ecmwf_forecasts:
+        forecast_resolution = RAPIDinflowECMWF_tool.getForecastMetadata(ecmwf_forecast)['resolution']
+        if forecast_resolution is None:
+            raise Exception("ERROR: invalid forecast resolution ...")
+        forecast_batches.setdefault(forecast_resolution, []).append(ecmwf_forecast)
+
+    for forecast_resolution, forecast_batch in sorted(forecast_batches.items()):
+        grid_name = RAPIDinflowECMWF_tool.getGridName(forecast_batch[0],
+                                                      high_res=(forecast_resolution == "HighRes"))
+        ensemble_numbers = [get_ensemble_number_from_forecast(ecmwf_forecast)
+                            for ecmwf_forecast in forecast_batch]
+
+        watershed_inflow_list = []
+        for rapid_input_directory, watershed_input_directory in \
+                sorted(watershed_input_directories.items()):
+            try:
+                weight_table_file = get_watershed_input_file(watershed_input_directory,
+                                                             watershed_input_manifests[rapid_input_directory],
+                                                             'weight_{0}'.format(grid_name))
+            except IndexError:
+                print("WARNING: Weight table not found for {0}. Skipping ..."
+                      .format(rapid_input_directory))
+                continue
+
+            inflow_directory = get_regional_inflow_directory(regional_inflow_directory,
+                                                             rapid_input_directory)
+            try:
+                os.makedirs(inflow_directory)
+            except OSError:
+                pass
+
+            inflow_file_lists = []
+            for ensemble_number in ensemble_numbers:
+                time_interval_list, inflow_file_list = \
+                    RAPIDinflowECMWF_tool.getInflowFileNames(inflow_directory,
+                                                             forecast_resolution,
+                                                             ensemble_number)
+                inflow_file_lists.append(inflow_file_list)
+            watershed_inflow_list.append((weight_table_file, inflow_file_lists, time_interval_list))
+
+        print("INFO: Generating inflow for {0} watersheds from {1}"
+              .format(len(watershed_inflow_list), ", ".join(forecast_batch)))
+        if watershed_inflow_list:
+            RAPIDinflowECMWF_tool.executeMultipleEnsembles(forecast_batch,
+                                                           watershed_inflow_list,
+                                                           grid_name)
+
+
+def run_regional_inflow_worker(args):
+    """
+    Multiprocess worker to generate the inflow of all watersheds
+    from a batch of ECMWF forecasts
+    """
+    ecmwf_forecasts = args[0]
+    watershed_input_directories = args[1]
+    regional_inflow_directory = args[2]
+    log_file_path = args[3]
+    forecast_metadata = args[4] if len(args) > 4 else None
+    inflow_options = args[5] if len(args) > 5 else None
+    watershed_input_manifests = args[6] if len(args) > 6 else None
+
+    with CaptureStdOutToLog(log_file_path):
+        try:
+            generate_regional_inflow(ecmwf_forecasts, watershed_input_directories,
+                                     regional_inflow_directory, forecast_metadata,
+                                     inflow_options, watershed_input_manifests)
+        except Exception:
+            # the watershed jobs generate the inflow themselves
+            traceback.print_exc()
+            return None
+    return ecmwf_forecasts
@@ -11,9 +11,11 @@ import datetime
 from glob import glob
 import os
 from shutil import rmtree
+import traceback
 
 #local imports
 from .extractnested import ExtractNested, FileExtension
+from .helper_functions import get_free_space_mb
 
 """
 This section adapted from https://github.com/keepitsimple/pyFTPclient
@@ -145,12 +147,39 @@ def get_ftp_forecast_list(file_match, ftp_host, ftp_login,
     return file_list
 
 
-def remove_old_ftp_downloads(folder):
+def get_ftp_download_paths(download_dir, file_to_download):
     """
-    Remove all previous ECMWF downloads
+    Returns the local path of the downloaded archive and the
+    directory it is extracted to
     """
+    local_path = os.path.join(download_dir, file_to_download)
+    local_dir = local_path[:-1*len(FileExtension(local_path))-1]
+    return local_path, local_dir
+
+
+def get_directory_size_mb(directory):
+    """
+    Gets the size of the files in the directory in MB
+    """
+    directory_size = 0
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            try:
+                directory_size += os.path.getsize(os.path.join(root, file_name))
+            except OSError:
+                pass
+    return directory_size / (1024.0 * 1024.0)
+
+
+def remove_old_ftp_downloads(folder, keep_paths=()):
+    """
+    Remove all previous ECMWF downloads except keep_paths
+    """
+    keep_paths = [os.path.abspath(keep_path) for keep_path in keep_paths]
     all_paths = glob(os.path.join(folder,'Runoff*netcdf*'))
     for path in all_paths:
+        if os.path.abspath(path) in keep_paths:
+            continue
         if os.path.isdir(path):
             rmtree(path)
         else:
@@ -177,8 +206,7 @@ def download_and_extract_ftp(download_dir, file_to_download,
     ftp_client.ftp.quit()
     #if there is a file list and the request completed, it is a success
     if file_list:
-        local_path = os.path.join(download_dir, file_to_download)
-        local_dir = local_path[:-1*len(FileExtension(local_path))-1]
+        local_path, local_dir = get_ftp_download_paths(download_dir, file_to_download)
         #download and unzip file
         try:
             #download from ftp site
@@ -198,4 +226,122 @@ def download_and_extract_ftp(download_dir, file_to_download,
             if os.path.exists(local_path):
                 os.remove(local_path)
             raise
-        return local_dir
\ No newline at end of file
+        return local_dir
+
+
+class ForecastPrefetcher(object):
+    """
+    Downloads and extracts the forecasts in order in a background thread
+
+    While a forecast is computed, up to look_ahead of the next forecasts
+    are downloaded and extracted if the download directory has the space
+    for them (twice the size of the last extracted forecast for the
+    archive and its files, plus min_free_mb). Otherwise, the next forecast
+    is downloaded when it is needed. With remove_past_downloads, the past
+    downloads are removed when a forecast is needed, except the forecast
+    and the forecasts prefetched after it.
+    """
+    def __init__(self, download_dir, ftp_files,
+                 ftp_host, ftp_login, ftp_passwd, ftp_directory,
+                 look_ahead=1, min_free_mb=0, remove_past_downloads=True):
+        self.download_dir = download_dir
+        self.ftp_files = list(ftp_files)
+        self.ftp_args = (ftp_host, ftp_login, ftp_passwd, ftp_directory)
+        self.look_ahead = look_ahead
+        self.min_free_mb = min_free_mb
+        self.remove_past_downloads = remove_past_downloads
+        # size of the last extracted forecast
+        self.forecast_mb = None
+        # index of the forecast being computed
+        self.current_index = -1
+        self.results = {}
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def canDownload(self, file_index):
+        """
+        Returns True if the forecast can be downloaded now.
+        Called with the condition acquired.
+        """
+        if file_index <= self.current_index:
+            return True
+        if file_index > self.current_index + self.look_ahead:
+            return False
+        if self.forecast_mb is None:
+            return True
+        free_space_mb = get_free_space_mb(self.download_dir)
+        return free_space_mb is None or free_space_mb >= 2 * self.forecast_mb + self.min_free_mb
+
+    def run(self):
+        """
+        Downloads the forecasts in order in the background thread
+        """
+        for file_index, ftp_file in enumerate(self.ftp_files):
+            with self.condition:
+                while not self.stopped and not self.canDownload(file_index):
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                if file_index > self.current_index:
+                    print("Prefetching forecast: {0}".format(ftp_file))
+            try:
+                local_dir = download_and_extract_ftp(self.download_dir, ftp_file,
+                                                     *self.ftp_args,
+                                                     remove_past_downloads=False)
+                result = (True, local_dir)
+            except Exception:
+                result = (False, traceback.format_exc())
+            with self.condition:
+                if result[0] and result[1] is not None:
+                    self.forecast_mb = get_directory_size_mb(result[1])
+                self.results[file_index] = result
+                self.condition.notify_all()
+            if not result[0]:
+                return
+
+    def getDownloadPaths(self):
+        """
+        Returns the local paths of the forecast being computed and the
+        forecasts that can be prefetched after it
+        """
+        download_paths = []
+        for file_index in range(max(self.current_index, 0),
+                                min(self.current_index + self.look_ahead + 1, len(self.ftp_files))):
+            download_paths.extend(get_ftp_download_paths(self.download_dir, self.ftp_files[file_index]))
+        return download_paths
+
+    def get(self, file_index):
+        """
+        Returns the extracted directory of the forecast after it is
+        downloaded. The forecasts before it are done.
+        """
+        with self.condition:
+            self.current_index = file_index
+            keep_paths = self.getDownloadPaths()
+        # the background thread only downloads the forecasts kept,
+        # so it can continue while the past downloads are removed
+        if self.remove_past_downloads:
+            remove_old_ftp_downloads(self.download_dir, keep_paths=keep_paths)
+        with self.condition:
+            self.condition.notify_all()
+            while file_index not in self.results:
+                if not self.thread.is_alive():
+                    raise Exception("ERROR: Forecast download stopped before {0} ..."
+                                    .format(self.ftp_files[file_index]))
+                self.condition.wait(1)
+            success, result = self.results.pop(file_index)
+        if not success:
+            raise Exception(result)
+        return result
+
+    def close(self):
+        """
+        Stops prefetching after the current download
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
@@ -10,8 +10,13 @@ import datetime
 from glob import glob
 import os
 import re
-from shutil import rmtree
+from shutil import copyfile, rmtree
 import sys
+try:
+    import resource
+    RESOURCE_ENABLED = True
+except ImportError:
+    RESOURCE_ENABLED = False
 
 
 # ----------------------------------------------------------------------------------------
@@ -96,6 +101,26 @@ def clean_logs(condor_log_directory, main_log_directory, prepend="rapid_", log_f
     clean_main_logs(main_log_directory, prepend, log_file_path)
 
 
+def clean_job_directories(job_parent_directories, forecast_date_timestep):
+    """
+    Removes the job directories of other forecast cycles left by a run
+    that stopped (e.g. in a staging directory on a RAM disk). The job
+    directories of the forecast cycle are kept to continue the jobs.
+    """
+    for job_parent_directory in job_parent_directories:
+        try:
+            directory_list = os.listdir(job_parent_directory)
+        except OSError:
+            continue
+        for directory in directory_list:
+            job_match = re.match(r"job_(\d{8}\.\d+)_", directory)
+            job_directory = os.path.join(job_parent_directory, directory)
+            if job_match and job_match.group(1) != forecast_date_timestep \
+                    and os.path.isdir(job_directory):
+                print("INFO: Removing {0} of a previous run ...".format(job_directory))
+                rmtree(job_directory, ignore_errors=True)
+
+
 def find_current_rapid_output(forecast_directory, watershed, subbasin):
     """
     Finds the most current files output from RAPID
@@ -109,6 +134,110 @@ def find_current_rapid_output(forecast_directory, watershed, subbasin):
     return None
 
 
+def get_free_space_mb(directory):
+    """
+    Gets the free space available in the directory in MB.
+    Returns None if it is not available.
+    """
+    try:
+        file_system_stat = os.statvfs(directory)
+    except (AttributeError, OSError):
+        return None
+    return file_system_stat.f_bavail * file_system_stat.f_frsize / (1024.0 * 1024.0)
+
+
+def is_memory_file_system(directory):
+    """
+    Returns True if the directory is on a file system kept in memory
+    (e.g. /dev/shm). Returns False if it is not known (Linux only).
+    """
+    directory = os.path.realpath(directory)
+    mount_type = None
+    mount_point_length = -1
+    try:
+        with open("/proc/mounts") as mounts_file:
+            for mount_line in mounts_file:
+                mount_fields = mount_line.split()
+                if len(mount_fields) < 3:
+                    continue
+                mount_point = mount_fields[1]
+                if (directory == mount_point or
+                        directory.startswith(mount_point.rstrip("/") + "/")) \
+                        and len(mount_point) > mount_point_length:
+                    mount_type = mount_fields[2]
+                    mount_point_length = len(mount_point)
+    except (IOError, OSError):
+        return False
+    return mount_type in ("tmpfs", "ramfs")
+
+
+def get_staging_directory(execute_directory, job_name, required_mb, staging_directories=()):
+    """
+    Creates the directory for the intermediate files of a job in the first
+    staging directory (e.g. /dev/shm or node local scratch) with the space
+    required and falls back to the execute directory
+    """
+    for staging_directory in staging_directories:
+        free_space_mb = get_free_space_mb(staging_directory)
+        if free_space_mb is None or free_space_mb < required_mb:
+            continue
+        job_directory = os.path.join(staging_directory, job_name)
+        try:
+            os.makedirs(job_directory)
+        except OSError:
+            if not os.path.isdir(job_directory):
+                continue
+        return job_directory
+
+    job_directory = os.path.join(execute_directory, job_name)
+    try:
+        os.mkdir(job_directory)
+    except OSError:
+        pass
+    return job_directory
+
+
+def publish_file(source_file, destination_file):
+    """
+    Moves the file to the destination so the destination is never
+    a partial file. On another file system, the file is copied to a
+    temporary file next to the destination and renamed.
+    """
+    try:
+        os.rename(source_file, destination_file)
+        return
+    except OSError:
+        pass
+
+    temp_destination_file = os.path.join(os.path.dirname(os.path.abspath(destination_file)),
+                                         ".{0}.tmp".format(os.path.basename(destination_file)))
+    try:
+        copyfile(source_file, temp_destination_file)
+        os.rename(temp_destination_file, destination_file)
+    except Exception:
+        try:
+            os.remove(temp_destination_file)
+        except OSError:
+            pass
+        raise
+    os.remove(source_file)
+
+
+def drop_file_cache(file_path):
+    """
+    Writes the file to disk and drops it from the page cache so the
+    next read of the file comes from the file system. Where the page
+    cache cannot be dropped (e.g. python 2), the file is only written.
+    """
+    file_descriptor = os.open(file_path, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(file_descriptor)
+
+
 def get_valid_watershed_list(input_directory):
     """
     Get a list of folders formatted correctly for watershed-subbasin
@@ -164,6 +293,62 @@ def get_ensemble_number_from_forecast(forecast_name):
     return ensemble_number
 
 
+def get_peak_memory_mb(children=False):
+    """
+    Gets the peak memory used by the process in MB. With children=True,
+    it is the peak memory of the largest finished child process (e.g. RAPID).
+    Returns None if it is not available on the platform.
+    """
+    if not RESOURCE_ENABLED:
+        return None
+    peak_memory = resource.getrusage(resource.RUSAGE_CHILDREN if children
+                                     else resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes on mac, kilobytes elsewhere
+        return peak_memory / (1024.0 * 1024.0)
+    return peak_memory / 1024.0
+
+
+def reset_peak_memory():
+    """
+    Resets the peak memory of the process so get_stage_peak_memory_mb
+    returns the peak from now on. Returns False if it is not available
+    on the platform (Linux only).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def get_stage_peak_memory_mb():
+    """
+    Gets the peak memory used by the process since reset_peak_memory in MB.
+    Returns None if it is not available on the platform (Linux only).
+    """
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def get_total_memory_mb():
+    """
+    Gets the physical memory of the machine in MB.
+    Returns None if it is not available on the platform.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024.0 * 1024.0)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
 def get_watershed_subbasin_from_folder(folder_name):
     """
     Get's the watershed & subbasin name from folder
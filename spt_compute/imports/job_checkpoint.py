@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+##
+##  job_checkpoint.py
+##  spt_compute
+##
+##  License: BSD 3-Clause
+
+import json
+import os
+
+#local imports
+from .rapid_qout_merge import get_qout_shape, is_valid_qout_file
+
+JOB_CHECKPOINT_VERSION = 2
+
+#------------------------------------------------------------------------------
+#functions
+#------------------------------------------------------------------------------
+class JobCheckpoint(object):
+    """
+    Stages of a job completed in the job directory
+
+    Each completed stage is stored in checkpoint.json with the size of the
+    files it made and the time steps and rivers of its netCDF files (the
+    inflow and Qout files). When a job is run again in the same directory,
+    the stages are valid if their files were not changed since and the
+    netCDF files have flow for every time step and river, and the job
+    continues after the last valid stage. A stage is invalid with all of
+    the stages after it. The checkpoint is reset if the job is different
+    (e.g. another forecast or initial flow file).
+    """
+    def __init__(self, job_directory, job_key):
+        self.checkpoint_file = os.path.join(job_directory, "checkpoint.json")
+        self.job_key = job_key
+        self.stages = []
+        try:
+            with open(self.checkpoint_file) as checkpoint_json:
+                checkpoint = json.load(checkpoint_json)
+        except (IOError, OSError, ValueError):
+            return
+        if checkpoint.get('version') == JOB_CHECKPOINT_VERSION \
+                and checkpoint.get('job_key') == job_key:
+            self.stages = checkpoint['stages']
+            self.validateStages()
+
+    def validateStages(self):
+        """
+        Removes the stages with files that were changed or removed
+        and all of the stages after them
+        """
+        # the size and shape of each file from the last stage that wrote it
+        expected_files = {}
+        for stage_index, stage in enumerate(self.stages):
+            for stage_file, file_size in stage['files'].items():
+                expected_files[stage_file] = (stage_index, file_size,
+                                              stage['netcdf_shapes'].get(stage_file))
+            for removed_file in stage['removed_files']:
+                expected_files.pop(removed_file, None)
+
+        num_valid_stages = len(self.stages)
+        for stage_file, (stage_index, file_size, netcdf_shape) in expected_files.items():
+            if stage_index >= num_valid_stages:
+                continue
+            if not os.path.exists(stage_file) or os.path.getsize(stage_file) != file_size \
+                    or (netcdf_shape is not None and not is_valid_qout_file(stage_file, *netcdf_shape)):
+                num_valid_stages = stage_index
+        if num_valid_stages < len(self.stages):
+            print("INFO: Stages from {0} of the previous run are not valid ..."
+                  .format(self.stages[num_valid_stages]['name']))
+            del self.stages[num_valid_stages:]
+
+    def getStage(self, stage_name):
+        """
+        Returns the completed stage or None
+        """
+        return next((stage for stage in self.stages if stage['name'] == stage_name), None)
+
+    def isComplete(self, stage_name):
+        """
+        Returns True if the stage was completed
+        """
+        return self.getStage(stage_name) is not None
+
+    def getFiles(self, stage_name):
+        """
+        Returns the files made by the completed stage in order
+        """
+        return self.getStage(stage_name)['file_list']
+
+    def complete(self, stage_name, stage_files, removed_files=()):
+        """
+        Stores the stage as complete with the files it made
+        and the files it removed
+        """
+        netcdf_shapes = {}
+        for stage_file in stage_files:
+            if stage_file.endswith(".nc"):
+                netcdf_shape = get_qout_shape(stage_file)
+                if netcdf_shape is not None:
+                    netcdf_shapes[stage_file] = netcdf_shape
+        self.stages = [stage for stage in self.stages if stage['name'] != stage_name]
+        self.stages.append({
+            'name': stage_name,
+            'file_list': list(stage_files),
+            'files': dict((stage_file, os.path.getsize(stage_file)) for stage_file in stage_files),
+            'netcdf_shapes': netcdf_shapes,
+            'removed_files': list(removed_files),
+        })
+        self.write()
+
+    def write(self):
+        """
+        Writes the checkpoint file
+        """
+        temp_checkpoint_file = "{0}.tmp".format(self.checkpoint_file)
+        with open(temp_checkpoint_file, 'w') as checkpoint_json:
+            json.dump({'version': JOB_CHECKPOINT_VERSION,
+                       'job_key': self.job_key,
+                       'stages': self.stages},
+                      checkpoint_json, indent=2, sort_keys=True)
+        os.rename(temp_checkpoint_file, self.checkpoint_file)
+
+    def remove(self):
+        """
+        Removes the checkpoint file
+        """
+        self.stages = []
+        try:
+            os.remove(self.checkpoint_file)
+        except OSError:
+            pass
@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+##
+##  job_executors.py
+##  spt_compute
+##
+##  License: BSD 3-Clause
+
+from collections import OrderedDict
+import heapq
+from multiprocessing import cpu_count
+import os
+from shutil import copy2, copytree, move, rmtree
+import subprocess
+import sys
+import tempfile
+import time
+from traceback import format_exc
+
+try:
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor
+    from concurrent.futures import wait as futures_wait
+
+    FUTURES_ENABLED = True
+except ImportError:
+    FUTURES_ENABLED = False
+    pass
+try:
+    from condorpy import Job as CJob
+    from condorpy import Templates as tmplt
+
+    CONDOR_ENABLED = True
+except ImportError:
+    CONDOR_ENABLED = False
+    pass
+
+#local imports
+from .worker_pool import AffinityWorkerPool
+
+JOB_EXECUTOR_MODES = ('htcondor', 'multiprocess', 'futures', 'serial', 'local_condor')
+# JobStatus of the HTCondor jobs
+CONDOR_JOB_STATUS = {1: 'Idle', 2: 'Running', 3: 'Removed', 4: 'Completed',
+                     5: 'Held', 6: 'Transferring Output', 7: 'Suspended'}
+
+#------------------------------------------------------------------------------
+#functions
+#------------------------------------------------------------------------------
+def get_condor_job_status(cluster_ids):
+    """
+    Returns the HTCondor JobStatus of the clusters with one condor_q call
+    for the jobs in the queue and one condor_history call for the jobs
+    that left it. The clusters not found are missing from the result.
+    Raises OSError or CalledProcessError if HTCondor cannot be queried.
+    """
+    cluster_status = {}
+    for condor_command in ("condor_q", "condor_history"):
+        query_cluster_ids = [str(cluster_id) for cluster_id in cluster_ids
+                             if int(cluster_id) not in cluster_status]
+        if not query_cluster_ids:
+            break
+        command_arguments = [condor_command] + query_cluster_ids + ["-af", "ClusterId", "JobStatus"]
+        if condor_command == "condor_history":
+            # stop reading the history when all of the clusters are found
+            command_arguments += ["-match", str(len(query_cluster_ids))]
+        condor_output = subprocess.check_output(command_arguments, universal_newlines=True)
+        for status_line in condor_output.splitlines():
+            status_fields = status_line.split()
+            if len(status_fields) == 2 and status_fields[1].isdigit():
+                cluster_status[int(status_fields[0])] = int(status_fields[1])
+    return cluster_status
+
+
+class JobError(Exception):
+    """
+    Failure of a job with the id of the job, so the
+    other jobs of the executor keep running
+    """
+    def __init__(self, job_id, error):
+        super(JobError, self).__init__(error)
+        self.job_id = job_id
+
+
+class JobExecutor(object):
+    """
+    Runs the watershed jobs of a forecast cycle
+
+    A job is a dictionary with:
+        function, args -- the worker function run with the arguments
+        htcondor -- job_name, executable, arguments, transfer_input_files,
+                    transfer_output_remaps and initialdir of the job
+                    for the executors with file transfer
+        affinity_key, memory_mb, predicted_seconds -- resource hints
+    Each executor uses the parts of the job it supports.
+    """
+    # number of jobs run at the same time, None if unknown
+    processes = None
+    # the job inputs are transferred to the node by the executor
+    transfers_files = False
+
+    def submit(self, job_id, job, priority=0):
+        """
+        Submits the job to run. The pending jobs with the
+        largest priority start first where supported.
+        """
+        raise NotImplementedError
+
+    def numPending(self):
+        """
+        Returns the number of submitted jobs that were not returned by waitAny
+        """
+        raise NotImplementedError
+
+    def waitAny(self, timeout=None):
+        """
+        Waits for a submitted job to finish and returns its id.
+        Returns None if no job finished within timeout seconds.
+        Raises a JobError with the id of the job if the job failed.
+        Other exceptions mean the executor cannot run the jobs.
+        """
+        raise NotImplementedError
+
+    def cancel(self):
+        """
+        Cancels the submitted jobs that did not finish
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases the resources of the executor
+        """
+        pass
+
+    def asCompleted(self):
+        """
+        Yields the id of each submitted job as it finishes
+        """
+        while self.numPending():
+            yield self.waitAny()
+
+
+class SerialExecutor(JobExecutor):
+    """
+    Runs the jobs one at a time in this process for debugging
+    """
+    processes = 1
+
+    def __init__(self):
+        # (-priority, submit index, job id, job) of the jobs in the order they run
+        self.jobs = []
+        self.num_submitted = 0
+
+    def submit(self, job_id, job, priority=0):
+        heapq.heappush(self.jobs, (-priority, self.num_submitted, job_id, job))
+        self.num_submitted += 1
+
+    def numPending(self):
+        return len(self.jobs)
+
+    def waitAny(self, timeout=None):
+        # the next job runs in this process, so it does not time out
+        job_id, job = heapq.heappop(self.jobs)[2:]
+        try:
+            job['function'](job['args'])
+        except Exception:
+            raise JobError(job_id, format_exc())
+        return job_id
+
+    def cancel(self):
+        del self.jobs[:]
+
+
+class MultiprocessExecutor(JobExecutor):
+    """
+    Runs the jobs on an AffinityWorkerPool with the affinity and memory
+    hints of the jobs. The pool is kept by the caller for the run.
+    """
+    def __init__(self, worker_pool):
+        self.worker_pool = worker_pool
+        self.processes = worker_pool.processes
+        self.task_job_ids = {}
+
+    def submit(self, job_id, job, priority=0):
+        task_id = self.worker_pool.submit(job['function'], job['args'],
+                                          affinity_key=job.get('affinity_key'),
+                                          memory_mb=job.get('memory_mb'),
+                                          priority=priority)
+        self.task_job_ids[task_id] = job_id
+
+    def numPending(self):
+        return len(self.task_job_ids)
+
+    def waitAny(self, timeout=None):
+        finished_task = self.worker_pool.waitAny(timeout)
+        if finished_task is None:
+            return None
+        task_id, success, result = finished_task
+        job_id = self.task_job_ids.pop(task_id)
+        if not success:
+            raise JobError(job_id, result)
+        return job_id
+
+    def cancel(self):
+        self.worker_pool.cancel()
+        self.task_job_ids.clear()
+
+
+class FuturesExecutor(JobExecutor):
+    """
+    Runs the jobs on a concurrent.futures process pool. The
+    jobs start in the order submitted.
+    """
+    def __init__(self, max_workers=None):
+        if not FUTURES_ENABLED:
+            raise ImportError("concurrent.futures is not available. "
+                              "Please install futures to use the 'futures' option.")
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.processes = getattr(self.executor, '_max_workers', max_workers)
+        self.futures = OrderedDict()
+
+    def submit(self, job_id, job, priority=0):
+        self.futures[self.executor.submit(job['function'], job['args'])] = job_id
+
+    def numPending(self):
+        return len(self.futures)
+
+    def waitAny(self, timeout=None):
+        done_futures = futures_wait(list(self.futures), timeout=timeout, return_when=FIRST_COMPLETED)[0]
+        if not done_futures:
+            return None
+        # the first submitted of the finished jobs
+        future = next(future for future in self.futures if future in done_futures)
+        job_id = self.futures.pop(future)
+        try:
+            future.result()
+        except Exception:
+            raise JobError(job_id, format_exc())
+        return job_id
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+        self.futures.clear()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class HTCondorExecutor(JobExecutor):
+    """
+    Submits the jobs to HTCondor
+
+    The status of all of the submitted jobs is queried every poll_seconds
+    with one condor_q and one condor_history call. A held or removed job
+    fails. If HTCondor cannot be queried, the jobs are queried again at
+    the next poll. The priority of a job is its HTCondor job priority.
+    """
+    transfers_files = True
+
+    def __init__(self, poll_seconds=30):
+        if not CONDOR_ENABLED:
+            raise ImportError("condorpy is not installed. Please install condorpy to use the 'htcondor' option.")
+        self.poll_seconds = poll_seconds
+        self.condor_jobs = OrderedDict()
+        # JobStatus of the clusters at the last query
+        self.cluster_status = {}
+        self.next_query_time = 0
+
+    def submit(self, job_id, job, priority=0):
+        htcondor_job = job['htcondor']
+        condor_job = CJob(htcondor_job['job_name'], tmplt.vanilla_transfer_files)
+        condor_job.set('executable', htcondor_job['executable'])
+        condor_job.set('transfer_input_files', ", ".join(htcondor_job['transfer_input_files']))
+        condor_job.set('initialdir', htcondor_job['initialdir'])
+        condor_job.set('arguments', " ".join(str(argument) for argument in htcondor_job['arguments']))
+        condor_job.set('transfer_output_remaps',
+                       "\"%s\"" % "; ".join("%s = %s" % output_remap for output_remap in
+                                           htcondor_job['transfer_output_remaps'].items()))
+        condor_job.set('priority', int(priority))
+        condor_job.submit()
+        self.condor_jobs[job_id] = condor_job
+
+    def numPending(self):
+        return len(self.condor_jobs)
+
+    def waitAny(self, timeout=None):
+        wait_end_time = None if timeout is None else time.time() + timeout
+        while True:
+            for job_id, condor_job in list(self.condor_jobs.items()):
+                job_status = CONDOR_JOB_STATUS.get(self.cluster_status.get(int(condor_job.cluster_id)))
+                if job_status == 'Completed':
+                    del self.condor_jobs[job_id]
+                    return job_id
+                if job_status in ('Held', 'Removed'):
+                    del self.condor_jobs[job_id]
+                    if job_status == 'Held':
+                        condor_job.remove()
+                    raise JobError(job_id, "ERROR: HTCondor job {0} was {1} ...".format(condor_job.name,
+                                                                                     job_status.lower()))
+            query_time = time.time()
+            if query_time >= self.next_query_time:
+                self.next_query_time = query_time + self.poll_seconds
+                try:
+                    self.cluster_status = get_condor_job_status([condor_job.cluster_id
+                                                                 for condor_job in self.condor_jobs.values()])
+                except (OSError, subprocess.CalledProcessError) as ex:
+                    print("WARNING: Could not query the status of the HTCondor jobs: {0}. "
+                          "Trying again in {1} seconds ...".format(ex, self.poll_seconds))
+                continue
+            if wait_end_time is not None and query_time >= wait_end_time:
+                return None
+            sleep_end_time = self.next_query_time if wait_end_time is None \
+                else min(self.next_query_time, wait_end_time)
+            time.sleep(sleep_end_time - query_time)
+
+    def cancel(self):
+        for condor_job in self.condor_jobs.values():
+            condor_job.remove()
+        self.condor_jobs.clear()
+
+
+class LocalCondorExecutor(JobExecutor):
+    """
+    Local scheduler with the file transfer of HTCondor to test the
+    jobs and their scheduling without a Condor pool
+
+    Each job runs in a new node directory with a copy of its executable
+    and input files and directories. The files made or changed in the
+    node directory are moved back to the initial directory of the job or
+    to their output remaps, then the node directory is removed. The
+    pending jobs with the largest priority start first.
+    """
+    transfers_files = True
+
+    def __init__(self, processes=1, scratch_directory=None, poll_seconds=0.1):
+        self.processes = processes
+        self.scratch_directory = scratch_directory
+        self.poll_seconds = poll_seconds
+        # (-priority, submit index, job id, job) of the jobs in the order they start
+        self.pending_jobs = []
+        self.num_submitted = 0
+        self.running_jobs = OrderedDict()
+
+    def getLogFile(self, htcondor_job):
+        """
+        Returns the file with the output of the job
+        """
+        return os.path.join(htcondor_job['initialdir'], "{0}.out".format(htcondor_job['job_name']))
+
+    def startJob(self, job_id, htcondor_job):
+        """
+        Transfers the inputs of the job to a node directory and starts it
+        """
+        node_directory = tempfile.mkdtemp(prefix="condor_node_", dir=self.scratch_directory)
+        for input_path in [htcondor_job['executable']] + list(htcondor_job['transfer_input_files']):
+            input_path = input_path.rstrip(os.sep)
+            node_path = os.path.join(node_directory, os.path.basename(input_path))
+            if os.path.isdir(input_path):
+                copytree(input_path, node_path)
+            else:
+                copy2(input_path, node_path)
+        input_files = dict((file_name, os.path.getmtime(os.path.join(node_directory, file_name)))
+                           for file_name in os.listdir(node_directory))
+
+        log_file = open(self.getLogFile(htcondor_job), 'w')
+        process = subprocess.Popen([sys.executable,
+                                    os.path.join(node_directory,
+                                                 os.path.basename(htcondor_job['executable']))] +
+                                   [str(argument) for argument in htcondor_job['arguments']],
+                                   cwd=node_directory, stdout=log_file, stderr=subprocess.STDOUT)
+        self.running_jobs[job_id] = (process, log_file, node_directory, input_files, htcondor_job)
+
+    def finishJob(self, job_id):
+        """
+        Transfers the outputs of the finished job and removes its node directory
+        """
+        process, log_file, node_directory, input_files, htcondor_job = self.running_jobs.pop(job_id)
+        log_file.close()
+        for file_name in os.listdir(node_directory):
+            node_file = os.path.join(node_directory, file_name)
+            if not os.path.isfile(node_file) or \
+                    input_files.get(file_name) == os.path.getmtime(node_file):
+                continue
+            move(node_file, htcondor_job['transfer_output_remaps'].get(
+                file_name, os.path.join(htcondor_job['initialdir'], file_name)))
+        rmtree(node_directory, ignore_errors=True)
+        if process.returncode != 0:
+            print("WARNING: Job {0} exited with code {1}. See {2} ..."
+                  .format(htcondor_job['job_name'], process.returncode, self.getLogFile(htcondor_job)))
+
+    def startJobs(self):
+        """
+        Starts the pending jobs on the free processes
+        """
+        while self.pending_jobs and len(self.running_jobs) < self.processes:
+            self.startJob(*heapq.heappop(self.pending_jobs)[2:])
+
+    def submit(self, job_id, job, priority=0):
+        heapq.heappush(self.pending_jobs, (-priority, self.num_submitted, job_id, job['htcondor']))
+        self.num_submitted += 1
+        self.startJobs()
+
+    def numPending(self):
+        return len(self.pending_jobs) + len(self.running_jobs)
+
+    def waitAny(self, timeout=None):
+        wait_end_time = None if timeout is None else time.time() + timeout
+        while True:
+            for job_id, running_job in self.running_jobs.items():
+                if running_job[0].poll() is not None:
+                    self.finishJob(job_id)
+                    self.startJobs()
+                    return job_id
+            if wait_end_time is not None and time.time() >= wait_end_time:
+                return None
+            time.sleep(self.poll_seconds)
+
+    def cancel(self):
+        del self.pending_jobs[:]
+        for job_id, running_job in list(self.running_jobs.items()):
+            running_job[0].kill()
+            running_job[0].wait()
+            self.finishJob(job_id)
+
+
+def get_job_executor_processes(mp_mode, processes=None):
+    """
+    Returns the number of jobs the executor of the mode runs at the same
+    time without starting it (e.g. for a dry run), None if unknown
+    """
+    if mp_mode == "htcondor":
+        return None
+    elif mp_mode == "serial":
+        return SerialExecutor.processes
+    return processes or cpu_count()
+
+
+def get_job_executor(mp_mode, worker_pool=None, processes=None, scratch_directory=None):
+    """
+    Returns the executor of the jobs for the mode
+    """
+    if mp_mode == "htcondor":
+        return HTCondorExecutor()
+    elif mp_mode == "multiprocess":
+        return MultiprocessExecutor(worker_pool or AffinityWorkerPool(processes))
+    elif mp_mode == "futures":
+        return FuturesExecutor(processes)
+    elif mp_mode == "serial":
+        return SerialExecutor()
+    elif mp_mode == "local_condor":
+        return LocalCondorExecutor(processes or cpu_count(), scratch_directory)
+    raise Exception("ERROR: Invalid mp_mode. Valid types are {0} ...".format(", ".join(JOB_EXECUTOR_MODES)))
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+##
+##  job_scheduler.py
+##  spt_compute
+##
+##  License: BSD 3-Clause
+
+import heapq
+import json
+import os
+
+#local imports
+from .rapid_qout_merge import QOUT_TIME_LENGTH
+
+JOB_COST_HISTORY_VERSION = 1
+# runtime of a river time step before the jobs have a history
+DEFAULT_SECONDS_PER_COST = 1e-4
+# number of forecast cycles remembered to learn each cycle once
+NUM_LEARNED_CYCLES = 100
+# memory of a job before the jobs have a history: the worker process,
+# the RAPID arrays of each reach and the inflow arrays of each time step
+JOB_BASE_MEMORY_MB = 200
+RAPID_BYTES_PER_REACH = 4096
+
+#------------------------------------------------------------------------------
+#functions
+#------------------------------------------------------------------------------
+def estimate_job_cost(num_rivers, forecast_resolution):
+    """
+    Estimates the relative cost of a watershed job from the number of
+    river time steps RAPID computes. A forecast with an unknown
+    resolution is assumed to be high resolution.
+    """
+    time_length = QOUT_TIME_LENGTH.get(forecast_resolution,
+                                       QOUT_TIME_LENGTH['HighRes'])
+    return (num_rivers or 1) * time_length
+
+
+def get_weight_table_extent(weight_table):
+    """
+    Returns the size of the runoff bounding box and the number of
+    runoff cells of a compiled weight table
+    """
+    lat_ind_all = weight_table['cell_lat_index']
+    lon_ind_all = weight_table['cell_lon_index']
+    if not lat_ind_all.size:
+        return 0, 0
+    size_bbox = (lat_ind_all.max() - lat_ind_all.min() + 1) * \
+                (lon_ind_all.max() - lon_ind_all.min() + 1)
+    return int(size_bbox), int(lat_ind_all.size)
+
+
+def estimate_job_memory_mb(num_reaches, forecast_resolution,
+                           weight_table_extent=None, inflow_memory_limit_mb=None):
+    """
+    Estimates the peak memory of a watershed job in MB from the reaches
+    routed by RAPID and the runoff bounding box read for the inflow
+    (see CreateInflowFileFromECMWFRunoff.getTimeBlockSize)
+    """
+    num_reaches = num_reaches or 0
+    size_bbox, num_cells = weight_table_extent or (0, 0)
+    time_length = QOUT_TIME_LENGTH.get(forecast_resolution,
+                                       QOUT_TIME_LENGTH['HighRes'])
+    inflow_mb = time_length * (4 * size_bbox + (8 + 1 + 8) * num_cells + 8 * num_reaches) / (1024.0 * 1024.0)
+    if inflow_memory_limit_mb is not None:
+        inflow_mb = min(inflow_mb, inflow_memory_limit_mb)
+    return JOB_BASE_MEMORY_MB + RAPID_BYTES_PER_REACH * num_reaches / (1024.0 * 1024.0) + inflow_mb
+
+
+
+def estimate_regional_inflow_memory_mb(num_members, forecast_resolution, weight_table_extents,
+                                       inflow_precision="float64", inflow_memory_limit_mb=None):
+    """
+    Estimates the peak memory of a regional inflow batch in MB from the
+    ensemble members, the time steps and the runoff cells of the
+    watersheds read together (see
+    CreateInflowFileFromECMWFRunoff.executeMultipleEnsembles)
+    """
+    # the cells of the watersheds are an upper bound of their union
+    num_cells = sum(num_cells for _, num_cells in weight_table_extents)
+    time_length = QOUT_TIME_LENGTH.get(forecast_resolution,
+                                       QOUT_TIME_LENGTH['HighRes'])
+    dtype_bytes = 4 if inflow_precision == "float32" else 8
+    inflow_mb = num_members * time_length * num_cells * dtype_bytes / (1024.0 * 1024.0)
+    if inflow_memory_limit_mb is not None:
+        inflow_mb = min(inflow_mb, inflow_memory_limit_mb)
+    return JOB_BASE_MEMORY_MB + inflow_mb
+
+def order_longest_job_first(jobs, job_cost):
+    """
+    Orders the jobs of all of the watersheds by the cost, largest first,
+    so the long jobs do not start last and leave the other cpus idle.
+    Jobs with the same cost keep their order.
+    """
+    return sorted(jobs, key=job_cost, reverse=True)
+
+
+class JobCostModel(object):
+    """
+    Predicts the runtime of the watershed jobs
+
+    A job is predicted to take the mean measured runtime of the jobs of
+    the watershed with the same forecast resolution. Otherwise, the cost of
+    the job (rivers x time steps) is converted to seconds with the measured
+    seconds per cost of the watershed, of all of the watersheds, or a
+    default rate if there is no history. The history is updated from the
+    job stats of each forecast cycle and kept in a JSON file.
+    """
+    def __init__(self, history_file=None, history_weight=0.3):
+        self.history_file = history_file
+        # weight of a new runtime in the moving mean of the runtimes
+        self.history_weight = history_weight
+        # watershed -> forecast resolution -> mean seconds and cost of the jobs
+        self.history = {}
+        self.learned_cycles = []
+        if not history_file:
+            return
+        try:
+            with open(history_file) as history_json:
+                history = json.load(history_json)
+        except (IOError, OSError, ValueError):
+            return
+        if history.get('version') == JOB_COST_HISTORY_VERSION:
+            self.history = history['watersheds']
+            self.learned_cycles = history['learned_cycles']
+
+    def getSecondsPerCost(self, watershed_key=None):
+        """
+        Returns the measured seconds per cost of the watershed, or of
+        all of the watersheds if watershed_key is None
+        """
+        if watershed_key is None:
+            job_histories = [job_history for watershed_history in self.history.values()
+                             for job_history in watershed_history.values()]
+        else:
+            job_histories = list(self.history.get(watershed_key, {}).values())
+        total_cost = sum(job_history['cost'] for job_history in job_histories)
+        if not total_cost:
+            return None
+        return sum(job_history['seconds'] for job_history in job_histories) / float(total_cost)
+
+    def predictSeconds(self, watershed_key, num_rivers, forecast_resolution):
+        """
+        Predicts the runtime of a job in seconds
+        """
+        job_history = self.history.get(watershed_key, {}).get(str(forecast_resolution))
+        if job_history is not None:
+            return job_history['seconds']
+        seconds_per_cost = self.getSecondsPerCost(watershed_key)
+        if seconds_per_cost is None:
+            seconds_per_cost = self.getSecondsPerCost()
+        if seconds_per_cost is None:
+            seconds_per_cost = DEFAULT_SECONDS_PER_COST
+        return seconds_per_cost * estimate_job_cost(num_rivers, forecast_resolution)
+
+    def predictMemoryMB(self, watershed_key, forecast_resolution, estimated_memory_mb):
+        """
+        Predicts the peak memory of a job in MB: the measured peak of the
+        worker and of RAPID. The estimate is used if the memory of the
+        worker was not measured and as the lower bound if the memory of
+        RAPID was not measured.
+        """
+        job_history = self.history.get(watershed_key, {}).get(str(forecast_resolution))
+        if job_history is None or job_history.get('peak_memory_mb') is None:
+            return estimated_memory_mb
+        if job_history.get('peak_child_memory_mb') is None:
+            return max(job_history['peak_memory_mb'], estimated_memory_mb)
+        return job_history['peak_memory_mb'] + job_history['peak_child_memory_mb']
+
+    def addJobRuntime(self, watershed_key, forecast_resolution, cost, seconds,
+                      peak_memory_mb=None, peak_child_memory_mb=None):
+        """
+        Adds the measured runtime and peak memory of a job to the history
+        """
+        watershed_history = self.history.setdefault(watershed_key, {})
+        job_history = watershed_history.get(str(forecast_resolution))
+        if job_history is None:
+            watershed_history[str(forecast_resolution)] = {'seconds': seconds, 'cost': cost, 'jobs': 1,
+                                                           'peak_memory_mb': peak_memory_mb,
+                                                           'peak_child_memory_mb': peak_child_memory_mb}
+            return
+        job_history['seconds'] += self.history_weight * (seconds - job_history['seconds'])
+        job_history['cost'] = cost
+        job_history['jobs'] += 1
+        for memory_key, memory_mb in (('peak_memory_mb', peak_memory_mb),
+                                      ('peak_child_memory_mb', peak_child_memory_mb)):
+            if memory_mb is None:
+                continue
+            if job_history.get(memory_key) is None:
+                job_history[memory_key] = memory_mb
+            else:
+                job_history[memory_key] += self.history_weight * (memory_mb - job_history[memory_key])
+
+    def learnForecastCycle(self, forecast_date_timestep, job_stats_records, cycle_jobs):
+        """
+        Adds the runtime and peak memory of the successful jobs of a
+        forecast cycle from the job stats. cycle_jobs maps the job name to
+        the watershed key, forecast resolution and cost of the job. A cycle
+        is learned once. The peak memory of a job is the largest peak of
+        the worker in a stage of the job, without the watershed state the
+        worker kept from previous jobs, and the peak of RAPID if it was
+        measured (see JobStats).
+        """
+        if forecast_date_timestep in self.learned_cycles:
+            return
+        job_seconds = {}
+        job_peak_memory_mb = {}
+        job_peak_child_memory_mb = {}
+        failed_jobs = set()
+        for record in job_stats_records:
+            job_name = str(record.get('job_name')).lower()
+            if not record['success']:
+                failed_jobs.add(job_name)
+            job_seconds[job_name] = job_seconds.get(job_name, 0) + record['wall_seconds']
+            if record.get('peak_memory_mb') is not None:
+                job_peak_memory_mb[job_name] = max(job_peak_memory_mb.get(job_name, 0),
+                                                   record['peak_memory_mb'] -
+                                                   (record.get('state_cache_mb') or 0))
+            if record.get('peak_child_memory_mb') is not None:
+                job_peak_child_memory_mb[job_name] = max(job_peak_child_memory_mb.get(job_name, 0),
+                                                         record['peak_child_memory_mb'])
+
+        cycle_jobs = dict((job_name.lower(), cycle_job) for job_name, cycle_job in cycle_jobs.items())
+        for job_name in sorted(job_seconds):
+            if job_name in cycle_jobs and job_name not in failed_jobs:
+                watershed_key, forecast_resolution, cost = cycle_jobs[job_name]
+                self.addJobRuntime(watershed_key, forecast_resolution, cost, job_seconds[job_name],
+                                   job_peak_memory_mb.get(job_name),
+                                   job_peak_child_memory_mb.get(job_name))
+
+        self.learned_cycles = (self.learned_cycles + [forecast_date_timestep])[-NUM_LEARNED_CYCLES:]
+
+    def write(self):
+        """
+        Writes the history file
+        """
+        if not self.history_file:
+            return
+        temp_history_file = "{0}.tmp".format(self.history_file)
+        with open(temp_history_file, 'w') as history_json:
+            json.dump({'version': JOB_COST_HISTORY_VERSION,
+                       'watersheds': self.history,
+                       'learned_cycles': self.learned_cycles},
+                      history_json, indent=2, sort_keys=True)
+        os.rename(temp_history_file, self.history_file)
+
+
+def predict_cycle_eta(job_predictions, processes):
+    """
+    Predicts when the jobs of a forecast cycle finish
+
+    job_predictions is a list of the watershed key and predicted seconds
+    of each job in the order the jobs are started. Each job starts on the
+    first process to be free, like the worker pool.
+    """
+    process_free_seconds = [0.0] * max(processes, 1)
+    watershed_finish_seconds = {}
+    watershed_job_seconds = {}
+    for watershed_key, seconds in job_predictions:
+        start_seconds = heapq.heappop(process_free_seconds)
+        finish_seconds = start_seconds + seconds
+        heapq.heappush(process_free_seconds, finish_seconds)
+        watershed_finish_seconds[watershed_key] = max(watershed_finish_seconds.get(watershed_key, 0),
+                                                      finish_seconds)
+        watershed_job_seconds[watershed_key] = watershed_job_seconds.get(watershed_key, 0) + seconds
+    return {
+        'processes': processes,
+        'jobs': len(job_predictions),
+        'job_seconds': sum(watershed_job_seconds.values()),
+        'makespan_seconds': max(process_free_seconds),
+        'watershed_finish_seconds': watershed_finish_seconds,
+        'watershed_job_seconds': watershed_job_seconds,
+    }
+
+
+def format_cycle_eta(cycle_eta):
+    """
+    Formats the predicted finish of each watershed as a table,
+    last watershed to finish first
+    """
+    header = "{0:<40} {1:>12} {2:>12}".format("watershed", "jobs (s)", "finish (s)")
+    lines = [header, "-" * len(header)]
+    for watershed_key, finish_seconds in sorted(cycle_eta['watershed_finish_seconds'].items(),
+                                                key=lambda item: (-item[1], item[0])):
+        lines.append("{0:<40} {1:>12.1f} {2:>12.1f}".format(watershed_key,
+                                                             cycle_eta['watershed_job_seconds'][watershed_key],
+                                                             finish_seconds))
+    lines.append("-" * len(header))
+    lines.append("{0} jobs on {1} processes: {2:.1f} job seconds, "
+                 "predicted to finish in {3:.1f} seconds".format(cycle_eta['jobs'],
+                                                                 cycle_eta['processes'],
+                                                                 cycle_eta['job_seconds'],
+                                                                 cycle_eta['makespan_seconds']))
+    return "\n".join(lines)
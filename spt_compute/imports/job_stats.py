@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+##
+##  job_stats.py
+##  spt_compute
+##
+##  License: BSD 3-Clause
+
+from contextlib import contextmanager
+import datetime
+from glob import glob
+import json
+import os
+import time
+
+#local imports
+from .helper_functions import (get_peak_memory_mb,
+                               get_stage_peak_memory_mb,
+                               reset_peak_memory)
+
+#------------------------------------------------------------------------------
+#functions
+#------------------------------------------------------------------------------
+def get_job_stats_file(log_directory, job_name):
+    """
+    Returns the path to the stats of the job beside the job log
+    """
+    return os.path.join(log_directory, "{0}_stats.jsonl".format(job_name))
+
+
+def get_io_bytes():
+    """
+    Gets the bytes read and written by the process and its finished
+    child processes. Returns None if it is not available on the platform.
+    """
+    try:
+        with open("/proc/self/io") as io_file:
+            io_counters = dict(line.split(":") for line in io_file if ":" in line)
+        return int(io_counters['rchar']), int(io_counters['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def get_cpu_seconds():
+    """
+    Gets the CPU time of the process and its finished child processes
+    """
+    cpu_times = os.times()
+    return sum(cpu_times[:4])
+
+
+class JobStats(object):
+    """
+    Records the time and resources of the stages of a job
+
+    Each stage is written as a JSON line to the stats file with the wall
+    time, CPU time (with child processes such as RAPID), peak memory,
+    bytes read and written, and the size of the output files of the stage.
+
+    peak_memory_mb is the peak of the process during the stage (None if it
+    cannot be reset on the platform). peak_child_memory_mb is the peak of
+    the child processes finished in the stage, or None if a child process
+    that finished before used more. The process_peak values are the peaks
+    over the life of the process, e.g. all of the jobs of a pool worker.
+    """
+    def __init__(self, stats_file=None, **job_info):
+        self.stats_file = stats_file
+        self.job_info = job_info
+        self.records = []
+
+    @contextmanager
+    def stage(self, stage_name, output_files=()):
+        """
+        Context to record a stage of the job. output_files is a list
+        or a function returning the list of files made by the stage.
+        """
+        record = dict(self.job_info)
+        record['stage'] = stage_name
+        record['start'] = datetime.datetime.utcnow().isoformat()
+        io_start = get_io_bytes()
+        cpu_start = get_cpu_seconds()
+        peak_reset = reset_peak_memory()
+        child_peak_start = get_peak_memory_mb(children=True)
+        time_start = time.time()
+        record['success'] = False
+        try:
+            yield record
+            record['success'] = True
+        finally:
+            record['wall_seconds'] = time.time() - time_start
+            record['cpu_seconds'] = get_cpu_seconds() - cpu_start
+            record['process_peak_memory_mb'] = get_peak_memory_mb()
+            record['process_peak_child_memory_mb'] = get_peak_memory_mb(children=True)
+            record['peak_memory_mb'] = get_stage_peak_memory_mb() if peak_reset else None
+            # the child peak is known if a child of the stage is the largest so far
+            record['peak_child_memory_mb'] = None
+            if child_peak_start is not None and \
+                    record['process_peak_child_memory_mb'] > child_peak_start:
+                record['peak_child_memory_mb'] = record['process_peak_child_memory_mb']
+            io_end = get_io_bytes()
+            if io_start is not None and io_end is not None:
+                record['bytes_read'] = io_end[0] - io_start[0]
+                record['bytes_written'] = io_end[1] - io_start[1]
+            else:
+                record['bytes_read'] = record['bytes_written'] = None
+            if callable(output_files):
+                output_files = output_files()
+            record['file_sizes'] = dict((os.path.basename(output_file), os.path.getsize(output_file))
+                                        for output_file in output_files
+                                        if output_file and os.path.exists(output_file))
+            self.writeRecord(record)
+
+    def writeRecord(self, record):
+        """
+        Appends the record to the stats file. The first record replaces
+        the records of a previous run of the job.
+        """
+        self.records.append(record)
+        if self.stats_file:
+            with open(self.stats_file, 'a' if len(self.records) > 1 else 'w') as stats_json:
+                stats_json.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def read_job_stats(log_directory):
+    """
+    Reads the stage records of all of the jobs in the log directory
+    """
+    records = []
+    for stats_file in sorted(glob(os.path.join(log_directory, "*_stats.jsonl"))):
+        with open(stats_file) as stats_json:
+            for line in stats_json:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print("WARNING: Invalid stats record in {0} ...".format(stats_file))
+    return records
+
+
+def summarize_job_stats(records):
+    """
+    Combines the stage records of the jobs by watershed and stage
+
+    Returns the rows of the summary sorted by the slowest watershed,
+    then by the slowest stage of the watershed.
+    """
+    stage_summary = {}
+    for record in records:
+        summary_key = (record.get('watershed'), record.get('subbasin'), record['stage'])
+        summary = stage_summary.setdefault(summary_key, {
+            'watershed': summary_key[0],
+            'subbasin': summary_key[1],
+            'stage': summary_key[2],
+            'jobs': 0,
+            'failed': 0,
+            'wall_seconds': 0.0,
+            'max_wall_seconds': 0.0,
+            'cpu_seconds': 0.0,
+            'peak_memory_mb': None,
+            'bytes_read': 0,
+            'bytes_written': 0,
+            'output_bytes': 0,
+        })
+        summary['jobs'] += 1
+        summary['failed'] += 0 if record['success'] else 1
+        summary['wall_seconds'] += record['wall_seconds']
+        summary['max_wall_seconds'] = max(summary['max_wall_seconds'], record['wall_seconds'])
+        summary['cpu_seconds'] += record['cpu_seconds']
+        for peak_memory in (record.get('peak_memory_mb'), record.get('peak_child_memory_mb')):
+            if peak_memory is not None:
+                summary['peak_memory_mb'] = max(summary['peak_memory_mb'] or 0, peak_memory)
+        summary['bytes_read'] += record.get('bytes_read') or 0
+        summary['bytes_written'] += record.get('bytes_written') or 0
+        summary['output_bytes'] += sum(record.get('file_sizes', {}).values())
+
+    watershed_seconds = {}
+    for summary in stage_summary.values():
+        watershed_key = (summary['watershed'], summary['subbasin'])
+        watershed_seconds[watershed_key] = watershed_seconds.get(watershed_key, 0) + summary['wall_seconds']
+
+    return sorted(stage_summary.values(),
+                  key=lambda summary: (-watershed_seconds[(summary['watershed'], summary['subbasin'])],
+                                       str(summary['watershed']), str(summary['subbasin']),
+                                       -summary['wall_seconds']))
+
+
+def format_job_stats_summary(summary_rows):
+    """
+    Formats the summary as a table
+    """
+    header = "{0:<40} {1:<12} {2:>5} {3:>6} {4:>10} {5:>10} {6:>10} {7:>10} {8:>10} {9:>10}".format(
+        "watershed", "stage", "jobs", "failed", "wall (s)", "max (s)", "cpu (s)",
+        "peak (MB)", "read (MB)", "write (MB)")
+    lines = [header, "-" * len(header)]
+    for summary in summary_rows:
+        peak_memory = summary['peak_memory_mb']
+        lines.append("{0:<40} {1:<12} {2:>5} {3:>6} {4:>10.1f} {5:>10.1f} {6:>10.1f} {7:>10} {8:>10.1f} {9:>10.1f}".format(
+            "{0}-{1}".format(summary['watershed'], summary['subbasin']),
+            summary['stage'],
+            summary['jobs'],
+            summary['failed'],
+            summary['wall_seconds'],
+            summary['max_wall_seconds'],
+            summary['cpu_seconds'],
+            "{0:.1f}".format(peak_memory) if peak_memory is not None else "-",
+            summary['bytes_read'] / (1024.0 * 1024.0),
+            summary['bytes_written'] / (1024.0 * 1024.0)))
+    return "\n".join(lines)
+
+
+def write_job_stats_summary(log_directory):
+    """
+    Writes the summary of the job stats in the log directory to
+    job_stats_summary.txt and returns the summary table
+    """
+    summary_rows = summarize_job_stats(read_job_stats(log_directory))
+    if not summary_rows:
+        return ""
+    summary_table = format_job_stats_summary(summary_rows)
+    with open(os.path.join(log_directory, "job_stats_summary.txt"), 'w') as summary_file:
+        summary_file.write(summary_table + "\n")
+    return summary_table
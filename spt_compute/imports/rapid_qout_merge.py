@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+##
+##  rapid_qout_merge.py
+##  spt_compute
+##
+##  License: BSD 3-Clause
+
+import csv
+import datetime
+from io import open
+import os
+
+from netCDF4 import Dataset, default_fillvals
+import numpy as np
+
+#local imports
+from .helper_functions import log
+
+# time steps of the Qout file of each forecast resolution with the initial flow
+QOUT_TIME_LENGTH = {
+    'HighRes': 1 + 90 + 18 + 16,
+    'LowResFull': 1 + 48 + 36,
+    'LowRes': 1 + 60,
+}
+# names used in the RAPID Qout files, in the order they are searched
+RIVER_ID_DIMENSION_NAMES = ('rivid', 'COMID', 'station', 'DrainLnID', 'FEATUREID')
+RIVER_ID_VARIABLE_NAMES = ('rivid', 'COMID', 'station_id', 'DrainLnID', 'FEATUREID')
+FLOW_VARIABLE_NAMES = ('Qout', 'streamflow', 'm3_riv')
+TIME_DIMENSION_NAMES = ('time', 'Time')
+
+#------------------------------------------------------------------------------
+#functions
+#------------------------------------------------------------------------------
+def read_csv_rows(csv_file):
+    """
+    Reads the rows of a csv file
+    """
+    with open(csv_file, "r") as csv_con:
+        return [row for row in csv.reader(csv_con) if row]
+
+
+def find_name(names, available_names, description):
+    """
+    Returns the first name available in the file
+    """
+    for name in names:
+        if name in available_names:
+            return name
+    raise IndexError("Could not find {0}. Looked for {1}.".format(description,
+                                                                   ", ".join(names)))
+
+
+class RAPIDQoutSegment(object):
+    """
+    One RAPID Qout file to merge
+    """
+    def __init__(self, rapid_output_file):
+        self.qout_nc = Dataset(rapid_output_file)
+        self.river_id_dimension = find_name(RIVER_ID_DIMENSION_NAMES,
+                                            self.qout_nc.dimensions, "river ID dimension")
+        self.flow_variable = find_name(FLOW_VARIABLE_NAMES,
+                                       self.qout_nc.variables, "flow variable")
+        self.time_dimension = find_name(TIME_DIMENSION_NAMES,
+                                        self.qout_nc.dimensions, "time dimension")
+        self.size_river_id = len(self.qout_nc.dimensions[self.river_id_dimension])
+        self.size_time = len(self.qout_nc.dimensions[self.time_dimension])
+
+    def getRiverIDArray(self):
+        """
+        Returns the river IDs of the file
+        """
+        river_id_variable = find_name(RIVER_ID_VARIABLE_NAMES,
+                                      self.qout_nc.variables, "river ID variable")
+        return self.qout_nc.variables[river_id_variable][:]
+
+    def getTimeArray(self, start_seconds, time_step):
+        """
+        Returns the time of each step in seconds since 1970. The time
+        variable is used if it is valid, otherwise the time is generated
+        from the start of the simulation and the time step.
+        """
+        if 'time' in self.qout_nc.variables and self.size_time > 1:
+            time_array = self.qout_nc.variables['time'][:]
+            if not np.ma.is_masked(time_array) and time_array[1] > time_array[0]:
+                return np.asarray(time_array, dtype=np.int64)
+        return start_seconds + time_step * np.arange(1, self.size_time + 1, dtype=np.int64)
+
+    def readQout(self, qout_array):
+        """
+        Reads the flow into the (river ID, time) array. Missing values
+        get the default fill value like a masked copy into the merged file.
+        """
+        flow_var = self.qout_nc.variables[self.flow_variable]
+        flow_var.set_auto_mask(False)
+        flow_data = flow_var[:]
+        if flow_var.dimensions[0] == self.time_dimension:
+            flow_data = flow_data.T
+        qout_array[:] = flow_data
+
+        for missing_attribute in ('_FillValue', 'missing_value'):
+            if missing_attribute in flow_var.ncattrs():
+                missing_value = np.asarray(flow_var.getncattr(missing_attribute), dtype=flow_data.dtype)
+                qout_array[flow_data == missing_value] = default_fillvals['f4']
+
+    def close(self):
+        """
+        Closes the file
+        """
+        self.qout_nc.close()
+
+
+def get_qout_static_metadata(river_id_array, rapid_connect_file="", comid_lat_lon_z_file=""):
+    """
+    Returns the data of the watershed added to the merged Qout files:
+    the index of each river in the rapid_connect file (the order of the
+    Qinit file) and the latitude, longitude, and elevation of each river.
+    This does not change between the ensembles of a watershed.
+    """
+    static_metadata = {
+        'river_id': np.array(river_id_array),
+        'rapid_connect_file': rapid_connect_file,
+        'comid_lat_lon_z_file': comid_lat_lon_z_file,
+        'rapid_connect_index': None,
+        'lat': None,
+        'lon': None,
+        'z': None,
+    }
+
+    if rapid_connect_file:
+        rapid_connect_index = dict((int(float(row[0])), row_index) for row_index, row
+                                   in reversed(list(enumerate(read_csv_rows(rapid_connect_file)))))
+        try:
+            static_metadata['rapid_connect_index'] = \
+                np.array([rapid_connect_index[river_id] for river_id in river_id_array])
+        except KeyError as ex:
+            log('COMID {0} misssing in rapid_connect file'.format(ex.args[0]), 'ERROR')
+
+    if comid_lat_lon_z_file and os.path.exists(comid_lat_lon_z_file):
+        lookup_table = read_csv_rows(comid_lat_lon_z_file)[1:]
+        lookup_index = dict((int(float(row[0])), row_index) for row_index, row
+                            in reversed(list(enumerate(lookup_table))))
+        try:
+            lookup_rows = [lookup_table[lookup_index[river_id]] for river_id in river_id_array]
+        except KeyError as ex:
+            log('rivid {0} missing in comid_lat_lon_z file'.format(ex.args[0]), 'ERROR')
+        for column_index, column_name in enumerate(('lat', 'lon', 'z')):
+            static_metadata[column_name] = np.array([float(row[column_index + 1])
+                                                     for row in lookup_rows])
+
+    return static_metadata
+
+
+def merge_rapid_qout_to_cf(rapid_output_file_list,
+                           start_datetime,
+                           time_step_list,
+                           qinit_file="",
+                           comid_lat_lon_z_file="",
+                           rapid_connect_file="",
+                           project_name="Default RAPID Project",
+                           output_id_dim_name='rivid',
+                           output_flow_var_name='Qout',
+                           static_metadata=None,
+                           output_file=None):
+    """
+    Merges consecutive RAPID Qout files into one CF compliant Qout file
+
+    The output matches RAPIDpy ConvertRAPIDOutputToCF: the first time
+    step has the Qinit flow (or zero), then the flow of each file. The
+    flow of all files is copied into one array and written at once.
+    The merged file replaces the first file and the other files are removed.
+    With output_file, the merged file is written next to output_file (e.g.
+    in the output directory of the forecast) and moved to it instead.
+
+    static_metadata is the result of get_qout_static_metadata for the
+    watershed. It is read from the input files if it is missing or for
+    other rivers. The static metadata used is returned to reuse for the
+    next ensemble.
+    """
+    time_start_conversion = datetime.datetime.utcnow()
+    if output_file is None:
+        output_file = rapid_output_file_list[0]
+        cf_compliant_file = '%s_CF.nc' % os.path.splitext(output_file)[0]
+    else:
+        cf_compliant_file = os.path.join(os.path.dirname(os.path.abspath(output_file)),
+                                         ".{0}.tmp".format(os.path.basename(output_file)))
+    print("INFO: Merging {0} ...".format(", ".join(rapid_output_file_list)))
+
+    segment_list = []
+    cf_nc = None
+    try:
+        for rapid_output_file in rapid_output_file_list:
+            segment_list.append(RAPIDQoutSegment(rapid_output_file))
+
+        river_id_array = segment_list[0].getRiverIDArray()
+        for segment in segment_list[1:]:
+            if segment.size_river_id != segment_list[0].size_river_id:
+                raise Exception("River ID size is different in one of the files ...")
+            if not (segment.getRiverIDArray() == river_id_array).all():
+                raise Exception("River IDs are different in files ...")
+
+        if static_metadata is None \
+                or static_metadata['rapid_connect_file'] != rapid_connect_file \
+                or static_metadata['comid_lat_lon_z_file'] != comid_lat_lon_z_file \
+                or not np.array_equal(static_metadata['river_id'], river_id_array):
+            static_metadata = get_qout_static_metadata(river_id_array,
+                                                       rapid_connect_file,
+                                                       comid_lat_lon_z_file)
+
+        # time of the first value is the start of the simulation
+        start_datetime = start_datetime.replace(tzinfo=None)
+        start_seconds = int((start_datetime - datetime.datetime(1970, 1, 1)).total_seconds())
+        time_array_list = [np.array([start_seconds], dtype=np.int64)]
+        for segment, time_step in zip(segment_list, time_step_list):
+            time_array_list.append(segment.getTimeArray(time_array_list[-1][-1], time_step))
+        time_array = np.concatenate(time_array_list)
+
+        # copy the flow of every file into the merged array
+        qout_array = np.empty((len(river_id_array), len(time_array)), dtype=np.float32)
+        if qinit_file and rapid_connect_file:
+            init_flow_table = read_csv_rows(qinit_file)
+            qout_array[:, 0] = [float(init_flow_table[rapid_connect_index][0])
+                                for rapid_connect_index in static_metadata['rapid_connect_index']]
+        else:
+            qout_array[:, 0] = 0
+        time_index_start = 1
+        for segment in segment_list:
+            time_index_end = time_index_start + segment.size_time
+            segment.readQout(qout_array[:, time_index_start:time_index_end])
+            time_index_start = time_index_end
+
+        print("INFO: Writing {0} ...".format(cf_compliant_file))
+        cf_nc = Dataset(cf_compliant_file, 'w', format='NETCDF3_CLASSIC')
+
+        # global attributes
+        cf_nc.featureType = 'timeSeries'
+        cf_nc.Metadata_Conventions = 'Unidata Dataset Discovery v1.0'
+        cf_nc.Conventions = 'CF-1.6'
+        cf_nc.cdm_data_type = 'Station'
+        cf_nc.nodc_template_version = 'NODC_NetCDF_TimeSeries_Orthogonal_Template_v1.1'
+        cf_nc.standard_name_vocabulary = ('NetCDF Climate and Forecast (CF) '
+                                          'Metadata Convention Standard Name '
+                                          'Table v28')
+        cf_nc.title = 'RAPID Result'
+        cf_nc.summary = ("Results of RAPID river routing simulation. Each river "
+                         "reach (i.e., feature) is represented by a point "
+                         "feature at its midpoint, and is identified by the "
+                         "reach's unique NHDPlus COMID identifier.")
+        cf_nc.time_coverage_resolution = 'point'
+        for coordinate, attribute_name, units in (('lat', 'lat', 'degrees_north'),
+                                                  ('lon', 'lon', 'degrees_east'),
+                                                  ('z', 'vertical', 'm')):
+            coordinate_array = static_metadata[coordinate]
+            has_coordinates = coordinate_array is not None and len(coordinate_array) > 0
+            cf_nc.setncattr('geospatial_{0}_min'.format(attribute_name),
+                            coordinate_array.min() if has_coordinates else 0.0)
+            cf_nc.setncattr('geospatial_{0}_max'.format(attribute_name),
+                            coordinate_array.max() if has_coordinates else 0.0)
+            cf_nc.setncattr('geospatial_{0}_units'.format(attribute_name), units)
+            cf_nc.setncattr('geospatial_{0}_resolution'.format(attribute_name),
+                            'midpoint of stream feature')
+        cf_nc.geospatial_vertical_positive = 'up'
+        cf_nc.project = project_name
+        cf_nc.processing_level = 'Raw simulation result'
+        cf_nc.keywords_vocabulary = ('NASA/Global Change Master Directory '
+                                     '(GCMD) Earth Science Keywords. Version '
+                                     '8.0.0.0.0')
+        cf_nc.keywords = 'DISCHARGE/FLOW'
+        cf_nc.comment = 'Result time step(s) (seconds): ' + str(list(time_step_list))
+        timestamp = datetime.datetime.utcnow().isoformat() + 'Z'
+        cf_nc.date_created = timestamp
+        cf_nc.history = (timestamp + '; added time, lat, lon, z, crs variables; '
+                         'added metadata to conform to NODC_NetCDF_TimeSeries_'
+                         'Orthogonal_Template_v1.1')
+        cf_nc.time_coverage_start = start_datetime.isoformat() + '+00:00Z'
+        cf_nc.time_coverage_end = (datetime.datetime(1970, 1, 1) +
+                                   datetime.timedelta(seconds=int(time_array[-1]))).isoformat() + 'Z'
+
+        # dimensions
+        cf_nc.createDimension('time', len(time_array))
+        cf_nc.createDimension(output_id_dim_name, len(river_id_array))
+
+        # variables
+        time_series_var = cf_nc.createVariable(output_id_dim_name, 'i4', (output_id_dim_name,))
+        time_series_var.long_name = 'Unique NHDPlus COMID identifier for each river reach feature'
+        time_series_var.cf_role = 'timeseries_id'
+
+        time_var = cf_nc.createVariable('time', 'i4', ('time',))
+        time_var.long_name = 'time'
+        time_var.standard_name = 'time'
+        time_var.units = 'seconds since 1970-01-01 00:00:00 0:00'
+        time_var.axis = 'T'
+
+        if static_metadata['lat'] is not None:
+            lat_var = cf_nc.createVariable('lat', 'f8', (output_id_dim_name,),
+                                           fill_value=-9999.0)
+            lat_var.long_name = 'latitude'
+            lat_var.standard_name = 'latitude'
+            lat_var.units = 'degrees_north'
+            lat_var.axis = 'Y'
+
+            lon_var = cf_nc.createVariable('lon', 'f8', (output_id_dim_name,),
+                                           fill_value=-9999.0)
+            lon_var.long_name = 'longitude'
+            lon_var.standard_name = 'longitude'
+            lon_var.units = 'degrees_east'
+            lon_var.axis = 'X'
+
+            z_var = cf_nc.createVariable('z', 'f8', (output_id_dim_name,),
+                                         fill_value=-9999.0)
+            z_var.long_name = ('Elevation referenced to the North American '
+                               'Vertical Datum of 1988 (NAVD88)')
+            z_var.standard_name = 'surface_altitude'
+            z_var.units = 'm'
+            z_var.axis = 'Z'
+            z_var.positive = 'up'
+
+            crs_var = cf_nc.createVariable('crs', 'i4')
+            crs_var.grid_mapping_name = 'latitude_longitude'
+            crs_var.epsg_code = 'EPSG:4326'  # WGS 84
+            crs_var.semi_major_axis = 6378137.0
+            crs_var.inverse_flattening = 298.257223563
+
+        q_var = cf_nc.createVariable(output_flow_var_name, 'f4', (output_id_dim_name, 'time'))
+        q_var.long_name = 'Discharge'
+        q_var.units = 'm^3/s'
+        q_var.coordinates = 'time lat lon z'
+        q_var.grid_mapping = 'crs'
+        q_var.source = ('Generated by the Routing Application for Parallel '
+                        'computatIon of Discharge (RAPID) river routing '
+                        'model.')
+        q_var.references = 'http://rapid-hub.org/'
+        q_var.comment = 'lat, lon, and z values taken at midpoint of river reach feature'
+
+        # data
+        time_series_var[:] = river_id_array
+        time_var[:] = time_array
+        if static_metadata['lat'] is not None:
+            lat_var[:] = static_metadata['lat']
+            lon_var[:] = static_metadata['lon']
+            z_var[:] = static_metadata['z']
+        q_var.set_auto_mask(False)
+        q_var[:] = qout_array
+
+        cf_nc.close()
+        for segment in segment_list:
+            segment.close()
+    except Exception:
+        if cf_nc is not None and cf_nc.isopen():
+            cf_nc.close()
+        for segment in segment_list:
+            if segment.qout_nc.isopen():
+                segment.close()
+        if os.path.exists(cf_compliant_file):
+            os.remove(cf_compliant_file)
+        raise
+
+    # the merged file replaces the original RAPID output
+    for rapid_output_file in rapid_output_file_list:
+        os.remove(rapid_output_file)
+    os.rename(cf_compliant_file, output_file)
+    print("INFO: Time to merge Qout: {0}".format(datetime.datetime.utcnow() - time_start_conversion))
+    return static_metadata
+
+
+def get_qout_shape(qout_file):
+    """
+    Returns the number of time steps and rivers of the Qout or
+    inflow file, or None if it is not a valid netCDF file
+    """
+    try:
+        qout_segment = RAPIDQoutSegment(qout_file)
+    except Exception:
+        return None
+    qout_segment.close()
+    return qout_segment.size_time, qout_segment.size_river_id
+
+
+def is_valid_qout_file(qout_file, time_length, num_rivers):
+    """
+    Returns True if the Qout file opens, has the number of time steps and
+    rivers expected, and has flow for every river and time step
+    (no NaN or fill values). Used to skip jobs completed before.
+    A fill value of zero (e.g. the m3_riv inflow files) is a valid flow.
+    """
+    if not os.path.exists(qout_file):
+        return False
+    try:
+        qout_segment = RAPIDQoutSegment(qout_file)
+    except Exception:
+        return False
+    try:
+        if qout_segment.size_time != time_length or qout_segment.size_river_id != num_rivers:
+            return False
+        flow_var = qout_segment.qout_nc.variables[qout_segment.flow_variable]
+        flow_var.set_auto_mask(False)
+        flow_data = flow_var[:]
+        fill_value = flow_var.getncattr('_FillValue') if '_FillValue' in flow_var.ncattrs() \
+            else default_fillvals['f4']
+        return bool(np.isfinite(flow_data).all() and
+                    (fill_value == 0 or (flow_data != np.float32(fill_value)).all()))
+    except Exception:
+        return False
+    finally:
+        qout_segment.close()
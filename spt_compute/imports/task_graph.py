@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+##
+##  task_graph.py
+##  spt_compute
+##
+##  License: BSD 3-Clause
+
+from collections import OrderedDict
+import hashlib
+import heapq
+import json
+from multiprocessing.pool import ThreadPool
+import os
+from threading import Thread
+from traceback import format_exc
+
+#local imports
+from .job_executors import JobError
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+TASK_MEMO_VERSION = 2
+
+#------------------------------------------------------------------------------
+#functions
+#------------------------------------------------------------------------------
+def get_file_signature(file_path):
+    """
+    Returns the size and modification time of the file or None if
+    the file does not exist. The file is not read, so the signature
+    of large files (e.g. the Qout files) is cheap.
+    """
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return None
+    return file_stat.st_size, file_stat.st_mtime
+
+
+def describe_task_argument(argument):
+    """
+    Describes the task arguments that are not JSON by their name
+    so the description is the same in the next run
+    """
+    return getattr(argument, '__name__', type(argument).__name__)
+
+
+def run_executor_jobs(job_executor, submit_queue, completion_queue, poll_seconds=1):
+    """
+    Submits the jobs from the submit queue to the executor and puts the
+    id of the finished jobs in the completion queue. While jobs run, the
+    submit queue is checked every poll_seconds so a new job does not wait
+    for a running job to finish. A failed job is put in the completion
+    queue and the other jobs keep running. The submitted jobs are
+    cancelled when None is submitted or the executor fails, then None
+    is put in the completion queue for the jobs that did not finish.
+    """
+    while True:
+        # submit the new jobs, waiting for one if no jobs are running
+        try:
+            submission = submit_queue.get(not job_executor.numPending())
+            while True:
+                if submission is None:
+                    job_executor.cancel()
+                    return
+                try:
+                    job_executor.submit(*submission)
+                except Exception:
+                    completion_queue.put((submission[0], False, format_exc(), None))
+                    job_executor.cancel()
+                    completion_queue.put((None, False, None, None))
+                    return
+                submission = submit_queue.get_nowait()
+        except Empty:
+            pass
+        try:
+            job_id = job_executor.waitAny(poll_seconds)
+        except JobError as ex:
+            completion_queue.put((ex.job_id, False, str(ex), None))
+            continue
+        except Exception:
+            job_executor.cancel()
+            completion_queue.put((None, False, format_exc(), None))
+            return
+        if job_id is not None:
+            completion_queue.put((job_id, True, None, None))
+
+
+class TaskGraph(object):
+    """
+    Tasks of a forecast cycle run when the tasks they depend on are done
+
+    A task is either a function run on a thread of this process or a
+    job dictionary run by a JobExecutor (see job_executors.py). The tasks
+    ready to run start in order of priority, largest first, so the
+    independent branches of the graph run at the same time. If a task
+    fails, the tasks after it do not run and the other tasks continue.
+
+    A memoized task is skipped if it was done before with the same
+    arguments and input file sizes and modification times, and its
+    output files were not changed since. The tasks done are stored in
+    the memo file.
+    """
+    def __init__(self, memo_file=None):
+        self.tasks = OrderedDict()
+        self.memo_file = memo_file
+        self.memo = {}
+        if memo_file:
+            try:
+                with open(memo_file) as memo_json:
+                    memo = json.load(memo_json)
+                if memo.get('version') == TASK_MEMO_VERSION:
+                    self.memo = memo['tasks']
+            except (IOError, OSError, ValueError):
+                pass
+
+    def addTask(self, name, function=None, args=(), depends=(), job=None,
+                input_files=(), output_files=(), memoize=False, priority=0):
+        """
+        Adds a task run after the tasks it depends on. The tasks it
+        depends on are added before it, so the graph has no cycles.
+        Returns the name of the task.
+        """
+        if name in self.tasks:
+            raise ValueError("Task {0} was already added ...".format(name))
+        if (function is None) == (job is None):
+            raise ValueError("Task {0} needs a function or a job ...".format(name))
+        for depend_name in depends:
+            if depend_name not in self.tasks:
+                raise ValueError("Task {0} depends on {1}, which was not added ...".format(name, depend_name))
+        self.tasks[name] = {
+            'function': function,
+            'args': args,
+            'depends': list(depends),
+            'job': job,
+            'input_files': list(input_files),
+            'output_files': list(output_files),
+            'memoize': memoize,
+            'priority': priority,
+            'level': 1 + max([self.tasks[depend_name]['level'] for depend_name in depends] or [0]),
+        }
+        return name
+
+    def getTaskKey(self, name):
+        """
+        Returns the hash of the arguments of the task and the size and
+        modification time of its input files
+        """
+        task = self.tasks[name]
+        task_args = task['args'] if task['job'] is None else task['job'].get('args', task['job'])
+        task_key = hashlib.sha1(json.dumps([name, task_args], sort_keys=True,
+                                           default=describe_task_argument).encode('utf-8'))
+        for input_file in task['input_files']:
+            task_key.update("{0}={1}".format(input_file, get_file_signature(input_file)).encode('utf-8'))
+        return task_key.hexdigest()
+
+    def isMemoized(self, name, task_key):
+        """
+        Returns True if the task was done with the key and made
+        its output files, which were not changed since
+        """
+        task_memo = self.memo.get(name)
+        if not self.tasks[name]['memoize'] or not task_memo or task_memo['key'] != task_key:
+            return False
+        for output_file in self.tasks[name]['output_files']:
+            if output_file not in task_memo['output_files'] or not os.path.exists(output_file) \
+                    or os.path.getsize(output_file) != task_memo['output_files'][output_file]:
+                return False
+        return True
+
+    def rememberTask(self, name, task_key):
+        """
+        Stores the task as done with the key and the size of its output files
+        """
+        self.memo[name] = {
+            'key': task_key,
+            'output_files': dict((output_file, os.path.getsize(output_file))
+                                 for output_file in self.tasks[name]['output_files']
+                                 if os.path.exists(output_file)),
+        }
+        if self.memo_file:
+            temp_memo_file = "{0}.tmp".format(self.memo_file)
+            with open(temp_memo_file, 'w') as memo_json:
+                json.dump({'version': TASK_MEMO_VERSION, 'tasks': self.memo},
+                          memo_json, indent=2, sort_keys=True)
+            os.rename(temp_memo_file, self.memo_file)
+
+    def getPlan(self):
+        """
+        Returns the tasks in the order they can run with their level
+        in the graph and if they would be skipped as memoized
+        """
+        plan = []
+        for name, task in sorted(self.tasks.items(), key=lambda name_task: name_task[1]['level']):
+            plan.append({
+                'name': name,
+                'level': task['level'],
+                'runs_on': 'thread' if task['job'] is None else 'executor',
+                'memoized': task['memoize'] and self.isMemoized(name, self.getTaskKey(name)),
+                'depends': task['depends'],
+            })
+        return plan
+
+    def formatPlan(self):
+        """
+        Formats the plan of the tasks as a table for a dry run
+        """
+        header = "{0:>5} {1:<60} {2:<8} {3:<8} {4}".format("level", "task", "runs on", "status", "after")
+        lines = [header, "-" * len(header)]
+        for planned_task in self.getPlan():
+            depends = planned_task['depends']
+            lines.append("{0:>5} {1:<60} {2:<8} {3:<8} {4}".format(
+                planned_task['level'],
+                planned_task['name'],
+                planned_task['runs_on'],
+                "memoized" if planned_task['memoized'] else "run",
+                ", ".join(depends[:2]) + (" and {0} more".format(len(depends) - 2) if len(depends) > 2 else "")
+                if depends else "-"))
+        return "\n".join(lines)
+
+    def runLocalTask(self, name, completion_queue):
+        """
+        Runs the function of the task unless it is memoized
+        and puts the result in the completion queue
+        """
+        task = self.tasks[name]
+        try:
+            task_key = self.getTaskKey(name) if task['memoize'] else None
+            if task_key is not None and self.isMemoized(name, task_key):
+                print("INFO: Skipping {0}. It was done before with the same inputs ...".format(name))
+                completion_queue.put((name, True, None, None))
+                return
+            completion_queue.put((name, True, task['function'](*task['args']), task_key))
+        except Exception:
+            completion_queue.put((name, False, format_exc(), None))
+
+    def run(self, job_executor=None, num_threads=1):
+        """
+        Runs the tasks and returns the result of each function task.
+        Raises an exception with the failed tasks after the other tasks
+        finish if a task failed.
+        """
+        completion_queue = Queue()
+        num_depends = dict((name, len(task['depends'])) for name, task in self.tasks.items())
+        dependents = dict((name, []) for name in self.tasks)
+        for name, task in self.tasks.items():
+            for depend_name in task['depends']:
+                dependents[depend_name].append(name)
+        # tasks ready to run, largest priority first then in the order added
+        task_order = dict((name, task_index) for task_index, name in enumerate(self.tasks))
+        ready_tasks = []
+
+        def add_ready_task(name):
+            heapq.heappush(ready_tasks, (-self.tasks[name]['priority'], task_order[name], name))
+
+        for name in self.tasks:
+            if not num_depends[name]:
+                add_ready_task(name)
+
+        thread_pool = None
+        if any(task['job'] is None for task in self.tasks.values()):
+            thread_pool = ThreadPool(num_threads)
+        submit_queue = None
+        job_thread = None
+        if any(task['job'] is not None for task in self.tasks.values()):
+            submit_queue = Queue()
+            job_thread = Thread(target=run_executor_jobs, args=(job_executor, submit_queue, completion_queue))
+            job_thread.daemon = True
+            job_thread.start()
+
+        results = OrderedDict()
+        job_keys = {}
+        task_errors = []
+        num_done = 0
+        num_failed = 0
+        # jobs submitted to the executor that did not finish
+        submitted_jobs = set()
+        executor_stopped = False
+        try:
+            num_running = 0
+            while ready_tasks or num_running:
+                while ready_tasks:
+                    name = heapq.heappop(ready_tasks)[2]
+                    task = self.tasks[name]
+                    if task['job'] is None:
+                        thread_pool.apply_async(self.runLocalTask, (name, completion_queue))
+                    else:
+                        if executor_stopped:
+                            # the job does not run
+                            continue
+                        job_keys[name] = self.getTaskKey(name) if task['memoize'] else None
+                        if job_keys[name] is not None and self.isMemoized(name, job_keys[name]):
+                            print("INFO: Skipping {0}. It was done before with the same inputs ...".format(name))
+                            del job_keys[name]
+                            completion_queue.put((name, True, None, None))
+                        else:
+                            submitted_jobs.add(name)
+                            submit_queue.put((name, task['job'], task['priority']))
+                    num_running += 1
+
+                name, success, result, task_key = completion_queue.get()
+                if name is None:
+                    # the executor stopped, so the submitted jobs do not finish
+                    if result is not None:
+                        task_errors.append("ERROR: The job executor failed ...\n{0}".format(result))
+                    executor_stopped = True
+                    num_running -= len(submitted_jobs)
+                    submitted_jobs.clear()
+                    continue
+                num_running -= 1
+                submitted_jobs.discard(name)
+                if not success:
+                    # the tasks after the failed task do not run
+                    num_failed += 1
+                    task_errors.append("ERROR: Task {0} failed ...\n{1}".format(name, result))
+                    job_keys.pop(name, None)
+                    continue
+                num_done += 1
+                if task_key is None:
+                    task_key = job_keys.pop(name, None)
+                if task_key is not None:
+                    self.rememberTask(name, task_key)
+                if self.tasks[name]['job'] is None:
+                    results[name] = result
+                for dependent_name in dependents[name]:
+                    num_depends[dependent_name] -= 1
+                    if not num_depends[dependent_name]:
+                        add_ready_task(dependent_name)
+        finally:
+            # the running tasks stop before the error is raised
+            if thread_pool is not None:
+                thread_pool.close()
+                thread_pool.join()
+            if job_thread is not None:
+                submit_queue.put(None)
+                job_thread.join()
+
+        if task_errors:
+            raise Exception("ERROR: {0} tasks failed and {1} tasks after them did not run ...\n{2}"
+                            .format(num_failed, len(self.tasks) - num_done - num_failed,
+                                    "\n".join(task_errors)))
+        return results
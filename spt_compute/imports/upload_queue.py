@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+##
+##  upload_queue.py
+##  spt_compute
+##
+##  License: BSD 3-Clause
+
+import json
+import os
+from shutil import copyfile
+import tarfile
+import threading
+import time
+import traceback
+
+UPLOAD_QUEUE_VERSION = 1
+
+#------------------------------------------------------------------------------
+#functions
+#------------------------------------------------------------------------------
+def upload_single_forecast(job_info, data_manager):
+    """
+    Uploads a single forecast file to CKAN.
+    Returns True if the upload succeeded.
+    """
+    print("Uploading {0} {1} {2} {3}".format(job_info['watershed'],
+                                             job_info['subbasin'],
+                                             job_info['forecast_date_timestep'],
+                                             job_info['ensemble_number']))
+
+    # Upload to CKAN
+    data_manager.initialize_run_ecmwf(job_info['watershed'], job_info['subbasin'], job_info['forecast_date_timestep'])
+    data_manager.update_resource_ensemble_number(job_info['ensemble_number'])
+    # tar.gz file
+    output_tar_file = os.path.join(job_info['master_watershed_outflow_directory'],
+                                   "%s.tar.gz" % data_manager.resource_name)
+    upload_success = False
+    try:
+        if not os.path.exists(output_tar_file):
+            with tarfile.open(output_tar_file, "w:gz") as tar:
+                tar.add(job_info['outflow_file_name'], arcname=os.path.basename(job_info['outflow_file_name']))
+        return_data = data_manager.upload_resource(output_tar_file)
+        upload_success = bool(return_data['success'])
+        if upload_success:
+            print("Upload success")
+        else:
+            print(return_data)
+    except Exception as ex:
+        print(ex)
+        pass
+    finally:
+        # remove tar.gz file
+        if os.path.exists(output_tar_file):
+            os.remove(output_tar_file)
+    return upload_success
+
+
+class LocalDatasetManager(object):
+    """
+    Data store in a local directory with the methods of the
+    ECMWFRAPIDDatasetManager used to upload the forecasts.
+    Used in place of CKAN for tests and local runs.
+    """
+    def __init__(self, data_store_directory):
+        self.data_store_directory = data_store_directory
+        self.watershed = None
+        self.subbasin = None
+        self.date_string = None
+        self.ensemble_number = None
+        self.resource_name = None
+
+    def initialize_run_ecmwf(self, watershed, subbasin, date_string):
+        """
+        Sets the forecast of the next uploads
+        """
+        self.watershed = watershed.lower()
+        self.subbasin = subbasin.lower()
+        self.date_string = date_string
+        self.ensemble_number = None
+        self.resource_name = "{0}-{1}-{2}".format(self.watershed, self.subbasin, date_string)
+
+    def update_resource_ensemble_number(self, ensemble_number):
+        """
+        Sets the ensemble number of the next upload
+        """
+        self.ensemble_number = ensemble_number
+        self.resource_name = "{0}-{1}-{2}-{3}".format(self.watershed, self.subbasin,
+                                                      self.date_string, ensemble_number)
+
+    def get_resource_directory(self):
+        """
+        Returns the directory of the resources of the forecast
+        """
+        return os.path.join(self.data_store_directory,
+                            "{0}-{1}".format(self.watershed, self.subbasin),
+                            self.date_string)
+
+    def upload_resource(self, file_path):
+        """
+        Copies the file to the data store
+        """
+        resource_directory = self.get_resource_directory()
+        try:
+            os.makedirs(resource_directory)
+        except OSError:
+            pass
+        copyfile(file_path, os.path.join(resource_directory, os.path.basename(file_path)))
+        return {'success': True}
+
+    def zip_upload_warning_points_in_directory(self, directory_path):
+        """
+        Copies the warning points in the directory to the data store
+        """
+        for file_name in os.listdir(directory_path):
+            if file_name.startswith("return_") and file_name.endswith(".geojson"):
+                self.upload_resource(os.path.join(directory_path, file_name))
+
+
+class UploadQueue(object):
+    """
+    Uploads the forecasts in the background
+
+    Each uploader thread has its own data manager from data_manager_factory
+    and calls upload_function(job_info, data_manager), which returns True
+    if the upload succeeded. A failed upload is tried again after a delay
+    doubled after each attempt. The pending uploads are kept in queue_file
+    with their number of attempts and are uploaded in the next run, so an
+    upload is dropped after max_attempts in all of the runs. An upload
+    whose outflow file no longer exists is dropped. put blocks while
+    max_pending uploads are waiting.
+    """
+    def __init__(self, queue_file, upload_function, data_manager_factory,
+                 num_uploaders=2, max_pending=100, max_attempts=5,
+                 backoff_seconds=30, max_backoff_seconds=1800):
+        self.queue_file = queue_file
+        self.upload_function = upload_function
+        self.data_manager_factory = data_manager_factory
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.pending = []
+        self.uploading = []
+        self.stopped = False
+        self.condition = threading.Condition()
+        try:
+            with open(queue_file) as queue_json:
+                upload_queue = json.load(queue_json)
+        except (IOError, OSError, ValueError):
+            upload_queue = {}
+        if upload_queue.get('version') == UPLOAD_QUEUE_VERSION:
+            self.pending = [upload for upload in upload_queue['uploads']
+                            if upload['attempts'] < self.max_attempts and self.hasOutflowFile(upload)]
+            print("INFO: {0} uploads pending from a previous run ...".format(len(self.pending)))
+
+        self.uploaders = []
+        for _ in range(num_uploaders):
+            uploader = threading.Thread(target=self.runUploader)
+            uploader.daemon = True
+            uploader.start()
+            self.uploaders.append(uploader)
+
+    def write(self):
+        """
+        Writes the pending uploads to the queue file.
+        Called with the condition acquired.
+        """
+        temp_queue_file = "{0}.tmp".format(self.queue_file)
+        with open(temp_queue_file, 'w') as queue_json:
+            json.dump({'version': UPLOAD_QUEUE_VERSION,
+                       'uploads': self.uploading + self.pending},
+                      queue_json, indent=2, sort_keys=True)
+        os.rename(temp_queue_file, self.queue_file)
+
+    def hasOutflowFile(self, upload):
+        """
+        Returns True if the outflow file of the upload exists,
+        otherwise the upload is dropped
+        """
+        outflow_file_name = upload['job_info'].get('outflow_file_name')
+        if outflow_file_name is None or os.path.exists(outflow_file_name):
+            return True
+        print("WARNING: {0} no longer exists. Dropping its upload ...".format(outflow_file_name))
+        return False
+
+    def put(self, job_info):
+        """
+        Adds the forecast of the job to the uploads
+        """
+        with self.condition:
+            while len(self.pending) >= self.max_pending and not self.stopped:
+                self.condition.wait(1)
+            self.pending.append({'job_info': job_info, 'attempts': 0, 'next_attempt_time': 0})
+            self.write()
+            self.condition.notify_all()
+
+    def getNextUpload(self):
+        """
+        Returns the next upload ready to be tried and the seconds
+        to wait for the next upload otherwise.
+        Called with the condition acquired.
+        """
+        if not self.pending:
+            return None, None
+        upload = min(self.pending, key=lambda pending_upload: pending_upload['next_attempt_time'])
+        wait_seconds = upload['next_attempt_time'] - time.time()
+        if wait_seconds > 0:
+            return None, wait_seconds
+        return upload, None
+
+    def runUploader(self):
+        """
+        Uploads the pending forecasts in an uploader thread
+        """
+        data_manager = self.data_manager_factory()
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopped:
+                        return
+                    upload, wait_seconds = self.getNextUpload()
+                    if upload is not None:
+                        break
+                    self.condition.wait(wait_seconds if wait_seconds is not None else 1)
+                self.pending.remove(upload)
+                if not self.hasOutflowFile(upload):
+                    self.write()
+                    self.condition.notify_all()
+                    continue
+                self.uploading.append(upload)
+                self.condition.notify_all()
+
+            upload_success = False
+            try:
+                upload_success = self.upload_function(upload['job_info'], data_manager)
+            except Exception:
+                traceback.print_exc()
+
+            with self.condition:
+                self.uploading.remove(upload)
+                if not upload_success:
+                    upload['attempts'] += 1
+                    if upload['attempts'] >= self.max_attempts:
+                        print("ERROR: Upload of {0} failed after {1} attempts. Dropping it ..."
+                              .format(upload['job_info'].get('outflow_file_name'), upload['attempts']))
+                    else:
+                        retry_seconds = min(self.backoff_seconds * 2 ** (upload['attempts'] - 1),
+                                            self.max_backoff_seconds)
+                        print("WARNING: Upload of {0} failed. Retrying in {1} seconds ..."
+                              .format(upload['job_info'].get('outflow_file_name'), retry_seconds))
+                        upload['next_attempt_time'] = time.time() + retry_seconds
+                        self.pending.append(upload)
+                self.write()
+                self.condition.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Waits for the pending uploads to succeed or fail, or for
+        timeout seconds. Returns True if no uploads are pending.
+        """
+        time_stop = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while (self.pending or self.uploading) and not self.stopped \
+                    and any(uploader.is_alive() for uploader in self.uploaders):
+                if time_stop is not None and time.time() >= time_stop:
+                    break
+                self.condition.wait(1)
+            return not (self.pending or self.uploading)
+
+    def getUploadsNotDone(self):
+        """
+        Returns the job info of the uploads pending
+        """
+        with self.condition:
+            return [upload['job_info'] for upload in self.uploading + self.pending]
+
+    def close(self, wait=True, timeout=None):
+        """
+        Stops the uploaders after the pending uploads if wait is True
+        (for up to timeout seconds), otherwise after the current uploads.
+        Uploads not done are kept in the queue file for the next run.
+        """
+        if wait:
+            self.join(timeout)
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for uploader in self.uploaders:
+            uploader.join()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+##
+##  watershed_input_manifest.py
+##  spt_compute
+##
+##  License: BSD 3-Clause
+
+import json
+import os
+import re
+
+WATERSHED_INPUT_MANIFEST_VERSION = 1
+
+# patterns of the watershed input files searched for by the jobs
+WATERSHED_INPUT_FILE_PATTERNS = {
+    'rapid_connect': r'rapid_connect\.csv',
+    'riv_bas_id': r'riv_bas_id.*?\.csv',
+    'k': r'k\.csv',
+    'x': r'x\.csv',
+    'qfor': r'qfor\.csv',
+    'for_tot_id': r'for_tot_id\.csv',
+    'for_use_id': r'for_use_id\.csv',
+    'comid_lat_lon_z': r'comid_lat_lon_z.*?\.csv',
+    # weight tables of the ECMWF grids
+    'weight_ecmwf_t1279': r'weight_ecmwf_t1279\.csv',
+    'weight_ecmwf_tco639': r'weight_ecmwf_tco639\.csv',
+}
+
+#------------------------------------------------------------------------------
+#functions
+#------------------------------------------------------------------------------
+def build_watershed_input_manifest(watershed_input_directory):
+    """
+    Finds all of the watershed input files with one listing of the directory
+
+    The files are found with the same case insensitive search as
+    case_insensitive_file_search. The manifest has the file name of each
+    input file (None if missing) and the modification time of the
+    directory when it was listed.
+    """
+    directory_mtime = os.path.getmtime(watershed_input_directory)
+    file_list = os.listdir(watershed_input_directory)
+    input_files = {}
+    for file_role, pattern in WATERSHED_INPUT_FILE_PATTERNS.items():
+        input_files[file_role] = next((filename for filename in file_list
+                                       if re.search(pattern, filename, re.IGNORECASE)), None)
+    return {
+        'version': WATERSHED_INPUT_MANIFEST_VERSION,
+        'directory_mtime': directory_mtime,
+        'files': input_files,
+    }
+
+
+def get_watershed_input_manifest(watershed_input_directory, input_manifest=None,
+                                 validate=True):
+    """
+    Returns the input manifest if the directory has not changed since
+    it was built, otherwise builds a new manifest. With validate=False,
+    the manifest is used without checking the directory (e.g. an HTCondor
+    job with its own copy of the directory).
+    """
+    if input_manifest is not None \
+            and input_manifest.get('version') == WATERSHED_INPUT_MANIFEST_VERSION \
+            and (not validate or input_manifest['directory_mtime'] ==
+                 os.path.getmtime(watershed_input_directory)):
+        return input_manifest
+    return build_watershed_input_manifest(watershed_input_directory)
+
+
+def get_watershed_input_file(watershed_input_directory, input_manifest, file_role):
+    """
+    Returns the path to the input file in the manifest.
+    Raises IndexError if the file is missing like case_insensitive_file_search.
+    """
+    filename = input_manifest['files'].get(file_role)
+    if filename is None:
+        print("{0} not found".format(WATERSHED_INPUT_FILE_PATTERNS.get(file_role, file_role)))
+        raise IndexError("{0} not found".format(file_role))
+    return os.path.join(watershed_input_directory, filename)
+
+
+def write_watershed_input_manifest(input_manifest, manifest_file):
+    """
+    Writes the input manifest to a json file
+    """
+    with open(manifest_file, 'w') as manifest_json:
+        json.dump(input_manifest, manifest_json, indent=2, sort_keys=True)
+
+
+def read_watershed_input_manifest(manifest_file):
+    """
+    Reads the input manifest from a json file
+    """
+    with open(manifest_file) as manifest_json:
+        return json.load(manifest_json)
+
+
+def get_watershed_river_count(watershed_input_directory, input_manifest,
+                              file_role='riv_bas_id'):
+    """
+    Returns the number of rivers in the riv_bas_id file (the rivers in
+    the Qout files of the watershed), or in the rapid_connect file (the
+    rivers RAPID routes) with file_role='rapid_connect'.
+    Returns None if the file is missing.
+    """
+    try:
+        river_file = get_watershed_input_file(watershed_input_directory,
+                                              input_manifest, file_role)
+    except IndexError:
+        return None
+    with open(river_file) as river_csv:
+        return sum(1 for line in river_csv if line.strip())
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+##
+##  worker_pool.py
+##  spt_compute
+##
+##  License: BSD 3-Clause
+
+from bisect import insort
+from collections import deque, OrderedDict
+from multiprocessing import cpu_count, Process, Queue
+import time
+import traceback
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+#------------------------------------------------------------------------------
+#functions
+#------------------------------------------------------------------------------
+def _affinity_worker(worker_index, task_queue, result_queue, initializer, initargs):
+    """
+    Runs the tasks sent to one worker of the pool until it gets None
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        task_index, func, args = task
+        try:
+            result_queue.put((worker_index, task_index, True, func(args)))
+        except Exception:
+            result_queue.put((worker_index, task_index, False, traceback.format_exc()))
+
+
+class AffinityWorkerPool(object):
+    """
+    Pool of worker processes kept for a whole run
+
+    The pending tasks start in order of priority, largest first, then in
+    the order submitted. Each task has an affinity key (e.g. the
+    watershed). A task is sent to
+    an idle worker that ran a task with the same key recently, so the state
+    the worker loaded for the key is reused. Otherwise it goes to the idle
+    worker with the fewest recent keys.
+
+    With a memory budget, a task is started only if the estimated memory
+    of the running tasks and the task is within the budget. The first
+    pending task that fits is started, and a task larger than the budget
+    is run alone. The first pending task is overtaken by at most
+    max_overtakes tasks (the number of workers by default), then the
+    pool waits for the memory it needs so it does not wait to the end.
+
+    The workers are checked every poll_seconds while waiting for a task.
+    If a worker stopped (e.g. killed when out of memory), its task fails
+    and the worker is started again.
+    """
+    def __init__(self, processes=None, initializer=None, initargs=(),
+                 affinity_keys_per_worker=4, memory_budget_mb=None,
+                 poll_seconds=5, max_overtakes=None):
+        self.processes = processes or cpu_count()
+        self.affinity_keys_per_worker = affinity_keys_per_worker
+        self.memory_budget_mb = memory_budget_mb
+        self.max_overtakes = self.processes if max_overtakes is None else max_overtakes
+        self.poll_seconds = poll_seconds
+        self._initializer = initializer
+        self._initargs = initargs
+        self._result_queue = Queue()
+        self._task_queues = [None] * self.processes
+        self._workers = [None] * self.processes
+        # recent affinity keys of each worker, most recent last
+        self._worker_keys = [OrderedDict() for _ in range(self.processes)]
+        # task running on each worker and the results of the finished
+        # tasks not returned yet, including the tasks of stopped workers
+        self._worker_tasks = {}
+        self._finished_results = deque()
+        for worker_index in range(self.processes):
+            self._start_worker(worker_index)
+        # submitted tasks by id: function, argument, affinity key, memory and priority
+        self._tasks = {}
+        self._next_task_id = 0
+        # (-priority, task id) of the pending tasks in the order they start
+        self._pending_tasks = []
+        self._running_tasks = set()
+        self._idle_workers = list(range(self.processes))
+        self._running_memory_mb = 0
+        # first pending task and the number of tasks started before it
+        self._overtaken_task = None
+        self._num_overtakes = 0
+
+    def _start_worker(self, worker_index):
+        """
+        Start the worker process with a new task queue
+        """
+        task_queue = Queue()
+        worker = Process(target=_affinity_worker,
+                         args=(worker_index, task_queue, self._result_queue,
+                               self._initializer, self._initargs))
+        worker.daemon = True
+        worker.start()
+        self._task_queues[worker_index] = task_queue
+        self._workers[worker_index] = worker
+        self._worker_keys[worker_index] = OrderedDict()
+
+    def _choose_worker(self, idle_workers, affinity_key):
+        """
+        Choose the idle worker for the task with the affinity key
+        """
+        if affinity_key is not None:
+            affinity_workers = [worker_index for worker_index in idle_workers
+                                if affinity_key in self._worker_keys[worker_index]]
+            if affinity_workers:
+                return affinity_workers[0]
+        return min(idle_workers, key=lambda worker_index: (len(self._worker_keys[worker_index]),
+                                                           worker_index))
+
+    def _remember_key(self, worker_index, affinity_key):
+        """
+        Store the affinity key as the most recent key of the worker
+        """
+        if affinity_key is None:
+            return
+        worker_keys = self._worker_keys[worker_index]
+        worker_keys.pop(affinity_key, None)
+        worker_keys[affinity_key] = True
+        while len(worker_keys) > self.affinity_keys_per_worker:
+            worker_keys.popitem(last=False)
+
+    def _next_task(self):
+        """
+        Returns the next pending task to start within the memory budget
+        or None if the tasks have to wait for running tasks to finish
+        """
+        first_task_id = self._pending_tasks[0][1]
+        if self.memory_budget_mb is None:
+            return first_task_id
+        if self._overtaken_task != first_task_id:
+            self._overtaken_task = first_task_id
+            self._num_overtakes = 0
+        for _, task_id in self._pending_tasks:
+            task_memory_mb = self._tasks[task_id][3]
+            if task_memory_mb is None or \
+                    self._running_memory_mb + task_memory_mb <= self.memory_budget_mb:
+                if task_id != first_task_id:
+                    if self._num_overtakes >= self.max_overtakes:
+                        return None
+                    self._num_overtakes += 1
+                return task_id
+        if not self._running_tasks:
+            return first_task_id
+        return None
+
+    def _start_tasks(self):
+        """
+        Starts pending tasks on the idle workers
+        """
+        while self._pending_tasks and self._idle_workers:
+            task_id = self._next_task()
+            if task_id is None:
+                break
+            func, args, affinity_key, memory_mb, priority = self._tasks[task_id]
+            self._pending_tasks.remove((-priority, task_id))
+            worker_index = self._choose_worker(self._idle_workers, affinity_key)
+            self._idle_workers.remove(worker_index)
+            self._remember_key(worker_index, affinity_key)
+            self._running_tasks.add(task_id)
+            self._worker_tasks[worker_index] = task_id
+            self._running_memory_mb += memory_mb or 0
+            self._task_queues[worker_index].put((task_id, func, args))
+
+    def submit(self, func, args, affinity_key=None, memory_mb=None, priority=0):
+        """
+        Submits func(args) to run on a worker and returns the task id.
+        The task is started when a worker is idle and the estimated
+        memory of the task, memory_mb, is within the memory budget.
+        The pending tasks with the largest priority start first.
+        """
+        task_id = self._next_task_id
+        self._next_task_id += 1
+        self._tasks[task_id] = (func, args, affinity_key, memory_mb, priority)
+        insort(self._pending_tasks, (-priority, task_id))
+        self._start_tasks()
+        return task_id
+
+    def numTasks(self):
+        """
+        Returns the number of pending and running tasks
+        """
+        return len(self._pending_tasks) + len(self._running_tasks)
+
+    def waitAny(self, timeout=None):
+        """
+        Waits for a running task to finish and returns the task id,
+        True if it succeeded and its result, or False and the traceback.
+        Returns None if no task finished within timeout seconds.
+        """
+        if not self._running_tasks:
+            raise ValueError("No tasks are running in the pool")
+        wait_end_time = None if timeout is None else time.time() + timeout
+        while True:
+            while not self._finished_results:
+                wait_seconds = self.poll_seconds
+                if wait_end_time is not None:
+                    wait_seconds = max(min(wait_seconds, wait_end_time - time.time()), 0)
+                try:
+                    self._finished_results.append(self._result_queue.get(timeout=wait_seconds))
+                except Empty:
+                    self._restart_stopped_workers()
+                    if not self._finished_results and wait_end_time is not None \
+                            and time.time() >= wait_end_time:
+                        return None
+            worker_index, task_id, success, result = self._finished_results.popleft()
+            # a task is returned once (e.g. not again if its worker
+            # stopped after the result was read as a failure)
+            if task_id in self._running_tasks:
+                break
+        del self._worker_tasks[worker_index]
+        self._idle_workers.append(worker_index)
+        self._running_tasks.remove(task_id)
+        self._running_memory_mb -= self._tasks.pop(task_id)[3] or 0
+        self._start_tasks()
+        return task_id, success, result
+
+    def _restart_stopped_workers(self):
+        """
+        Starts the workers that stopped again. The tasks running on the
+        stopped workers fail, unless their result is in the result queue
+        (e.g. the worker stopped after the task finished).
+        """
+        stopped_workers = [worker_index for worker_index, worker in enumerate(self._workers)
+                           if not worker.is_alive()]
+        if not stopped_workers:
+            return
+        # the results put by the workers before they stopped
+        while True:
+            try:
+                self._finished_results.append(self._result_queue.get_nowait())
+            except Empty:
+                break
+        finished_task_ids = set(finished_result[1] for finished_result in self._finished_results)
+        for worker_index in stopped_workers:
+            worker = self._workers[worker_index]
+            worker.join()
+            print("WARNING: Worker {0} stopped with exit code {1}. Starting it again ..."
+                  .format(worker_index, worker.exitcode))
+            self._start_worker(worker_index)
+            if worker_index in self._worker_tasks \
+                    and self._worker_tasks[worker_index] not in finished_task_ids:
+                self._finished_results.append(
+                    (worker_index, self._worker_tasks[worker_index], False,
+                     "Worker {0} stopped with exit code {1} while running the task "
+                     "(e.g. killed when out of memory)".format(worker_index, worker.exitcode)))
+
+    def cancel(self):
+        """
+        Removes the pending tasks and waits for the running tasks to finish
+        """
+        for _, task_id in self._pending_tasks:
+            self._tasks.pop(task_id)
+        del self._pending_tasks[:]
+        while self._running_tasks:
+            self.waitAny()
+
+    def imap_unordered(self, func, iterable, affinity_key=None, task_memory_mb=None):
+        """
+        Runs func on each item and yields the results as they finish
+
+        affinity_key is the key of all of the items or a function
+        returning the key of an item. task_memory_mb is a function
+        returning the estimated memory of an item in MB for the memory
+        budget. If a task fails, the running tasks are finished and
+        the error is raised.
+        """
+        task_error = None
+        try:
+            for task in iterable:
+                self.submit(func, task,
+                            affinity_key(task) if callable(affinity_key) else affinity_key,
+                            task_memory_mb(task) if task_memory_mb is not None else None)
+            while self._running_tasks:
+                _, success, result = self.waitAny()
+                if not success:
+                    task_error = task_error or result
+                    # the results of the running tasks are not yielded
+                    self.cancel()
+                elif task_error is None:
+                    yield result
+        finally:
+            # the results of the running tasks are not left for the next call
+            self.cancel()
+
+        if task_error is not None:
+            raise Exception(task_error)
+
+    def close(self):
+        """
+        Stop the workers when they finish their tasks
+        """
+        for task_queue in self._task_queues:
+            task_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def terminate(self):
+        """
+        Stop the workers immediately
+        """
+        for worker in self._workers:
+            worker.terminate()
+        for worker in self._workers:
+            worker.join()
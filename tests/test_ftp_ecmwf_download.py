@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from spt_compute.imports import ftp_ecmwf_download
+from spt_compute.imports.ftp_ecmwf_download import (ForecastPrefetcher,
+                                                    get_ftp_download_paths,
+                                                    remove_old_ftp_downloads)
+
+FTP_FILES = ["Runoff.20170708.00.netcdf.tar.gz",
+             "Runoff.20170708.12.netcdf.tar.gz",
+             "Runoff.20170709.00.netcdf.tar.gz"]
+
+
+class FakeDownloads(object):
+    """
+    Extracts an empty forecast in place of the FTP download
+    """
+    def __init__(self):
+        self.downloaded = []
+
+    def __call__(self, download_dir, file_to_download, *args, **kwargs):
+        local_dir = get_ftp_download_paths(download_dir, file_to_download)[1]
+        os.mkdir(local_dir)
+        with open(os.path.join(local_dir, "52.runoff.nc"), "w") as forecast_file:
+            forecast_file.write("0" * 1000)
+        self.downloaded.append(file_to_download)
+        return local_dir
+
+
+def test_remove_old_ftp_downloads(tmpdir):
+    """
+    Test the past downloads are removed except the kept paths
+    """
+    for ftp_file in FTP_FILES:
+        os.mkdir(get_ftp_download_paths(str(tmpdir), ftp_file)[1])
+    remove_old_ftp_downloads(str(tmpdir), keep_paths=get_ftp_download_paths(str(tmpdir), FTP_FILES[1]))
+    assert os.listdir(str(tmpdir)) == ["Runoff.20170708.12.netcdf"]
+
+
+def test_forecast_prefetcher(tmpdir, monkeypatch):
+    """
+    Test the next forecast is downloaded before it is needed
+    and the past forecasts are removed
+    """
+    fake_downloads = FakeDownloads()
+    monkeypatch.setattr(ftp_ecmwf_download, "download_and_extract_ftp", fake_downloads)
+    forecast_prefetcher = ForecastPrefetcher(str(tmpdir), FTP_FILES, "ftp.host", "login", "passwd", "",
+                                             look_ahead=1)
+    try:
+        local_dir = forecast_prefetcher.get(0)
+        assert local_dir == get_ftp_download_paths(str(tmpdir), FTP_FILES[0])[1]
+        # the next forecast is downloaded, but not the one after it
+        with forecast_prefetcher.condition:
+            while 1 not in forecast_prefetcher.results:
+                forecast_prefetcher.condition.wait(1)
+        assert fake_downloads.downloaded == FTP_FILES[:2]
+
+        forecast_prefetcher.get(1)
+        forecast_prefetcher.get(2)
+        assert fake_downloads.downloaded == FTP_FILES
+        assert os.listdir(str(tmpdir)) == ["Runoff.20170709.00.netcdf"]
+    finally:
+        forecast_prefetcher.close()
+
+
+def test_forecast_prefetcher_disk_space(tmpdir, monkeypatch):
+    """
+    Test the next forecast is not prefetched without the space for it
+    """
+    fake_downloads = FakeDownloads()
+    monkeypatch.setattr(ftp_ecmwf_download, "download_and_extract_ftp", fake_downloads)
+    monkeypatch.setattr(ftp_ecmwf_download, "get_free_space_mb", lambda directory: 0.001)
+    forecast_prefetcher = ForecastPrefetcher(str(tmpdir), FTP_FILES, "ftp.host", "login", "passwd", "",
+                                             look_ahead=2, remove_past_downloads=False)
+    try:
+        forecast_prefetcher.get(0)
+        assert not forecast_prefetcher.canDownload(1)
+        assert fake_downloads.downloaded == FTP_FILES[:1]
+        forecast_prefetcher.get(1)
+        assert fake_downloads.downloaded == FTP_FILES[:2]
+    finally:
+        forecast_prefetcher.close()
+
+
+def test_forecast_prefetcher_error(tmpdir, monkeypatch):
+    """
+    Test a failed download raises an error when the forecast is needed
+    """
+    def fail_download(*args, **kwargs):
+        raise IOError("FTP connection failed")
+    monkeypatch.setattr(ftp_ecmwf_download, "download_and_extract_ftp", fail_download)
+    forecast_prefetcher = ForecastPrefetcher(str(tmpdir), FTP_FILES, "ftp.host", "login", "passwd", "")
+    try:
+        with pytest.raises(Exception) as ex:
+            forecast_prefetcher.get(0)
+        assert "FTP connection failed" in str(ex.value)
+    finally:
+        forecast_prefetcher.close()
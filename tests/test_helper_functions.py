@@ -0,0 +1,53 @@
+import os
+
+from spt_compute.imports.helper_functions import (clean_job_directories,
+                                                  get_free_space_mb,
+                                                  get_staging_directory,
+                                                  publish_file)
+
+
+def test_staging_directory(tmpdir):
+    """
+    Test the job directory is staged when there is space and falls back otherwise
+    """
+    execute_directory = tmpdir.mkdir("execute")
+    staging_directory = tmpdir.mkdir("staging")
+    free_space_mb = get_free_space_mb(str(staging_directory))
+    assert free_space_mb > 0
+
+    job_directory = get_staging_directory(str(execute_directory), "job_1", 1,
+                                          [str(tmpdir.join("missing")), str(staging_directory)])
+    assert job_directory == str(staging_directory.join("job_1"))
+    assert os.path.isdir(job_directory)
+
+    job_directory = get_staging_directory(str(execute_directory), "job_2", free_space_mb * 2,
+                                          [str(staging_directory)])
+    assert job_directory == str(execute_directory.join("job_2"))
+    assert os.path.isdir(job_directory)
+
+
+def test_publish_file(tmpdir):
+    """
+    Test the published file replaces the destination and the source is removed
+    """
+    source_file = tmpdir.mkdir("node").join("Qout_1.nc")
+    source_file.write("new")
+    destination_file = tmpdir.mkdir("output").join("Qout_1.nc")
+    destination_file.write("old")
+
+    publish_file(str(source_file), str(destination_file))
+    assert destination_file.read() == "new"
+    assert not source_file.exists()
+    assert [output_file.basename for output_file in tmpdir.join("output").listdir()] == ["Qout_1.nc"]
+
+
+def test_clean_job_directories(tmpdir):
+    """
+    Test the job directories of other forecasts are removed
+    """
+    staging_directory = tmpdir.mkdir("staging")
+    for directory in ("job_20170707.12_haina_river_52", "job_20170708.00_haina_river_52", "other"):
+        staging_directory.mkdir(directory)
+    clean_job_directories([str(staging_directory), str(tmpdir.join("missing"))], "20170708.00")
+    assert sorted(directory.basename for directory in staging_directory.listdir()) == \
+        ["job_20170708.00_haina_river_52", "other"]
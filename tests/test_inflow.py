@@ -0,0 +1,419 @@
+from netCDF4 import Dataset
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+import os
+import pytest
+
+from spt_compute.imports.CreateInflowFileFromECMWFRunoff import CreateInflowFileFromECMWFRunoff
+from spt_compute.imports.ecmwf_forecast_metadata import (build_forecast_metadata_index,
+                                                         get_forecast_metadata_index_file,
+                                                         load_forecast_metadata_index)
+from spt_compute.imports.ecmwf_regional_inflow import get_regional_inflow_batches
+
+# hours of each time step in the ECMWF forecasts
+FORECAST_HOURS = {
+    'LowRes': list(range(0, 361, 6)),
+    'LowResFull': list(range(0, 145, 3)) + list(range(150, 361, 6)),
+    'HighRes': list(range(0, 91)) + list(range(93, 145, 3)) + list(range(150, 241, 6)),
+}
+
+# time intervals the forecast process generates inflow for
+TIME_INTERVALS = {
+    'LowRes': ["6hr"],
+    'LowResFull': ["3hr_subset", "6hr_subset", "6hr"],
+    'HighRes': ["1hr", "3hr", "3hr_subset", "6hr_subset", "6hr"],
+}
+
+
+def create_ecmwf_runoff_file(out_nc, resolution, num_lat=12, num_lon=15, seed=0):
+    """
+    Creates a cumulative ECMWF runoff file with random values in mm
+    """
+    hours = FORECAST_HOURS[resolution]
+    random_state = np.random.RandomState(seed)
+    runoff = random_state.uniform(-0.001, 0.5, size=(len(hours), num_lat, num_lon))
+    # occasional decreases in the cumulative runoff
+    runoff[random_state.uniform(size=runoff.shape) < 0.05] *= -1
+    with Dataset(out_nc, 'w') as data_nc:
+        data_nc.createDimension('lon', num_lon)
+        data_nc.createDimension('lat', num_lat)
+        data_nc.createDimension('time', len(hours))
+        data_nc.createVariable('lon', 'f8', ('lon',))[:] = np.linspace(-75, -68, num_lon)
+        data_nc.createVariable('lat', 'f8', ('lat',))[:] = np.linspace(21, 16, num_lat)
+        data_nc.createVariable('time', 'f8', ('time',))[:] = hours
+        data_nc.createVariable('RO', 'f4', ('time', 'lat', 'lon'))[:] = np.cumsum(runoff, axis=0)
+
+
+def create_weight_table(out_csv, num_streams=40, num_lat=12, num_lon=15, seed=0):
+    """
+    Creates a weight table where some streams share grid cells
+    """
+    random_state = np.random.RandomState(seed)
+    with open(out_csv, 'w') as weight_file:
+        weight_file.write("rivid,area_sqm,lon_index,lat_index,npoints,weight,Lon,Lat\n")
+        for stream_index in range(num_streams):
+            npoints = random_state.randint(1, 12)
+            for _ in range(npoints):
+                weight_file.write("{0},{1},{2},{3},{4},0.5,-70.0,18.0\n"
+                                  .format(1000 + stream_index,
+                                          random_state.uniform(0, 5e7),
+                                          random_state.randint(2, num_lon),
+                                          random_state.randint(1, num_lat - 1),
+                                          npoints))
+
+
+@pytest.fixture(scope="module")
+def inflow_setup(tclean):
+    weight_table = os.path.join(tclean.output, 'weight_ecmwf_tco639.csv')
+    create_weight_table(weight_table)
+    runoff_files = {}
+    for resolution in FORECAST_HOURS:
+        runoff_files[resolution] = os.path.join(tclean.output, '{0}.runoff.nc'.format(resolution))
+        create_ecmwf_runoff_file(runoff_files[resolution], resolution)
+    return tclean.output, weight_table, runoff_files
+
+
+def read_inflow(inflow_file):
+    """returns the inflow in the m3_riv file"""
+    with Dataset(inflow_file) as inflow_nc:
+        return inflow_nc.variables['m3_riv'][:]
+
+
+@pytest.mark.parametrize("resolution", sorted(FORECAST_HOURS))
+def test_sparse_inflow_matches_loop(inflow_setup, resolution):
+    """
+    Test the sparse matrix inflow is the same as computing one stream at a time
+    """
+    output_dir, weight_table, runoff_files = inflow_setup
+    for time_interval in TIME_INTERVALS[resolution]:
+        inflow_files = {}
+        for inflow_method in ("sparse", "loop"):
+            inflow_files[inflow_method] = os.path.join(output_dir, 'm3_riv_{0}.nc'.format(inflow_method))
+            CreateInflowFileFromECMWFRunoff(inflow_method=inflow_method)\
+                .execute(runoff_files[resolution], weight_table,
+                         inflow_files[inflow_method], 'ecmwf_tco639', time_interval)
+
+        sparse_inflow = read_inflow(inflow_files['sparse'])
+        assert sparse_inflow.shape == (len(CreateInflowFileFromECMWFRunoff()
+                                           .getTimeIndices(resolution, time_interval)[0]), 40)
+        assert_allclose(sparse_inflow, read_inflow(inflow_files['loop']), rtol=1e-6)
+
+
+def test_weight_table_cache(inflow_setup):
+    """
+    Test the compiled weight table is reused and rebuilt when the csv changes
+    """
+    output_dir, weight_table, runoff_files = inflow_setup
+    cached_weight_table = os.path.join(output_dir, 'weight_cache_test.csv')
+    create_weight_table(cached_weight_table, seed=1)
+    inflow_tool = CreateInflowFileFromECMWFRunoff()
+    cache_file = inflow_tool.getWeightTableCacheFile(cached_weight_table)
+    assert cache_file.endswith('weight_cache_test.npz')
+
+    compiled = inflow_tool.readWeightTable(cached_weight_table)
+    assert os.path.exists(cache_file)
+    cached = inflow_tool.loadWeightTableCache(cached_weight_table)
+    for key, value in compiled.items():
+        assert_array_equal(cached[key], value)
+
+    # a new modification time with the same contents keeps the cache
+    # and the cache is updated so the csv is not hashed again
+    os.utime(cached_weight_table, (1e9, 1e9))
+    assert inflow_tool.loadWeightTableCache(cached_weight_table) is not None
+    with np.load(cache_file) as cache_npz:
+        assert cache_npz['csv_mtime'].item() == 1e9
+
+    # new contents invalidate the cache
+    create_weight_table(cached_weight_table, num_streams=10, seed=2)
+    assert inflow_tool.loadWeightTableCache(cached_weight_table) is None
+    # the cache is rebuilt without changing the input directory
+    os.utime(output_dir, (1e9, 1e9))
+    compiled = inflow_tool.readWeightTable(cached_weight_table)
+    assert os.path.getmtime(output_dir) == 1e9
+    assert compiled['stream_id'].size == 10
+    assert_array_equal(inflow_tool.loadWeightTableCache(cached_weight_table)['stream_id'],
+                       compiled['stream_id'])
+
+
+@pytest.mark.parametrize("resolution", sorted(FORECAST_HOURS))
+def test_inflow_multiple_intervals(inflow_setup, resolution):
+    """
+    Test the inflow of several intervals from one read matches separate runs
+    """
+    output_dir, weight_table, runoff_files = inflow_setup
+    inflow_tool = CreateInflowFileFromECMWFRunoff()
+    time_intervals = TIME_INTERVALS[resolution]
+    multi_files = [os.path.join(output_dir, 'm3_riv_multi_{0}.nc'.format(time_interval))
+                   for time_interval in time_intervals]
+    inflow_tool.executeMultipleIntervals(runoff_files[resolution], weight_table,
+                                         multi_files, 'ecmwf_tco639', time_intervals)
+    single_file = os.path.join(output_dir, 'm3_riv_single.nc')
+    for multi_file, time_interval in zip(multi_files, time_intervals):
+        inflow_tool.execute(runoff_files[resolution], weight_table,
+                            single_file, 'ecmwf_tco639', time_interval)
+        assert_array_equal(read_inflow(multi_file), read_inflow(single_file))
+
+
+@pytest.mark.parametrize("resolution", sorted(FORECAST_HOURS))
+@pytest.mark.parametrize("memory_limit_mb", (0.0001, 0.02))
+def test_inflow_time_blocks(inflow_setup, resolution, memory_limit_mb):
+    """
+    Test the inflow computed in blocks of time steps matches one read
+    """
+    output_dir, weight_table, runoff_files = inflow_setup
+    time_intervals = TIME_INTERVALS[resolution]
+    block_files = [os.path.join(output_dir, 'm3_riv_block_{0}.nc'.format(time_interval))
+                   for time_interval in time_intervals]
+    block_tool = CreateInflowFileFromECMWFRunoff(memory_limit_mb=memory_limit_mb)
+    assert block_tool.getTimeBlockSize(block_tool.readWeightTable(weight_table),
+                                       len(time_intervals)) < len(FORECAST_HOURS[resolution])
+    block_tool.executeMultipleIntervals(runoff_files[resolution], weight_table,
+                                        block_files, 'ecmwf_tco639', time_intervals)
+
+    single_file = os.path.join(output_dir, 'm3_riv_single.nc')
+    for block_file, time_interval in zip(block_files, time_intervals):
+        CreateInflowFileFromECMWFRunoff().execute(runoff_files[resolution], weight_table,
+                                                  single_file, 'ecmwf_tco639', time_interval)
+        assert_array_equal(read_inflow(block_file), read_inflow(single_file))
+
+
+def test_inflow_multiple_watersheds(inflow_setup):
+    """
+    Test the inflow of several watersheds from one read matches separate runs
+    """
+    output_dir, weight_table, runoff_files = inflow_setup
+    inflow_tool = CreateInflowFileFromECMWFRunoff()
+    watershed_weight_tables = [weight_table]
+    for seed in (3, 4):
+        watershed_weight_tables.append(os.path.join(output_dir, 'weight_watershed_{0}.csv'.format(seed)))
+        create_weight_table(watershed_weight_tables[-1], num_streams=15, seed=seed)
+
+    time_intervals = TIME_INTERVALS['HighRes']
+    watershed_inflow_list = []
+    for watershed_index, watershed_weight_table in enumerate(watershed_weight_tables):
+        watershed_inflow_list.append((watershed_weight_table,
+                                      [os.path.join(output_dir, 'm3_riv_{0}_{1}.nc'.format(watershed_index,
+                                                                                          time_interval))
+                                       for time_interval in time_intervals],
+                                      time_intervals))
+    inflow_tool.executeMultipleWatersheds(runoff_files['HighRes'], watershed_inflow_list, 'ecmwf_t1279')
+
+    single_file = os.path.join(output_dir, 'm3_riv_single.nc')
+    for watershed_weight_table, inflow_files, _ in watershed_inflow_list:
+        for inflow_file, time_interval in zip(inflow_files, time_intervals):
+            inflow_tool.execute(runoff_files['HighRes'], watershed_weight_table,
+                                single_file, 'ecmwf_t1279', time_interval)
+            assert_array_equal(read_inflow(inflow_file), read_inflow(single_file))
+
+
+@pytest.mark.parametrize("inflow_method", ("sparse", "loop"))
+def test_inflow_multiple_ensembles(inflow_setup, inflow_method):
+    """
+    Test the inflow of an ensemble batch matches separate runs of each member
+    """
+    output_dir, weight_table, runoff_files = inflow_setup
+    inflow_tool = CreateInflowFileFromECMWFRunoff(inflow_method=inflow_method)
+    ensemble_files = []
+    for ensemble_number in range(1, 5):
+        ensemble_files.append(os.path.join(output_dir, '{0}.ensemble_{1}.nc'.format(ensemble_number,
+                                                                                    inflow_method)))
+        create_ecmwf_runoff_file(ensemble_files[-1], 'LowRes', seed=10 + ensemble_number)
+
+    time_intervals = ["6hr"]
+    out_nc_lists = [[os.path.join(output_dir, 'm3_riv_ensemble_{0}.nc'.format(ensemble_index))]
+                    for ensemble_index in range(len(ensemble_files))]
+    inflow_tool.executeMultipleEnsembles(ensemble_files,
+                                         [(weight_table, out_nc_lists, time_intervals)],
+                                         'ecmwf_tco639')
+
+    single_file = os.path.join(output_dir, 'm3_riv_single.nc')
+    for ensemble_file, out_nc_list in zip(ensemble_files, out_nc_lists):
+        inflow_tool.execute(ensemble_file, weight_table,
+                            single_file, 'ecmwf_tco639', "6hr")
+        assert_array_equal(read_inflow(out_nc_list[0]), read_inflow(single_file))
+
+
+@pytest.mark.parametrize("memory_limit_mb", (0.0001, 0.02))
+def test_inflow_multiple_ensembles_time_blocks(inflow_setup, capsys, memory_limit_mb):
+    """
+    Test the inflow of an ensemble batch computed in blocks of time steps matches one read
+    """
+    output_dir, weight_table, runoff_files = inflow_setup
+    watershed_weight_table = os.path.join(output_dir, 'weight_watershed_block.csv')
+    create_weight_table(watershed_weight_table, num_streams=15, seed=5)
+    ensemble_files = []
+    for ensemble_number in range(1, 4):
+        ensemble_files.append(os.path.join(output_dir, '{0}.ensemble_block.nc'.format(ensemble_number)))
+        create_ecmwf_runoff_file(ensemble_files[-1], 'LowResFull', seed=20 + ensemble_number)
+
+    time_intervals = TIME_INTERVALS['LowResFull']
+    inflow_files = {}
+    for inflow_mode, inflow_tool in (("block", CreateInflowFileFromECMWFRunoff(memory_limit_mb=memory_limit_mb)),
+                                     ("single", CreateInflowFileFromECMWFRunoff())):
+        watershed_inflow_list = []
+        for watershed_index, watershed_table in enumerate((weight_table, watershed_weight_table)):
+            watershed_inflow_list.append((watershed_table,
+                                          [[os.path.join(output_dir, 'm3_riv_{0}_{1}_{2}_{3}.nc'.format(
+                                              inflow_mode, watershed_index, ensemble_index, time_interval))
+                                            for time_interval in time_intervals]
+                                           for ensemble_index in range(len(ensemble_files))],
+                                          time_intervals))
+        inflow_tool.executeMultipleEnsembles(ensemble_files, watershed_inflow_list, 'ecmwf_tco639')
+        inflow_files[inflow_mode] = [inflow_file for watershed_inflow in watershed_inflow_list
+                                     for out_nc_list in watershed_inflow[1] for inflow_file in out_nc_list]
+        if inflow_mode == "block":
+            assert "in blocks of" in capsys.readouterr().out
+
+    for block_file, single_file in zip(inflow_files["block"], inflow_files["single"]):
+        assert_array_equal(read_inflow(block_file), read_inflow(single_file))
+
+
+def test_regional_inflow_batches():
+    """
+    Test the ensemble batches have one resolution and a bounded size
+    """
+    ecmwf_forecasts = ["/forecasts/{0}.runoff.nc".format(ensemble_number) for ensemble_number in range(52, 0, -1)]
+    forecast_metadata = dict(("{0}.runoff.nc".format(ensemble_number),
+                              {'resolution': "HighRes" if ensemble_number == 52 else "LowResFull"})
+                             for ensemble_number in range(1, 53))
+    forecast_batches = get_regional_inflow_batches(ecmwf_forecasts, forecast_metadata, batch_size=13)
+    assert [len(forecast_batch) for forecast_batch in forecast_batches] == [1, 13, 13, 13, 12]
+    assert forecast_batches[0] == ["/forecasts/52.runoff.nc"]
+    assert forecast_batches[1][0] == "/forecasts/1.runoff.nc"
+    assert sorted(sum(forecast_batches, [])) == sorted(ecmwf_forecasts)
+
+
+def test_inflow_read_strategy(inflow_setup):
+    """
+    Test the row read of scattered cells matches the bounding box read
+    """
+    output_dir, weight_table, runoff_files = inflow_setup
+    diagonal_weight_table = os.path.join(output_dir, 'weight_diagonal.csv')
+    with open(diagonal_weight_table, 'w') as weight_file:
+        weight_file.write("rivid,area_sqm,lon_index,lat_index,npoints,weight,Lon,Lat\n")
+        for stream_index in range(10):
+            weight_file.write("{0},{1},{2},{3},1,1.0,-70.0,18.0\n"
+                              .format(2000 + stream_index, 1e7 * (stream_index + 1),
+                                      stream_index + 3, stream_index + 1))
+
+    inflow_tool = CreateInflowFileFromECMWFRunoff()
+    cells = inflow_tool.readWeightTable(diagonal_weight_table)
+    assert inflow_tool.getReadStrategy(cells['cell_lat_index'], cells['cell_lon_index'])[0] == "rows"
+    cells = inflow_tool.readWeightTable(weight_table)
+    assert inflow_tool.getReadStrategy(cells['cell_lat_index'], cells['cell_lon_index'])[0] == "bbox"
+
+    for test_weight_table in (diagonal_weight_table, weight_table):
+        inflow_files = {}
+        for read_strategy in ("bbox", "rows"):
+            inflow_files[read_strategy] = os.path.join(output_dir, 'm3_riv_{0}.nc'.format(read_strategy))
+            CreateInflowFileFromECMWFRunoff(read_strategy=read_strategy)\
+                .execute(runoff_files['HighRes'], test_weight_table,
+                         inflow_files[read_strategy], 'ecmwf_t1279', "1hr")
+        assert_array_equal(read_inflow(inflow_files['rows']), read_inflow(inflow_files['bbox']))
+
+
+@pytest.mark.parametrize("read_strategy", ("bbox", "rows"))
+def test_inflow_float32(inflow_setup, read_strategy):
+    """
+    Test the float32 inflow matches the float64 inflow, including missing runoff
+    """
+    output_dir, weight_table, runoff_files = inflow_setup
+    missing_runoff_file = os.path.join(output_dir, 'HighRes.missing_{0}.runoff.nc'.format(read_strategy))
+    create_ecmwf_runoff_file(missing_runoff_file, 'HighRes')
+    with Dataset(missing_runoff_file, 'a') as runoff_nc:
+        runoff_nc.variables['RO'][40:, 5, 6] = np.ma.masked
+        runoff_nc.variables['RO'][:, 7, 8] = np.ma.masked
+
+    for runoff_file in (runoff_files['HighRes'], missing_runoff_file):
+        inflow_files = {}
+        for inflow_precision in ("float64", "float32"):
+            inflow_files[inflow_precision] = os.path.join(output_dir,
+                                                          'm3_riv_{0}.nc'.format(inflow_precision))
+            CreateInflowFileFromECMWFRunoff(read_strategy=read_strategy,
+                                            inflow_precision=inflow_precision)\
+                .execute(runoff_file, weight_table, inflow_files[inflow_precision],
+                         'ecmwf_t1279', "3hr")
+        float64_inflow = read_inflow(inflow_files['float64'])
+        assert_allclose(read_inflow(inflow_files['float32']), float64_inflow,
+                        rtol=1e-5, atol=1e-6 * float64_inflow.max())
+
+    # the missing runoff is read without a masked array
+    inflow_tool = CreateInflowFileFromECMWFRunoff(read_strategy=read_strategy, inflow_precision="float32")
+    cells = inflow_tool.readWeightTable(weight_table)
+    data_cells = inflow_tool.readRunoff(missing_runoff_file, cells['cell_lat_index'],
+                                        cells['cell_lon_index'], 'ecmwf_t1279')[1]
+    assert not np.ma.isMaskedArray(data_cells)
+    assert data_cells.dtype == np.float32
+    assert np.isnan(data_cells).any()
+
+
+@pytest.mark.parametrize("inflow_format, inflow_complevel", [("NETCDF3_64BIT_OFFSET", 0),
+                                                             ("NETCDF4", 0),
+                                                             ("NETCDF4", 1)])
+def test_inflow_format(inflow_setup, inflow_format, inflow_complevel):
+    """
+    Test the inflow written in other formats matches the netcdf3 inflow
+    """
+    output_dir, weight_table, runoff_files = inflow_setup
+    inflow_file = os.path.join(output_dir, 'm3_riv_{0}_{1}.nc'.format(inflow_format, inflow_complevel))
+    CreateInflowFileFromECMWFRunoff(inflow_format=inflow_format,
+                                    inflow_complevel=inflow_complevel)\
+        .execute(runoff_files['LowRes'], weight_table, inflow_file, 'ecmwf_tco639', "6hr")
+    single_file = os.path.join(output_dir, 'm3_riv_single.nc')
+    CreateInflowFileFromECMWFRunoff().execute(runoff_files['LowRes'], weight_table,
+                                              single_file, 'ecmwf_tco639', "6hr")
+    assert_array_equal(read_inflow(inflow_file), read_inflow(single_file))
+
+    with Dataset(inflow_file) as inflow_nc:
+        assert inflow_nc.data_model == inflow_format
+        if inflow_format == "NETCDF4":
+            assert inflow_nc.variables['m3_riv'].chunking() == [1, 40]
+            assert inflow_nc.variables['m3_riv'].filters()['zlib'] == bool(inflow_complevel)
+
+
+def test_inflow_format_benchmark(tmpdir):
+    """
+    Test the inflow format benchmark times every format
+    """
+    inflow_tool = CreateInflowFileFromECMWFRunoff()
+    fastest_format, format_seconds = inflow_tool.benchmarkInflowFormats(str(tmpdir), size_time=5,
+                                                                        size_streamID=20, repeats=1)
+    assert sorted(format_seconds) == sorted(inflow_tool.benchmark_formats)
+    assert format_seconds[fastest_format] == min(format_seconds.values())
+    assert not tmpdir.listdir()
+
+
+def test_forecast_metadata_index(tmpdir):
+    """
+    Test the forecast metadata index matches the forecast files
+    """
+    ecmwf_folder = str(tmpdir)
+    ecmwf_forecasts = []
+    for ensemble_number, resolution in ((1, 'LowRes'), (2, 'LowResFull'), (52, 'HighRes')):
+        ecmwf_forecasts.append(os.path.join(ecmwf_folder, '{0}.runoff.nc'.format(ensemble_number)))
+        create_ecmwf_runoff_file(ecmwf_forecasts[-1], resolution)
+
+    # a dry run reads the metadata without writing the index
+    forecast_metadata = build_forecast_metadata_index(ecmwf_folder, ecmwf_forecasts, write_index=False)
+    assert forecast_metadata['52.runoff.nc']['resolution'] == 'HighRes'
+    assert not os.path.exists(get_forecast_metadata_index_file(ecmwf_folder))
+
+    forecast_metadata = build_forecast_metadata_index(ecmwf_folder, ecmwf_forecasts)
+    assert os.path.exists(get_forecast_metadata_index_file(ecmwf_folder))
+    assert load_forecast_metadata_index(ecmwf_folder) == forecast_metadata
+    assert forecast_metadata['1.runoff.nc']['resolution'] == 'LowRes'
+    assert forecast_metadata['2.runoff.nc']['resolution'] == 'LowResFull'
+    assert forecast_metadata['52.runoff.nc']['resolution'] == 'HighRes'
+    assert forecast_metadata['52.runoff.nc']['grid_name'] == 'ecmwf_t1279'
+    assert forecast_metadata['52.runoff.nc']['ensemble_number'] == 52
+    assert forecast_metadata['52.runoff.nc']['time_length'] == len(FORECAST_HOURS['HighRes'])
+
+    # the tool uses the index instead of reading the file
+    inflow_tool = CreateInflowFileFromECMWFRunoff(forecast_metadata=forecast_metadata)
+    assert inflow_tool.getForecastMetadata(ecmwf_forecasts[0]) is forecast_metadata['1.runoff.nc']
+
+    # changed forecasts are read again
+    create_ecmwf_runoff_file(ecmwf_forecasts[0], 'HighRes')
+    forecast_metadata = build_forecast_metadata_index(ecmwf_folder, ecmwf_forecasts)
+    assert forecast_metadata['1.runoff.nc']['resolution'] == 'HighRes'
+    assert load_forecast_metadata_index(ecmwf_folder)['1.runoff.nc']['resolution'] == 'HighRes'
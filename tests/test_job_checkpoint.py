@@ -0,0 +1,95 @@
+import os
+
+from netCDF4 import Dataset
+import numpy as np
+
+from spt_compute.imports.job_checkpoint import JobCheckpoint
+
+JOB_KEY = {'forecast': "52.runoff.nc", 'forecast_date_timestep': "20170708.00"}
+
+
+def write_file(file_path, content):
+    """
+    Writes the content to the file
+    """
+    with open(file_path, "w") as stage_file:
+        stage_file.write(content)
+    return file_path
+
+
+def run_stages(job_directory):
+    """
+    Completes the stages of a job with intermediate files
+    """
+    inflow_file = write_file(os.path.join(job_directory, "m3_riv_bas_1hr_52.nc"), "inflow")
+    qout_file = write_file(os.path.join(job_directory, "Qout_52.nc"), "qout")
+    qout_3hr_file = write_file(os.path.join(job_directory, "Qout_3hr.nc"), "qout 3hr")
+    job_checkpoint = JobCheckpoint(job_directory, JOB_KEY)
+    job_checkpoint.complete('inflow', [inflow_file])
+    job_checkpoint.complete('rapid_1hr', [qout_file])
+    job_checkpoint.complete('rapid_3hr', [qout_3hr_file])
+    # the merge replaces the first file and removes the others
+    write_file(qout_file, "merged qout")
+    os.remove(qout_3hr_file)
+    job_checkpoint.complete('qout_merge', [qout_file], removed_files=[qout_3hr_file])
+    return inflow_file, qout_file
+
+
+def test_checkpoint_resume(tmpdir):
+    """
+    Test the completed stages are valid in the next run of the job
+    """
+    inflow_file = run_stages(str(tmpdir))[0]
+    job_checkpoint = JobCheckpoint(str(tmpdir), JOB_KEY)
+    for stage_name in ('inflow', 'rapid_1hr', 'rapid_3hr', 'qout_merge'):
+        assert job_checkpoint.isComplete(stage_name)
+    assert job_checkpoint.getFiles('inflow') == [inflow_file]
+
+
+def test_checkpoint_changed_file(tmpdir):
+    """
+    Test a changed file invalidates its stage and the stages after it
+    """
+    _, qout_file = run_stages(str(tmpdir))
+    write_file(qout_file, "partial")
+    job_checkpoint = JobCheckpoint(str(tmpdir), JOB_KEY)
+    assert job_checkpoint.isComplete('inflow')
+    assert job_checkpoint.isComplete('rapid_1hr')
+    assert job_checkpoint.isComplete('rapid_3hr')
+    assert not job_checkpoint.isComplete('qout_merge')
+
+    inflow_file = run_stages(str(tmpdir))[0]
+    os.remove(inflow_file)
+    job_checkpoint = JobCheckpoint(str(tmpdir), JOB_KEY)
+    assert not job_checkpoint.stages
+
+
+def test_checkpoint_invalid_netcdf(tmpdir):
+    """
+    Test a Qout file with missing flow invalidates its stage
+    """
+    qout_file = os.path.join(str(tmpdir), "Qout_52.nc")
+    with Dataset(qout_file, "w", format="NETCDF3_CLASSIC") as qout_nc:
+        qout_nc.createDimension('time', 3)
+        qout_nc.createDimension('rivid', 4)
+        qout_nc.createVariable('rivid', 'i4', ('rivid',))[:] = np.arange(4)
+        qout_nc.createVariable('Qout', 'f4', ('time', 'rivid'))[:] = np.ones((3, 4))
+    job_checkpoint = JobCheckpoint(str(tmpdir), JOB_KEY)
+    job_checkpoint.complete('rapid_1hr', [qout_file])
+    assert JobCheckpoint(str(tmpdir), JOB_KEY).isComplete('rapid_1hr')
+
+    # a job that stopped while writing the flow, with the same file size
+    with Dataset(qout_file, "a") as qout_nc:
+        qout_nc.variables['Qout'][2, 1] = np.nan
+    assert not JobCheckpoint(str(tmpdir), JOB_KEY).isComplete('rapid_1hr')
+
+
+def test_checkpoint_other_job(tmpdir):
+    """
+    Test the checkpoint of another job is not used
+    """
+    run_stages(str(tmpdir))
+    job_checkpoint = JobCheckpoint(str(tmpdir), dict(JOB_KEY, forecast_date_timestep="20170708.12"))
+    assert not job_checkpoint.isComplete('inflow')
+    job_checkpoint.remove()
+    assert not os.path.exists(job_checkpoint.checkpoint_file)
@@ -0,0 +1,131 @@
+import os
+import stat
+import subprocess
+
+import pytest
+
+from spt_compute.imports.job_executors import (FUTURES_ENABLED,
+                                               get_condor_job_status,
+                                               get_job_executor,
+                                               LocalCondorExecutor)
+from spt_compute.imports.worker_pool import AffinityWorkerPool
+
+NODE_SCRIPT = """import sys
+with open("Qout_{0}.nc".format(sys.argv[1]), "w") as qout_file:
+    qout_file.write(open("input.txt").read())
+with open("node_log.txt", "w") as log_file:
+    log_file.write("done")
+sys.exit(int(sys.argv[2]))
+"""
+
+CONDOR_COMMAND_SCRIPT = """#!/bin/sh
+echo "$@" >> {0}
+cat {1}
+exit {2}
+"""
+
+
+def square_job(job_args):
+    """
+    Job returning the square of its argument
+    """
+    if job_args < 0:
+        raise ValueError("Job {0} failed".format(job_args))
+    return job_args * job_args
+
+
+def run_executor(job_executor, job_args):
+    """
+    Submits a job for each argument and returns the finished job ids
+    """
+    try:
+        for job_id, job_arg in enumerate(job_args):
+            job_executor.submit(job_id, {'function': square_job,
+                                         'args': job_arg,
+                                         'affinity_key': job_arg % 2,
+                                         'memory_mb': 1})
+        return list(job_executor.asCompleted())
+    finally:
+        job_executor.cancel()
+        job_executor.close()
+
+
+def test_local_executors():
+    """
+    Test the executors on this machine run every job
+    """
+    assert run_executor(get_job_executor("serial"), range(5)) == list(range(5))
+    if FUTURES_ENABLED:
+        assert sorted(run_executor(get_job_executor("futures", processes=2), range(5))) == list(range(5))
+
+    worker_pool = AffinityWorkerPool(processes=2)
+    try:
+        assert sorted(run_executor(get_job_executor("multiprocess", worker_pool), range(5))) == list(range(5))
+        with pytest.raises(Exception):
+            run_executor(get_job_executor("multiprocess", worker_pool), [1, -1, 2])
+        # the pool is usable after a failed job
+        assert run_executor(get_job_executor("multiprocess", worker_pool), [3]) == [0]
+    finally:
+        worker_pool.close()
+
+    with pytest.raises(Exception):
+        get_job_executor("slurm")
+
+
+def test_local_condor_executor(tmpdir):
+    """
+    Test the local scheduler transfers the files of the jobs
+    """
+    input_directory = tmpdir.mkdir("input")
+    input_file = input_directory.join("input.txt")
+    input_file.write("runoff")
+    node_script = input_directory.join("node_script.py")
+    node_script.write(NODE_SCRIPT)
+    output_directory = tmpdir.mkdir("output")
+    log_directory = tmpdir.mkdir("logs")
+    scratch_directory = tmpdir.mkdir("scratch")
+
+    job_executor = LocalCondorExecutor(processes=2, scratch_directory=str(scratch_directory))
+    for job_id, exit_code in enumerate((0, 0, 1)):
+        job_executor.submit(job_id, {'htcondor': {
+            'job_name': "job_{0}".format(job_id),
+            'executable': str(node_script),
+            'arguments': [job_id, exit_code],
+            'transfer_input_files': [str(input_file)],
+            'transfer_output_remaps': {"Qout_{0}.nc".format(job_id):
+                                       str(output_directory.join("Qout_{0}.nc".format(job_id)))},
+            'initialdir': str(log_directory),
+        }})
+    assert sorted(job_executor.asCompleted()) == [0, 1, 2]
+
+    for job_id in range(3):
+        assert output_directory.join("Qout_{0}.nc".format(job_id)).read() == "runoff"
+        assert os.path.exists(str(log_directory.join("job_{0}.out".format(job_id))))
+    # the other new files go to the initial directory and the inputs are not transferred back
+    assert log_directory.join("node_log.txt").read() == "done"
+    assert not log_directory.join("input.txt").check()
+    assert not scratch_directory.listdir()
+
+
+def test_condor_job_status(tmpdir, monkeypatch):
+    """
+    Test the status of all of the jobs is queried with one call of each command
+    """
+    command_log = tmpdir.join("commands.txt")
+    for condor_command, condor_output, exit_code in (("condor_q", "11 2\n", 0),
+                                                     ("condor_history", "12 4\n13 5\n", 0)):
+        tmpdir.join("{0}.txt".format(condor_command)).write(condor_output)
+        command_script = tmpdir.join(condor_command)
+        command_script.write(CONDOR_COMMAND_SCRIPT.format(command_log,
+                                                          tmpdir.join("{0}.txt".format(condor_command)),
+                                                          exit_code))
+        command_script.chmod(stat.S_IRWXU)
+    monkeypatch.setenv("PATH", "{0}{1}{2}".format(tmpdir, os.pathsep, os.environ.get("PATH", "")))
+
+    assert get_condor_job_status([11, 12, 13]) == {11: 2, 12: 4, 13: 5}
+    assert command_log.read().splitlines() == ["11 12 13 -af ClusterId JobStatus",
+                                               "12 13 -af ClusterId JobStatus -match 2"]
+
+    tmpdir.join("condor_q").write(CONDOR_COMMAND_SCRIPT.format(command_log, tmpdir.join("condor_q.txt"), 1))
+    with pytest.raises(subprocess.CalledProcessError):
+        get_condor_job_status([11])
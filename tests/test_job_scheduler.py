@@ -0,0 +1,139 @@
+import os
+
+import pytest
+
+from spt_compute.imports.job_scheduler import (DEFAULT_SECONDS_PER_COST,
+                                               estimate_job_cost,
+                                               estimate_job_memory_mb,
+                                               estimate_regional_inflow_memory_mb,
+                                               JOB_BASE_MEMORY_MB,
+                                               format_cycle_eta,
+                                               JobCostModel,
+                                               order_longest_job_first,
+                                               predict_cycle_eta)
+
+
+def test_estimate_job_cost():
+    """
+    Test the cost increases with the rivers and the resolution
+    """
+    assert estimate_job_cost(100, 'HighRes') > estimate_job_cost(100, 'LowResFull')
+    assert estimate_job_cost(100, 'LowResFull') > estimate_job_cost(100, 'LowRes')
+    assert estimate_job_cost(200, 'LowRes') > estimate_job_cost(100, 'LowRes')
+    assert estimate_job_cost(100, None) == estimate_job_cost(100, 'HighRes')
+
+
+def test_order_longest_job_first():
+    """
+    Test the jobs of all of the watersheds are ordered by cost
+    """
+    jobs = [{'watershed': 'haina', 'ensemble_number': 1, 'cost': estimate_job_cost(100, 'LowRes')},
+            {'watershed': 'haina', 'ensemble_number': 52, 'cost': estimate_job_cost(100, 'HighRes')},
+            {'watershed': 'magdalena', 'ensemble_number': 1, 'cost': estimate_job_cost(5000, 'LowRes')},
+            {'watershed': 'magdalena', 'ensemble_number': 2, 'cost': estimate_job_cost(5000, 'LowRes')},
+            {'watershed': 'magdalena', 'ensemble_number': 52, 'cost': estimate_job_cost(5000, 'HighRes')}]
+    ordered_jobs = order_longest_job_first(jobs, lambda job: job['cost'])
+    assert [(job['watershed'], job['ensemble_number']) for job in ordered_jobs] == \
+        [('magdalena', 52), ('magdalena', 1), ('magdalena', 2), ('haina', 52), ('haina', 1)]
+
+
+def test_estimate_job_memory_mb():
+    """
+    Test the memory increases with the reaches, runoff bounding box and resolution
+    """
+    assert estimate_job_memory_mb(0, 'HighRes') == JOB_BASE_MEMORY_MB
+    assert estimate_job_memory_mb(100000, 'HighRes', (10000, 1000)) > \
+        estimate_job_memory_mb(1000, 'HighRes', (10000, 1000))
+    assert estimate_job_memory_mb(1000, 'HighRes', (1000000, 1000)) > \
+        estimate_job_memory_mb(1000, 'HighRes', (10000, 1000))
+    assert estimate_job_memory_mb(1000, 'HighRes', (1000000, 1000)) > \
+        estimate_job_memory_mb(1000, 'LowRes', (1000000, 1000))
+    assert estimate_job_memory_mb(1000, 'HighRes', (1000000, 1000), inflow_memory_limit_mb=1) < \
+        estimate_job_memory_mb(1000, 'HighRes', (1000000, 1000))
+
+
+
+def test_estimate_regional_inflow_memory_mb():
+    """
+    Test the memory of an inflow batch increases with the members, cells and precision
+    """
+    assert estimate_regional_inflow_memory_mb(4, 'HighRes', []) == JOB_BASE_MEMORY_MB
+    assert estimate_regional_inflow_memory_mb(4, 'HighRes', [(10000, 1000), (10000, 1000)]) > \
+        estimate_regional_inflow_memory_mb(4, 'HighRes', [(10000, 1000)])
+    assert estimate_regional_inflow_memory_mb(8, 'HighRes', [(10000, 1000)]) > \
+        estimate_regional_inflow_memory_mb(4, 'HighRes', [(10000, 1000)])
+    assert estimate_regional_inflow_memory_mb(4, 'HighRes', [(10000, 1000)]) > \
+        estimate_regional_inflow_memory_mb(4, 'HighRes', [(10000, 1000)], inflow_precision="float32")
+    assert estimate_regional_inflow_memory_mb(4, 'HighRes', [(10000, 100000)],
+                                              inflow_memory_limit_mb=1) == JOB_BASE_MEMORY_MB + 1
+
+
+def get_job_record(job_name, stage, wall_seconds, success=True, peak_memory_mb=None,
+                   peak_child_memory_mb=None, state_cache_mb=0):
+    """
+    Job stats record of a stage
+    """
+    return {'job_name': job_name, 'stage': stage, 'success': success, 'wall_seconds': wall_seconds,
+            'peak_memory_mb': peak_memory_mb, 'peak_child_memory_mb': peak_child_memory_mb,
+            'state_cache_mb': state_cache_mb}
+
+
+def test_job_cost_model(tmpdir):
+    """
+    Test the runtime is learned from the job stats of a forecast cycle
+    """
+    history_file = os.path.join(str(tmpdir), "job_cost_history.json")
+    job_cost_model = JobCostModel(history_file)
+    high_res_cost = estimate_job_cost(100, 'HighRes')
+    low_res_cost = estimate_job_cost(100, 'LowRes')
+    assert job_cost_model.predictSeconds("dr-haina", 100, 'HighRes') == \
+        pytest.approx(DEFAULT_SECONDS_PER_COST * high_res_cost)
+
+    # the watershed state kept by the worker is not part of the job memory
+    records = [get_job_record("job_20170708.00_DR_haina_52", "inflow", 10.0, peak_memory_mb=300.0,
+                              state_cache_mb=50.0),
+               get_job_record("job_20170708.00_DR_haina_52", "rapid_1hr", 90.0, peak_memory_mb=320.0,
+                              peak_child_memory_mb=100.0, state_cache_mb=50.0),
+               get_job_record("job_20170708.00_DR_haina_1", "inflow", 10.0, success=False),
+               get_job_record("job_20170708.00_other_job_1", "inflow", 10.0)]
+    cycle_job_costs = {"job_20170708.00_DR_haina_52": ("dr-haina", 'HighRes', high_res_cost),
+                       "job_20170708.00_DR_haina_1": ("dr-haina", 'LowRes', low_res_cost)}
+    job_cost_model.learnForecastCycle("20170708.00", records, cycle_job_costs)
+    job_cost_model.write()
+
+    job_cost_model = JobCostModel(history_file)
+    assert job_cost_model.predictSeconds("dr-haina", 100, 'HighRes') == pytest.approx(100.0)
+    assert job_cost_model.predictMemoryMB("dr-haina", 'HighRes', 1000.0) == pytest.approx(370.0)
+    assert job_cost_model.predictMemoryMB("dr-haina", 'LowRes', 1000.0) == 1000.0
+    # the failed job is not learned, the rate of the watershed is used
+    assert job_cost_model.predictSeconds("dr-haina", 100, 'LowRes') == \
+        pytest.approx(100.0 * low_res_cost / high_res_cost)
+    # other watersheds use the rate of all of the watersheds
+    assert job_cost_model.predictSeconds("dr-other", 200, 'HighRes') == pytest.approx(200.0)
+
+    # a cycle is learned once
+    job_cost_model.learnForecastCycle("20170708.00", records, cycle_job_costs)
+    assert job_cost_model.history["dr-haina"]['HighRes']['jobs'] == 1
+    job_cost_model.learnForecastCycle("20170708.12",
+                                      [get_job_record("job_20170708.12_DR_haina_52", "inflow", 200.0)],
+                                      {"job_20170708.12_DR_haina_52": ("dr-haina", 'HighRes', high_res_cost)})
+    assert job_cost_model.predictSeconds("dr-haina", 100, 'HighRes') == pytest.approx(130.0)
+
+    # without the peak of RAPID, the estimate is the lower bound of the memory
+    job_cost_model.learnForecastCycle("20170709.00",
+                                      [get_job_record("job_20170709.00_DR_haina_1", "inflow", 10.0,
+                                                      peak_memory_mb=200.0)],
+                                      {"job_20170709.00_DR_haina_1": ("dr-haina", 'LowRes', low_res_cost)})
+    assert job_cost_model.predictMemoryMB("dr-haina", 'LowRes', 100.0) == pytest.approx(200.0)
+    assert job_cost_model.predictMemoryMB("dr-haina", 'LowRes', 300.0) == pytest.approx(300.0)
+
+
+def test_predict_cycle_eta():
+    """
+    Test the jobs are predicted to start on the first process to be free
+    """
+    cycle_eta = predict_cycle_eta([("magdalena", 10.0), ("haina", 6.0), ("haina", 5.0), ("haina", 4.0)], 2)
+    assert cycle_eta['makespan_seconds'] == 14.0
+    assert cycle_eta['job_seconds'] == 25.0
+    assert cycle_eta['watershed_finish_seconds'] == {"magdalena": 10.0, "haina": 14.0}
+    assert "predicted to finish in 14.0 seconds" in format_cycle_eta(cycle_eta)
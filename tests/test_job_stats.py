@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from spt_compute.imports.job_stats import (get_job_stats_file,
+                                           JobStats,
+                                           read_job_stats,
+                                           summarize_job_stats,
+                                           write_job_stats_summary)
+
+
+def test_job_stats_records(tmpdir):
+    """
+    Test the stages of a job are written as JSON lines
+    """
+    stats_file = get_job_stats_file(str(tmpdir), "job_20170708.00_haina_haina_52")
+    output_file = os.path.join(str(tmpdir), "Qout.nc")
+    job_stats = JobStats(stats_file, watershed="haina", subbasin="haina", ensemble_number=52)
+    with job_stats.stage("inflow", output_files=[output_file]):
+        with open(output_file, "w") as output:
+            output.write("0" * 1000)
+    with pytest.raises(ValueError):
+        with job_stats.stage("rapid_1hr"):
+            raise ValueError("RAPID failed")
+
+    records = read_job_stats(str(tmpdir))
+    assert [record['stage'] for record in records] == ["inflow", "rapid_1hr"]
+    assert [record['success'] for record in records] == [True, False]
+    assert records[0]['file_sizes'] == {"Qout.nc": 1000}
+    assert records[0]['ensemble_number'] == 52
+    for record in records:
+        assert record['wall_seconds'] >= 0
+        assert record['cpu_seconds'] >= 0
+        assert record['peak_memory_mb'] is None or record['peak_memory_mb'] > 0
+        assert 'process_peak_memory_mb' in record
+
+    # a new run of the job replaces the records
+    job_stats = JobStats(stats_file, watershed="haina", subbasin="haina", ensemble_number=52)
+    with job_stats.stage("inflow"):
+        pass
+    assert [record['stage'] for record in read_job_stats(str(tmpdir))] == ["inflow"]
+
+
+def test_job_stats_summary(tmpdir):
+    """
+    Test the summary is sorted by the slowest watershed and stage
+    """
+    records = []
+    for watershed, stage, wall_seconds in (("haina", "inflow", 1.0),
+                                           ("haina", "rapid_1hr", 2.0),
+                                           ("magdalena", "inflow", 5.0),
+                                           ("magdalena", "rapid_1hr", 3.0),
+                                           ("magdalena", "rapid_1hr", 4.0)):
+        records.append({'watershed': watershed, 'subbasin': "river", 'stage': stage,
+                        'success': True, 'wall_seconds': wall_seconds, 'cpu_seconds': 1.0,
+                        'peak_memory_mb': 10.0, 'peak_child_memory_mb': None,
+                        'bytes_read': 10, 'bytes_written': 20, 'file_sizes': {}})
+    summary_rows = summarize_job_stats(records)
+    assert [(summary['watershed'], summary['stage']) for summary in summary_rows] == \
+        [("magdalena", "rapid_1hr"), ("magdalena", "inflow"),
+         ("haina", "rapid_1hr"), ("haina", "inflow")]
+    assert summary_rows[0]['jobs'] == 2
+    assert summary_rows[0]['wall_seconds'] == 7.0
+    assert summary_rows[0]['max_wall_seconds'] == 4.0
+
+    job_stats = JobStats(get_job_stats_file(str(tmpdir), "job_1"), watershed="haina", subbasin="river")
+    with job_stats.stage("inflow"):
+        pass
+    summary_table = write_job_stats_summary(str(tmpdir))
+    assert "haina-river" in summary_table
+    assert os.path.exists(os.path.join(str(tmpdir), "job_stats_summary.txt"))
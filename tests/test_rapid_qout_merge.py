@@ -0,0 +1,125 @@
+import datetime
+import os
+from shutil import copy
+
+from netCDF4 import Dataset
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+from spt_compute.imports.rapid_qout_merge import is_valid_qout_file, merge_rapid_qout_to_cf
+
+from .conftest import SCRIPT_DIR
+
+RAPID_INPUT_DIR = os.path.join(SCRIPT_DIR, "input", "rapid_input", "dominican_republic-haina")
+COMPARE_QOUT_FILE = os.path.join(SCRIPT_DIR, "compare", "rapid_output", "dominican_republic-haina",
+                                 "20170708.00", "Qout_dominican_republic_haina_52_init.nc")
+
+
+def write_rapid_qout_segments(compare_qout_file, output_directory):
+    """
+    Writes the 1hr, 3hr and 6hr RAPID Qout files of the merged Qout file
+    and the Qinit file with the initial flow
+    """
+    with Dataset(compare_qout_file) as compare_nc:
+        qout = compare_nc.variables['Qout'][:]
+        rivid = compare_nc.variables['rivid'][:]
+        time = compare_nc.variables['time'][:]
+
+    init_flow = dict(zip(rivid, qout[:, 0]))
+    qinit_file = os.path.join(output_directory, "Qinit.csv")
+    with open(os.path.join(RAPID_INPUT_DIR, "rapid_connect.csv")) as rapid_connect, \
+            open(qinit_file, "w") as qinit:
+        for row in rapid_connect:
+            qinit.write("{0!r}\n".format(float(init_flow[int(row.split(",")[0])])))
+
+    rapid_output_file_list = []
+    for segment_index, (time_index_start, time_index_end) in enumerate(((1, 91), (91, 109), (109, 125))):
+        rapid_output_file = os.path.join(output_directory, "Qout_{0}.nc".format(segment_index))
+        with Dataset(rapid_output_file, "w", format="NETCDF3_CLASSIC") as qout_nc:
+            qout_nc.createDimension('time', None)
+            qout_nc.createDimension('rivid', len(rivid))
+            qout_nc.createVariable('rivid', 'i4', ('rivid',))[:] = rivid
+            # the 3hr file has the time variable, the others have legacy time
+            if segment_index == 1:
+                qout_nc.createVariable('time', 'i4', ('time',))[:] = time[time_index_start:time_index_end]
+            qout_nc.createVariable('Qout', 'f4', ('time', 'rivid'))[:] = \
+                qout[:, time_index_start:time_index_end].T
+        rapid_output_file_list.append(rapid_output_file)
+    return rapid_output_file_list, qinit_file
+
+
+@pytest.mark.parametrize("reuse_static_metadata", [False, True])
+def test_merge_rapid_qout_to_cf(tmpdir, reuse_static_metadata):
+    """
+    Test merging the RAPID Qout files matches the CF Qout file of RAPIDpy
+    """
+    static_metadata = None
+    for _ in range(2 if reuse_static_metadata else 1):
+        rapid_output_file_list, qinit_file = write_rapid_qout_segments(COMPARE_QOUT_FILE, str(tmpdir))
+        static_metadata = \
+            merge_rapid_qout_to_cf(rapid_output_file_list,
+                                   start_datetime=datetime.datetime(2017, 7, 8),
+                                   time_step_list=[3600, 10800, 21600],
+                                   qinit_file=qinit_file,
+                                   comid_lat_lon_z_file=os.path.join(RAPID_INPUT_DIR, "comid_lat_lon_z.csv"),
+                                   rapid_connect_file=os.path.join(RAPID_INPUT_DIR, "rapid_connect.csv"),
+                                   project_name="ECMWF-RAPID Predicted flows by US Army ERDC",
+                                   static_metadata=static_metadata)
+
+    assert sorted(os.listdir(str(tmpdir))) == ["Qinit.csv", "Qout_0.nc"]
+    with Dataset(rapid_output_file_list[0]) as merged_nc, \
+            Dataset(COMPARE_QOUT_FILE) as compare_nc:
+        assert merged_nc.data_model == compare_nc.data_model
+        assert list(merged_nc.dimensions) == list(compare_nc.dimensions)
+        assert merged_nc.ncattrs() == compare_nc.ncattrs()
+        for attribute in compare_nc.ncattrs():
+            if attribute not in ("date_created", "history"):
+                assert merged_nc.getncattr(attribute) == compare_nc.getncattr(attribute)
+        assert list(merged_nc.variables) == list(compare_nc.variables)
+        for variable_name, compare_variable in compare_nc.variables.items():
+            merged_variable = merged_nc.variables[variable_name]
+            assert merged_variable.dtype == compare_variable.dtype
+            assert merged_variable.dimensions == compare_variable.dimensions
+            assert merged_variable.ncattrs() == compare_variable.ncattrs()
+            assert_array_equal(merged_variable[:], compare_variable[:])
+
+
+def test_merge_rapid_qout_to_output_file(tmpdir):
+    """
+    Test the merged Qout file is written to the output file in another directory
+    """
+    job_directory = tmpdir.mkdir("job")
+    output_directory = tmpdir.mkdir("output")
+    output_file = str(output_directory.join("Qout_haina_52.nc"))
+    rapid_output_file_list, qinit_file = write_rapid_qout_segments(COMPARE_QOUT_FILE, str(job_directory))
+    merge_rapid_qout_to_cf(rapid_output_file_list,
+                           start_datetime=datetime.datetime(2017, 7, 8),
+                           time_step_list=[3600, 10800, 21600],
+                           qinit_file=qinit_file,
+                           rapid_connect_file=os.path.join(RAPID_INPUT_DIR, "rapid_connect.csv"),
+                           output_file=output_file)
+
+    assert job_directory.listdir() == [job_directory.join("Qinit.csv")]
+    assert output_directory.listdir() == [output_directory.join("Qout_haina_52.nc")]
+    with Dataset(output_file) as merged_nc, \
+            Dataset(COMPARE_QOUT_FILE) as compare_nc:
+        assert_array_equal(merged_nc.variables['Qout'][:], compare_nc.variables['Qout'][:])
+
+def test_is_valid_qout_file(tmpdir):
+    """
+    Test the Qout file of a completed job is valid
+    """
+    with Dataset(COMPARE_QOUT_FILE) as compare_nc:
+        num_rivers = len(compare_nc.dimensions['rivid'])
+    assert is_valid_qout_file(COMPARE_QOUT_FILE, 125, num_rivers)
+    assert not is_valid_qout_file(COMPARE_QOUT_FILE, 85, num_rivers)
+    assert not is_valid_qout_file(COMPARE_QOUT_FILE, 125, num_rivers + 1)
+    assert not is_valid_qout_file(os.path.join(str(tmpdir), "Qout_missing.nc"), 125, num_rivers)
+
+    # a job that failed while writing the flow
+    partial_qout_file = os.path.join(str(tmpdir), "Qout_partial.nc")
+    copy(COMPARE_QOUT_FILE, partial_qout_file)
+    with Dataset(partial_qout_file, "a") as partial_nc:
+        partial_nc.variables['Qout'][0, 10] = np.nan
+    assert not is_valid_qout_file(partial_qout_file, 125, num_rivers)
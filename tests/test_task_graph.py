@@ -0,0 +1,185 @@
+import time
+
+import pytest
+
+from spt_compute.imports.job_executors import get_job_executor
+from spt_compute.imports.task_graph import TaskGraph
+from spt_compute.imports.worker_pool import AffinityWorkerPool
+
+
+def square_job(job_args):
+    """
+    Job returning the square of its argument
+    """
+    return job_args * job_args
+
+
+def record_job(job_args):
+    """
+    Job writing the time it ran to its file
+    """
+    job_file, seconds = job_args
+    time_start = time.time()
+    time.sleep(seconds)
+    with open(job_file, "w") as job_log:
+        job_log.write("{0} {1}".format(time_start, time.time()))
+
+
+def record_task(task_log, name, seconds=0):
+    """
+    Task recording the time it ran
+    """
+    time_start = time.time()
+    time.sleep(seconds)
+    task_log[name] = (time_start, time.time())
+    return name
+
+
+def fail_task():
+    """
+    Task that fails
+    """
+    raise ValueError("Task failed")
+
+
+def test_task_graph_order():
+    """
+    Test the tasks run after the tasks they depend on and
+    the independent branches run at the same time
+    """
+    task_log = {}
+    task_graph = TaskGraph()
+    task_graph.addTask("prepare", record_task, (task_log, "prepare"))
+    for watershed in ("haina", "magdalena"):
+        job_names = [task_graph.addTask("rapid/{0}_{1}".format(watershed, ensemble),
+                                        job={'function': square_job, 'args': ensemble},
+                                        depends=["prepare"], priority=ensemble)
+                     for ensemble in range(3)]
+        task_graph.addTask("finish/{0}".format(watershed), record_task,
+                           (task_log, watershed, 0.2), depends=job_names)
+    task_graph.addTask("report", record_task, (task_log, "report"),
+                       depends=["finish/haina", "finish/magdalena"])
+
+    assert [planned_task['level'] for planned_task in task_graph.getPlan()] == [1] + [2] * 6 + [3, 3, 4]
+    assert "rapid/haina_2" in task_graph.formatPlan()
+
+    job_executor = get_job_executor("serial")
+    results = task_graph.run(job_executor, num_threads=2)
+    assert results["report"] == "report"
+    assert task_log["prepare"][1] <= min(task_log["haina"][0], task_log["magdalena"][0])
+    assert max(task_log["haina"][1], task_log["magdalena"][1]) <= task_log["report"][0]
+    # the watersheds are finished at the same time
+    assert task_log["haina"][0] < task_log["magdalena"][1]
+    assert task_log["magdalena"][0] < task_log["haina"][1]
+
+
+def test_task_graph_submit_while_running(tmpdir):
+    """
+    Test a job that is ready starts while another job is running
+    """
+    slow_file = str(tmpdir.join("slow.txt"))
+    fast_file = str(tmpdir.join("fast.txt"))
+    task_graph = TaskGraph()
+    task_graph.addTask("rapid/slow", job={'function': record_job, 'args': (slow_file, 2)})
+    task_graph.addTask("prepare", record_task, ({}, "prepare", 0.2))
+    task_graph.addTask("rapid/fast", job={'function': record_job, 'args': (fast_file, 0)},
+                       depends=["prepare"])
+
+    worker_pool = AffinityWorkerPool(processes=2)
+    try:
+        task_graph.run(get_job_executor("multiprocess", worker_pool))
+    finally:
+        worker_pool.close()
+    slow_start, slow_end = [float(time_value) for time_value in open(slow_file).read().split()]
+    fast_start, fast_end = [float(time_value) for time_value in open(fast_file).read().split()]
+    assert slow_start < fast_start and fast_end < slow_end
+
+
+def test_task_graph_memoize(tmpdir):
+    """
+    Test a memoized task is skipped if its inputs and outputs did not change
+    """
+    input_file = tmpdir.join("Qout.nc")
+    input_file.write("flows")
+    output_file = tmpdir.join("warning_points.geojson")
+    memo_file = str(tmpdir.join("task_memo.json"))
+
+    def run_graph():
+        task_log = []
+
+        def warning_task():
+            task_log.append("warning")
+            output_file.write("warnings from {0}".format(input_file.read()))
+
+        task_graph = TaskGraph(memo_file)
+        task_graph.addTask("warning", warning_task, input_files=[str(input_file)],
+                           output_files=[str(output_file)], memoize=True)
+        memoized = task_graph.getPlan()[0]['memoized']
+        task_graph.run()
+        return memoized, task_log
+
+    assert run_graph() == (False, ["warning"])
+    assert run_graph() == (True, [])
+    input_file.write("new flows")
+    assert run_graph() == (False, ["warning"])
+    # an input file of the same size written later
+    input_file.write("old flows")
+    input_file.setmtime(input_file.mtime() + 10)
+    assert run_graph() == (False, ["warning"])
+    output_file.write("partial")
+    assert run_graph() == (False, ["warning"])
+
+
+def test_task_graph_failure():
+    """
+    Test the tasks after a failed task do not run and the other tasks continue
+    """
+    task_log = {}
+    task_graph = TaskGraph()
+    task_graph.addTask("fail", fail_task)
+    task_graph.addTask("after", record_task, (task_log, "after"), depends=["fail"])
+    task_graph.addTask("rapid/fail", job={'function': square_job, 'args': None})
+    task_graph.addTask("upload", record_task, (task_log, "upload"), depends=["rapid/fail"])
+    task_graph.addTask("rapid/other", job={'function': square_job, 'args': 2})
+    task_graph.addTask("other", record_task, (task_log, "other"), depends=["rapid/other"])
+    with pytest.raises(Exception) as error:
+        task_graph.run(get_job_executor("serial"))
+    assert "2 tasks failed and 2 tasks after them did not run" in str(error.value)
+    assert "Task fail failed" in str(error.value)
+    assert "Task rapid/fail failed" in str(error.value)
+    assert list(task_log) == ["other"]
+
+    with pytest.raises(ValueError):
+        task_graph.addTask("fail", fail_task)
+    with pytest.raises(ValueError):
+        task_graph.addTask("unknown", fail_task, depends=["missing"])
+
+
+class FailingSubmitExecutor(object):
+    """
+    Executor that cannot submit the jobs
+    """
+    def submit(self, job_id, job, priority=0):
+        raise OSError("Unable to submit {0}".format(job_id))
+
+    def numPending(self):
+        return 0
+
+    def cancel(self):
+        pass
+
+
+def test_task_graph_submit_failure():
+    """
+    Test the graph stops with an error if a job cannot be submitted
+    """
+    task_log = {}
+    task_graph = TaskGraph()
+    task_graph.addTask("rapid/first", job={'function': square_job, 'args': 1})
+    task_graph.addTask("after", record_task, (task_log, "after"), depends=["rapid/first"])
+    task_graph.addTask("other", record_task, (task_log, "other"))
+    with pytest.raises(Exception) as error:
+        task_graph.run(FailingSubmitExecutor())
+    assert "Task rapid/first failed" in str(error.value)
+    assert "Unable to submit rapid/first" in str(error.value)
+    assert list(task_log) == ["other"]
@@ -0,0 +1,118 @@
+import json
+import os
+import tarfile
+
+from spt_compute.imports.upload_queue import (LocalDatasetManager,
+                                              upload_single_forecast,
+                                              UploadQueue)
+
+
+def write_job_output(output_directory, ensemble_number):
+    """
+    Writes the Qout file of a job and returns the job info
+    """
+    outflow_file_name = os.path.join(output_directory, "Qout_haina_haina_{0}.nc".format(ensemble_number))
+    with open(outflow_file_name, "w") as outflow_file:
+        outflow_file.write("qout")
+    return {'watershed': "haina",
+            'subbasin': "haina",
+            'outflow_file_name': outflow_file_name,
+            'forecast_date_timestep': "20170708.00",
+            'ensemble_number': ensemble_number,
+            'master_watershed_outflow_directory': output_directory}
+
+
+def test_upload_single_forecast(tmpdir):
+    """
+    Test the forecast is uploaded as a tar.gz file to the data store
+    """
+    output_directory = str(tmpdir.mkdir("output"))
+    data_store_directory = str(tmpdir.join("data_store"))
+    job_info = write_job_output(output_directory, 52)
+    assert upload_single_forecast(job_info, LocalDatasetManager(data_store_directory))
+    resource_file = os.path.join(data_store_directory, "haina-haina", "20170708.00",
+                                 "haina-haina-20170708.00-52.tar.gz")
+    with tarfile.open(resource_file) as resource_tar:
+        assert resource_tar.getnames() == ["Qout_haina_haina_52.nc"]
+    # the tar.gz file is removed after the upload
+    assert os.listdir(output_directory) == ["Qout_haina_haina_52.nc"]
+
+
+def test_upload_queue_retry(tmpdir):
+    """
+    Test failed uploads are tried again and the queue file is emptied
+    """
+    output_directory = str(tmpdir.mkdir("output"))
+    data_store_directory = str(tmpdir.join("data_store"))
+    queue_file = str(tmpdir.join("upload_queue.json"))
+    attempts = []
+
+    def flaky_upload(job_info, data_manager):
+        attempts.append(job_info['ensemble_number'])
+        if attempts.count(job_info['ensemble_number']) < 3:
+            return False
+        return upload_single_forecast(job_info, data_manager)
+
+    upload_queue = UploadQueue(queue_file, flaky_upload,
+                               lambda: LocalDatasetManager(data_store_directory),
+                               num_uploaders=2, backoff_seconds=0.01)
+    for ensemble_number in range(1, 5):
+        upload_queue.put(write_job_output(output_directory, ensemble_number))
+    upload_queue.close()
+
+    assert sorted(attempts) == sorted(list(range(1, 5)) * 3)
+    assert len(os.listdir(os.path.join(data_store_directory, "haina-haina", "20170708.00"))) == 4
+    with open(queue_file) as queue_json:
+        assert json.load(queue_json)['uploads'] == []
+
+
+def test_upload_queue_resume(tmpdir):
+    """
+    Test the uploads pending after a crash are uploaded in the next run
+    with their attempts, and the uploads failing every attempt or without
+    an outflow file are dropped
+    """
+    output_directory = str(tmpdir.mkdir("output"))
+    data_store_directory = str(tmpdir.join("data_store"))
+    queue_file = str(tmpdir.join("upload_queue.json"))
+    with open(queue_file, "w") as queue_json:
+        json.dump({'version': 1,
+                   'uploads': [{'job_info': write_job_output(output_directory, ensemble_number),
+                                'attempts': 1, 'next_attempt_time': 0}
+                               for ensemble_number in (52, 2)]},
+                  queue_json)
+    attempts = []
+
+    def failing_upload(job_info, data_manager):
+        attempts.append(job_info['ensemble_number'])
+        if job_info['ensemble_number'] == 2:
+            return False
+        return upload_single_forecast(job_info, data_manager)
+
+    upload_queue = UploadQueue(queue_file, failing_upload,
+                               lambda: LocalDatasetManager(data_store_directory),
+                               max_attempts=2, backoff_seconds=0.01)
+    upload_queue.put(dict(write_job_output(output_directory, 1),
+                          outflow_file_name=os.path.join(output_directory, "missing.nc")))
+    upload_queue.close()
+
+    # the upload failing a second time in all of the runs is dropped
+    # and the upload without its outflow file is not tried
+    assert sorted(attempts) == [2, 52]
+    assert os.listdir(os.path.join(data_store_directory, "haina-haina", "20170708.00")) == \
+        ["haina-haina-20170708.00-52.tar.gz"]
+    assert upload_queue.getUploadsNotDone() == []
+    with open(queue_file) as queue_json:
+        assert json.load(queue_json)['uploads'] == []
+
+    # the attempts of an upload not done are kept for the next run
+    upload_queue = UploadQueue(queue_file, lambda job_info, data_manager: attempts.append(3),
+                               lambda: LocalDatasetManager(data_store_directory),
+                               max_attempts=3, backoff_seconds=60)
+    upload_queue.put(write_job_output(output_directory, 3))
+    assert not upload_queue.join(timeout=1)
+    assert [job_info['ensemble_number'] for job_info in upload_queue.getUploadsNotDone()] == [3]
+    upload_queue.close(wait=False)
+    assert attempts.count(3) == 1
+    with open(queue_file) as queue_json:
+        assert [upload['attempts'] for upload in json.load(queue_json)['uploads']] == [1]
@@ -0,0 +1,59 @@
+import os
+from shutil import copytree
+
+import pytest
+
+from spt_compute.imports.helper_functions import case_insensitive_file_search
+from spt_compute.imports.watershed_input_manifest import (build_watershed_input_manifest,
+                                                          get_watershed_input_file,
+                                                          get_watershed_input_manifest,
+                                                          read_watershed_input_manifest,
+                                                          write_watershed_input_manifest,
+                                                          WATERSHED_INPUT_FILE_PATTERNS)
+
+from .conftest import SCRIPT_DIR
+
+RAPID_INPUT_DIR = os.path.join(SCRIPT_DIR, "input", "rapid_input")
+
+
+@pytest.mark.parametrize("watershed_folder", ["dominican_republic-haina",
+                                              "dominican_republic-haina_forcing"])
+def test_input_manifest_matches_search(watershed_folder):
+    """
+    Test the manifest finds the same files as searching the input directory
+    """
+    watershed_input_directory = os.path.join(RAPID_INPUT_DIR, watershed_folder)
+    input_manifest = build_watershed_input_manifest(watershed_input_directory)
+    for file_role, pattern in WATERSHED_INPUT_FILE_PATTERNS.items():
+        try:
+            input_file = case_insensitive_file_search(watershed_input_directory, pattern)
+        except IndexError:
+            with pytest.raises(IndexError):
+                get_watershed_input_file(watershed_input_directory, input_manifest, file_role)
+        else:
+            assert get_watershed_input_file(watershed_input_directory,
+                                            input_manifest, file_role) == input_file
+
+
+def test_input_manifest_validation(tmpdir):
+    """
+    Test the manifest is rebuilt when the input directory changes
+    """
+    watershed_input_directory = str(tmpdir.join("dominican_republic-haina"))
+    copytree(os.path.join(RAPID_INPUT_DIR, "dominican_republic-haina"),
+             watershed_input_directory)
+    os.utime(watershed_input_directory, (1e9, 1e9))
+    input_manifest = build_watershed_input_manifest(watershed_input_directory)
+    assert input_manifest['files']['qfor'] is None
+
+    manifest_file = str(tmpdir.join("input_manifest.json"))
+    write_watershed_input_manifest(input_manifest, manifest_file)
+    assert read_watershed_input_manifest(manifest_file) == input_manifest
+    assert get_watershed_input_manifest(watershed_input_directory, input_manifest) is input_manifest
+
+    with open(os.path.join(watershed_input_directory, "Qfor.csv"), 'w') as qfor_file:
+        qfor_file.write("0\n")
+    assert get_watershed_input_manifest(watershed_input_directory, input_manifest,
+                                        validate=False) is input_manifest
+    input_manifest = get_watershed_input_manifest(watershed_input_directory, input_manifest)
+    assert input_manifest['files']['qfor'] == "Qfor.csv"
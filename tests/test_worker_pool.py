@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+
+import pytest
+
+from spt_compute.imports.worker_pool import AffinityWorkerPool
+
+
+def get_worker_pid(task):
+    """
+    Task returning the worker process id
+    """
+    return task, os.getpid()
+
+
+def fail_task(task):
+    """
+    Task failing for the odd numbers
+    """
+    if task % 2:
+        raise ValueError("Task {0} failed".format(task))
+    return task
+
+
+def exit_task(task):
+    """
+    Task stopping the worker for the odd numbers like the out of memory killer
+    """
+    if task % 2:
+        os._exit(1)
+    return task
+
+
+def exit_after_task(task):
+    """
+    Task stopping the worker after its result is put in the result queue
+    """
+    threading.Timer(0.2, os._exit, (1,)).start()
+    return task
+
+
+def sleep_task(task):
+    """
+    Task returning the time it ran
+    """
+    time_start = time.time()
+    time.sleep(0.2)
+    return task, time_start, time.time()
+
+
+def test_worker_pool_results():
+    """
+    Test the pool returns the result of every task
+    """
+    worker_pool = AffinityWorkerPool(processes=2)
+    try:
+        results = list(worker_pool.imap_unordered(get_worker_pid, range(10)))
+    finally:
+        worker_pool.close()
+    assert sorted(task for task, _ in results) == list(range(10))
+
+
+def test_worker_pool_affinity():
+    """
+    Test the tasks of a key go back to the workers that ran the key
+    """
+    worker_pool = AffinityWorkerPool(processes=4)
+    try:
+        pids = {}
+        for affinity_key in ("haina", "magdalena", "haina", "magdalena"):
+            key_pids = set(pid for _, pid in
+                           worker_pool.imap_unordered(get_worker_pid, range(2),
+                                                      affinity_key=affinity_key))
+            pids.setdefault(affinity_key, set()).update(key_pids)
+    finally:
+        worker_pool.close()
+    assert len(pids["haina"]) == 2
+    assert len(pids["magdalena"]) == 2
+    assert not pids["haina"] & pids["magdalena"]
+
+
+def test_worker_pool_error():
+    """
+    Test a failed task raises an error and the pool can be used again
+    """
+    worker_pool = AffinityWorkerPool(processes=2)
+    try:
+        with pytest.raises(Exception) as ex:
+            list(worker_pool.imap_unordered(fail_task, range(6)))
+        assert "ValueError" in str(ex.value)
+        assert sorted(worker_pool.imap_unordered(fail_task, [0, 2, 4])) == [0, 2, 4]
+    finally:
+        worker_pool.close()
+
+
+def test_worker_pool_stopped_worker():
+    """
+    Test the task of a stopped worker fails and the worker is started again
+    """
+    worker_pool = AffinityWorkerPool(processes=2, poll_seconds=0.1)
+    try:
+        with pytest.raises(Exception) as ex:
+            list(worker_pool.imap_unordered(exit_task, [1]))
+        assert "stopped with exit code 1" in str(ex.value)
+        assert sorted(worker_pool.imap_unordered(exit_task, [0, 2, 4])) == [0, 2, 4]
+    finally:
+        worker_pool.close()
+
+
+def test_worker_pool_stopped_after_result():
+    """
+    Test the task of a worker stopped after putting its result is returned once
+    """
+    worker_pool = AffinityWorkerPool(processes=2, poll_seconds=0.1)
+    try:
+        slow_task_id = worker_pool.submit(sleep_task, "slow")
+        exit_task_id = worker_pool.submit(exit_after_task, "exit")
+        time.sleep(1)
+        # the stopped worker is found before its result is read
+        worker_pool._restart_stopped_workers()
+        finished_tasks = [worker_pool.waitAny(), worker_pool.waitAny()]
+        assert sorted((task_id, success) for task_id, success, _ in finished_tasks) == \
+            [(slow_task_id, True), (exit_task_id, True)]
+        assert not worker_pool.numTasks()
+        assert sorted(worker_pool.imap_unordered(fail_task, [0, 2])) == [0, 2]
+    finally:
+        worker_pool.close()
+
+
+def test_worker_pool_memory_budget():
+    """
+    Test the tasks running at the same time are within the memory budget
+    """
+    task_memory_mb = {"large_1": 80, "large_2": 80, "small_1": 10, "small_2": 10, "huge": 150}
+    worker_pool = AffinityWorkerPool(processes=4, memory_budget_mb=100)
+    try:
+        results = list(worker_pool.imap_unordered(sleep_task, sorted(task_memory_mb),
+                                                  task_memory_mb=task_memory_mb.get))
+    finally:
+        worker_pool.close()
+    assert sorted(task for task, _, _ in results) == sorted(task_memory_mb)
+    # the memory of the tasks running when each task starts
+    for task, time_start, _ in results:
+        running_tasks = [other_task for other_task, other_start, other_end in results
+                         if other_start <= time_start < other_end]
+        running_memory_mb = sum(task_memory_mb[other_task] for other_task in running_tasks)
+        # the task larger than the budget runs alone
+        assert running_memory_mb <= 100 or running_tasks == [task]
+
+
+def test_worker_pool_memory_overtakes():
+    """
+    Test the small tasks overtake a large task a limited number of times
+    """
+    tasks = ["small_1", "small_2", "large"] + ["small_{0}".format(task) for task in range(3, 9)]
+    worker_pool = AffinityWorkerPool(processes=2, memory_budget_mb=100, max_overtakes=2)
+    try:
+        results = list(worker_pool.imap_unordered(sleep_task, tasks,
+                                                  task_memory_mb=lambda task: 80 if task == "large" else 30))
+    finally:
+        worker_pool.close()
+    task_start = dict((task, time_start) for task, time_start, _ in results)
+    # two small tasks start before the large task, the others after it
+    assert sum(1 for task in tasks if task_start[task] > task_start["large"]) == 4
+
+
+def test_worker_pool_priority():
+    """
+    Test the pending tasks start in order of priority and waitAny times out
+    """
+    worker_pool = AffinityWorkerPool(processes=1)
+    try:
+        for task, priority in (("first", 0), ("low", 1), ("high", 5), ("medium", 3)):
+            worker_pool.submit(sleep_task, task, priority=priority)
+        assert worker_pool.waitAny(timeout=0.05) is None
+        results = []
+        while worker_pool.numTasks():
+            task_id, success, result = worker_pool.waitAny()
+            assert success
+            results.append(result)
+    finally:
+        worker_pool.close()
+    assert [task for task, _, _ in sorted(results, key=lambda result: result[1])] == \
+        ["first", "high", "medium", "low"]